@@ -1,10 +1,9 @@
 import os
 import sys
 import re
-import time
 from pathlib import Path
 from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import CancelledError, TimeoutError as FuturesTimeoutError
 from datetime import datetime, date, timedelta, time
 
 import streamlit as st
@@ -26,7 +25,23 @@ from src.utils.experiment_utils import (
     filter_active_variants,
     build_analysis_datetime_strings,
     apply_time_to_datetime_string,
+    run_planned_funnel_query,
+    get_funnel_batch_stats,
+    prefetch_segment_breakdown,
+    get_experiment_catalog_stats,
 )
+from src.utils.amplitude_client import get_amplitude_client_stats
+from src.utils.amplitude_filters import get_filter_compiler_stats
+from src.utils.arrow_cache import get_arrow_result_cache
+from src.utils.composite_metrics import get_composite_stats
+from src.utils.amplitude_query import fingerprint_query
+from src.utils.amplitude_cache import get_memory_cache, get_response_store, get_single_flight_stats
+from src.utils.funnel_cube import FunnelCube
+from src.utils.query_planner import plan_funnel_queries
+from src.utils.deadline import Deadline, DeadlineExceededError, deadline_scope
+from src.utils.task_scheduler import get_task_scheduler, get_task_scheduler_stats
+from src.utils.tracing import get_recent_traces, get_trace_stats, set_debug_tracing
+from src.utils.metrics_loader import get_compiled_metrics, get_metric_registry, metric_to_process
 
 PROJECT_ROOT = Path(__file__).resolve().parent
 
@@ -85,32 +100,6 @@ def _date_range_suffix_for_filename() -> str:
     return f"{start_clean}_al_{end_clean}"
 
 
-# ==============================================================================
-# MAPEO DE GHOST ANCHORS (Configuración Explícita)
-# Define qué evento de contexto (_loaded) se inyecta según el evento inicial.
-# Key: Evento Inicial de la métrica (Hijo)
-# Value: Evento Ancla a inyectar (Padre/Contexto)
-# ==============================================================================
-EVENT_ANCHOR_MAP = {
-    # Extras (Flexi, Checkin, Embarque, etc.)
-    'extra_selected': 'extras_dom_loaded',  # CORREGIDO: Plural 'extras'
-
-    # Maletas / Ancillaries (Modal o Selección directa)
-    'modal_ancillary_clicked': 'baggage_dom_loaded',
-    'baggage_selected': 'baggage_dom_loaded',
-    'cabin_bag_selected': 'baggage_dom_loaded',
-    'checked_bag_selected': 'baggage_dom_loaded',
-
-    # Vuelos (Selección de itinerario)
-    'dc_modal_dom_loaded': 'flight_dom_loaded_flight',
-    'inbound_flight_selected_flight': 'flight_dom_loaded_flight',
-    'outbound_flight_selected_flight': 'flight_dom_loaded_flight',
-
-    # Asientos (Selección en mapa)
-    'inbound_seat_selected': 'seatmap_dom_loaded',
-    'outbound_seat_selected': 'seatmap_dom_loaded'
-}
-
 # Lista completa de eventos disponibles en Amplitude
 AVAILABLE_EVENTS = [
     "homepage_dom_loaded", 
@@ -383,6 +372,9 @@ def run_ui():
     ensure_sys_path()
     env_success, env_message = load_env()
 
+    # Trazas de requests a Amplitude en modo debug (además de AMPLITUDE_TRACING); el flag es de esta sesión
+    set_debug_tracing(st.session_state.get('debug_mode', False))
+
     # Estado de sesión para persistir vistas e inputs entre reruns
     if "show_experiments" not in st.session_state:
         st.session_state["show_experiments"] = False
@@ -745,30 +737,10 @@ def run_ui():
                     st.divider()
                     
                     # Cargar métricas
+                    # OPTIMIZACIÓN: Definiciones compiladas una vez por versión del registro (Ghost Anchors ya aplicados)
                     PREDEFINED_METRICS_QUICK = {}
                     try:
-                        from src.utils.metrics_loader import (
-                            load_all_metrics,
-                            get_all_metrics_flat,
-                            get_metrics_info
-                        )
-                        
-                        metrics_by_category = load_all_metrics()
-                        PREDEFINED_METRICS_QUICK = get_all_metrics_flat(metrics_by_category)
-                        
-                        # Aplicar Ghost Anchors
-                        for metric_name, metric_def in PREDEFINED_METRICS_QUICK.items():
-                            if isinstance(metric_def, dict) and 'events' in metric_def:
-                                events_list = metric_def.get('events', [])
-                                if len(events_list) > 0:
-                                    first_event = events_list[0]
-                                    first_event_name = first_event[0] if isinstance(first_event, tuple) else first_event
-                                    if first_event_name in EVENT_ANCHOR_MAP:
-                                        anchor_event = EVENT_ANCHOR_MAP[first_event_name]
-                                        if first_event_name != anchor_event:
-                                            anchor_tuple = (anchor_event, [])
-                                            events_list.insert(0, anchor_tuple)
-                                            metric_def['hidden_first_step'] = True
+                        PREDEFINED_METRICS_QUICK = get_compiled_metrics()
                     except Exception as e:
                         # Error silenciado: solo se registra en terminal, no se muestra al usuario
                         print(f"[Error interno] Error cargando métricas: {str(e)}")
@@ -795,49 +767,7 @@ def run_ui():
                         # Procesar métricas predefinidas
                         for metric_name in selected_metrics_quick:
                             if metric_name in PREDEFINED_METRICS_QUICK:
-                                metric_config = PREDEFINED_METRICS_QUICK[metric_name]
-                                metric_events = []
-                                metric_filters_map = {}
-                                
-                                if isinstance(metric_config, dict) and 'events' in metric_config:
-                                    events_list = metric_config['events']
-                                    if events_list:
-                                        first_item = events_list[0]
-                                        
-                                        if isinstance(first_item, tuple) and len(first_item) >= 2:
-                                            for event_tuple in events_list:
-                                                if isinstance(event_tuple, tuple) and len(event_tuple) >= 2:
-                                                    event_name = event_tuple[0]
-                                                    event_filters = event_tuple[1] if isinstance(event_tuple[1], list) else []
-                                                    metric_events.append(event_name)
-                                                    if event_filters:
-                                                        metric_filters_map[event_name] = event_filters
-                                        elif isinstance(first_item, tuple) and len(first_item) == 1:
-                                            for event_tuple in events_list:
-                                                if isinstance(event_tuple, tuple) and len(event_tuple) > 0:
-                                                    metric_events.append(event_tuple[0])
-                                        elif isinstance(first_item, str):
-                                            metric_events = events_list
-                                            metric_filters = metric_config.get('filters', [])
-                                            if metric_filters:
-                                                filters_list = metric_filters if isinstance(metric_filters, list) else [metric_filters]
-                                                for event in metric_events:
-                                                    metric_filters_map[event] = filters_list.copy()
-                                
-                                elif isinstance(metric_config, list):
-                                    metric_events = metric_config
-                                
-                                if metric_events:
-                                    hidden_first_step = False
-                                    if isinstance(metric_config, dict):
-                                        hidden_first_step = metric_config.get('hidden_first_step', False)
-                                    
-                                    metrics_to_process_sidebar.append({
-                                        'name': metric_name,
-                                        'events': metric_events,
-                                        'filters': metric_filters_map,
-                                        'hidden_first_step': hidden_first_step
-                                    })
+                                metrics_to_process_sidebar.append(metric_to_process(PREDEFINED_METRICS_QUICK[metric_name]))
                         
                         # Agregar eventos individuales
                         if selected_events_raw_quick:
@@ -899,13 +829,48 @@ def run_ui():
         # ============================================================
         st.subheader("🚀 Optimización")
         if st.button("🗑️ Limpiar Caché de Amplitude", key="clear_cache_sidebar"):
-            # Limpiar caché en memoria (legacy)
+            # Limpiar caché en memoria y store persistente de respuestas
             clear_amplitude_cache()
             # Limpiar caché persistente de Streamlit
             st.cache_data.clear()
             st.success("✅ Caché limpiado exitosamente")
             st.info("El caché acelera las consultas repetidas. Límpialo si los datos parecen desactualizados.")
-        
+
+        with st.expander("📈 Estadísticas de Amplitude", expanded=False):
+            st.caption("Conexiones HTTP (pool keep-alive) y gobernador de concurrencia")
+            st.json(get_amplitude_client_stats())
+            st.caption("Single-flight (queries idénticas en vuelo compartidas)")
+            st.json(get_single_flight_stats())
+            st.caption("Caché en memoria (LRU/TTL con presupuesto en bytes)")
+            st.json(get_memory_cache().get_stats())
+            st.caption("Store persistente de respuestas (SQLite)")
+            st.json(get_response_store().get_stats())
+            st.caption("Queries multi-variante (un segmento por variante)")
+            st.json(get_funnel_batch_stats())
+            st.caption("Catálogo de experimentos (índice en memoria con refresco por TTL)")
+            st.json(get_experiment_catalog_stats())
+            st.caption("Planificador de tareas (pool compartido de métricas, variantes y segmentos)")
+            st.json(get_task_scheduler_stats())
+            st.caption("Registro de métricas (recarga solo los archivos modificados)")
+            st.json(get_metric_registry().get_stats())
+            st.caption("Compilador de filtros (JSON de eventos por combinación de filtros)")
+            st.json(get_filter_compiler_stats())
+            st.caption("Métricas compuestas (sub-métricas combinadas por fecha)")
+            st.json(get_composite_stats())
+            st.caption("Resultados del pipeline (tablas Arrow mapeadas en memoria)")
+            st.json(get_arrow_result_cache().get_stats())
+            # Trazas por request: solo con AMPLITUDE_TRACING=1 o en modo debug
+            trace_stats = get_trace_stats()
+            if trace_stats['enabled']:
+                st.caption("Trazas de requests (latencia, payload y resultado de caché)")
+                st.json(trace_stats)
+                recent_traces = get_recent_traces(limit=100)
+                if recent_traces:
+                    st.dataframe(pd.DataFrame(recent_traces), use_container_width=True, hide_index=True)
+            if st.session_state.get('query_plan_stats'):
+                st.caption("Planificador de queries (último análisis)")
+                st.json(st.session_state['query_plan_stats'])
+
         st.divider()
         
         # ============================================================
@@ -1148,61 +1113,158 @@ def run_ui():
                                 # Diccionario para almacenar resultados por métrica
                                 metrics_results = {}
                                 
-                                # Procesar cada métrica por separado (solo variantes activas → menos llamadas API)
-                                progress_bar = st.progress(0)
+                                # OPTIMIZACIÓN: Planificar queries - las métricas que son prefijo de otra (mismos eventos y
+                                # filtros) se responden con la query de la métrica más larga (solo variantes activas)
+                                query_plan = plan_funnel_queries(metrics_to_process)
+                                st.session_state['query_plan_stats'] = {
+                                    'metrics': query_plan['requested_calls'],
+                                    'funnel_queries': query_plan['planned_calls'],
+                                    'saved_queries': query_plan['saved_calls'],
+                                    'saved_api_calls': query_plan['saved_calls'] * len(active_variants_tuple),
+                                }
+                                progress_bar = st.progress(0, text=f"0/{len(metrics_to_process)} métricas")
                                 total_metrics = len(metrics_to_process)
+                                completed_metrics = 0
+                                # Deadline del análisis: al vencer se cancela lo pendiente y se muestra lo que ya terminó
+                                analysis_deadline = Deadline.from_env()
+                                timed_out_metrics = []
+                                metric_configs = {m['name']: m for m in metrics_to_process}
                                 
-                                for idx, metric_info in enumerate(metrics_to_process):
-                                    metric_name = metric_info['name']
-                                    metric_events = metric_info['events']
-                                    metric_filters = metric_info['filters']
-                                    
-                                    # Actualizar progreso
-                                    progress_bar.progress((idx + 1) / total_metrics)
-                                    
-                                    # Ejecutar pipeline para esta métrica (solo variantes activas)
-                                    pipeline_kwargs = {
-                                        'start_date': start_date_quick,
-                                        'end_date': end_date_quick,
-                                        'experiment_id': experiment_id_quick,
-                                        'device': device_quick,
-                                        'culture': culture_quick,
-                                        'country': st.session_state.get('country_quick', []),
-                                        'event_list': metric_events,
-                                        'conversion_window': conversion_window_quick,
-                                        'flow_type': flow_type_quick,
-                                        'bundle_profile': bundle_profile_quick,
-                                        'trip_type': trip_type_quick,
-                                        'travel_group': travel_group_quick,
-                                        'active_variants': active_variants_tuple,
-                                    }
-                                    
-                                    # Agregar event_filters_map solo si existe y no está vacío
-                                    if metric_filters:
-                                        pipeline_kwargs['event_filters_map'] = metric_filters
-                                    
-                                    # Agregar hidden_first_step si la métrica lo tiene
-                                    if metric_info.get('hidden_first_step', False):
-                                        pipeline_kwargs['hidden_first_step'] = True
-                                    
-                                    try:
-                                        if use_cumulative:
-                                            df_metric = final_pipeline_cumulative(**pipeline_kwargs)
+                                # OPTIMIZACIÓN: Resultados en vivo - cada métrica se muestra apenas llegan sus datos,
+                                # sin esperar al resto del lote (la pestaña de estadísticas mantiene el análisis completo)
+                                st.markdown("### ⚡ Resultados en vivo")
+                                live_results = st.container()
+                                
+                                def render_live_metric(metric_name, df_metric):
+                                    """Tarjeta de una métrica recién obtenida (pasos por posición: ancla o paso 1 → último paso)"""
+                                    from src.utils.statistical_analysis import (
+                                        prepare_variants_by_step,
+                                        calculate_ab_test,
+                                        calculate_chi_square_test,
+                                        create_metric_card,
+                                        create_multivariant_card,
+                                    )
+                                    initial_step = 1 if metric_configs.get(metric_name, {}).get('hidden_first_step', False) else 0
+                                    variants_live = prepare_variants_by_step(df_metric, initial_step=initial_step)
+                                    # Mismo orden que la pestaña de estadísticas: control primero y luego el orden del experimento
+                                    variant_order = {name: idx for idx, name in enumerate(experiment_variants or [])}
+                                    variants_live.sort(key=lambda v: (v['name'].lower() != 'control', variant_order.get(v['name'], len(variant_order))))
+                                    with live_results:
+                                        if len(variants_live) < 2:
+                                            st.caption(f"ℹ️ {metric_name}: sin datos suficientes para comparar variantes")
+                                        elif len(variants_live) == 2:
+                                            create_metric_card(
+                                                metric_name=metric_name,
+                                                data={'baseline': variants_live[0], 'treatment': variants_live[1]},
+                                                results=calculate_ab_test(
+                                                    variants_live[0]['n'], variants_live[0]['x'],
+                                                    variants_live[1]['n'], variants_live[1]['x']
+                                                ),
+                                                experiment_name=selected_row.get('name', experiment_id_quick),
+                                                metric_subtitle=metric_name
+                                            )
                                         else:
-                                            df_metric = final_pipeline(**pipeline_kwargs)
-                                        
-                                        # Guardar resultado de esta métrica
-                                        metrics_results[metric_name] = df_metric
-                                    except Exception as e:
-                                        # Error silenciado: solo se registra en terminal, no se muestra al usuario
-                                        print(f"[Error interno] Error procesando métrica '{metric_name}': {str(e)}")
-                                        metrics_results[metric_name] = pd.DataFrame()
+                                            create_multivariant_card(
+                                                metric_name=metric_name,
+                                                variants=variants_live,
+                                                experiment_name=selected_row.get('name', experiment_id_quick),
+                                                metric_subtitle=metric_name,
+                                                chi_square_result=calculate_chi_square_test(variants_live)
+                                            )
+                                
+                                # Productor: las queries del plan (una por grupo de métricas) se encolan en el planificador compartido;
+                                # cada una abre sus tareas por variante en el mismo pool y el gobernador de Amplitude limita las requests reales.
+                                # Consumidor: este hilo (el único que puede escribir en la UI) muestra cada métrica al completarse
+                                scheduler = get_task_scheduler()
+                                # Encolar dentro del deadline del análisis: la tarea queda ligada a él y solo se une a una
+                                # query en vuelo de otra ejecución si el deadline de esa query dura al menos lo mismo
+                                with deadline_scope(analysis_deadline):
+                                    future_to_query = {
+                                        scheduler.submit(
+                                            run_planned_funnel_query,
+                                            planned_query,
+                                            start_date=start_date_quick,
+                                            end_date=end_date_quick,
+                                            experiment_id=experiment_id_quick,
+                                            device=device_quick,
+                                            culture=culture_quick,
+                                            country=st.session_state.get('country_quick', []),
+                                            conversion_window=conversion_window_quick,
+                                            flow_type=flow_type_quick,
+                                            bundle_profile=bundle_profile_quick,
+                                            trip_type=trip_type_quick,
+                                            travel_group=travel_group_quick,
+                                            active_variants=active_variants_tuple,
+                                            use_cumulative=use_cumulative,
+                                            _deadline=analysis_deadline,
+                                            # Una re-ejecución del script con el mismo análisis se une a la query que sigue en vuelo
+                                            key=fingerprint_query({
+                                                'metric': planned_query['metric'], 'members': planned_query['members'],
+                                                'experiment_id': experiment_id_quick, 'start_date': start_date_quick, 'end_date': end_date_quick,
+                                                'device': device_quick, 'culture': culture_quick, 'country': st.session_state.get('country_quick', []),
+                                                'conversion_window': conversion_window_quick, 'flow_type': flow_type_quick,
+                                                'bundle_profile': bundle_profile_quick, 'trip_type': trip_type_quick, 'travel_group': travel_group_quick,
+                                                'active_variants': active_variants_tuple, 'use_cumulative': use_cumulative,
+                                            }, scope='planned_query'),
+                                        ): planned_query
+                                        for planned_query in query_plan['queries']
+                                    }
+                                
+                                # El hilo principal no espera más allá del deadline, aunque una query no responda
+                                pending_queries = dict(future_to_query)
+                                try:
+                                    for future in scheduler.as_completed(future_to_query, timeout=analysis_deadline.remaining()):
+                                        planned_query = pending_queries.pop(future)
+                                        try:
+                                            planned_results = future.result()
+                                        except DeadlineExceededError:
+                                            timed_out_metrics.extend(member['name'] for member in planned_query['members'])
+                                            planned_results = {}
+                                        except CancelledError:
+                                            timed_out_metrics.extend(member['name'] for member in planned_query['members'])
+                                            planned_results = {}
+                                        except Exception as e:
+                                            # Error silenciado: solo se registra en terminal, no se muestra al usuario
+                                            for member in planned_query['members']:
+                                                print(f"[Error interno] Error procesando métrica '{member['name']}': {str(e)}")
+                                            metrics_results.update({member['name']: pd.DataFrame() for member in planned_query['members']})
+                                            planned_results = {}
+                                        metrics_results.update(planned_results)
+                                
+                                        # Progreso real: métricas completadas (una query del plan puede resolver varias)
+                                        completed_metrics += len(planned_query['members'])
+                                        progress_bar.progress(completed_metrics / total_metrics, text=f"{completed_metrics}/{total_metrics} métricas")
+                                        for metric_name, df_metric in planned_results.items():
+                                            try:
+                                                render_live_metric(metric_name, df_metric)
+                                            except Exception as e:
+                                                # La tarjeta en vivo es una vista previa: un error aquí no debe cortar el análisis
+                                                print(f"⚠️ No se pudo mostrar en vivo '{metric_name}': {e}")
+                                except FuturesTimeoutError:
+                                    # Lo que no terminó no alcanzaría a terminar: cancelarlo (una query compartida
+                                    # con otra sesión solo se suelta, esa sesión la sigue esperando)
+                                    for pending_future, planned_query in pending_queries.items():
+                                        scheduler.cancel(pending_future)
+                                        timed_out_metrics.extend(member['name'] for member in planned_query['members'])
+                                
+                                # Mantener el orden de selección de las métricas
+                                metrics_results = {m['name']: metrics_results[m['name']] for m in metrics_to_process if m['name'] in metrics_results}
+                                if query_plan['saved_calls'] > 0:
+                                    print(f"[Planner] {query_plan['requested_calls']} métricas resueltas con {query_plan['planned_calls']} queries de funnel")
                                 
                                 progress_bar.empty()
+                                st.session_state['analysis_timed_out_metrics'] = timed_out_metrics
+                                if timed_out_metrics:
+                                    st.warning(
+                                        f"⏱️ Se alcanzó el límite de {analysis_deadline.seconds:.0f}s del análisis. "
+                                        f"Resultados parciales; sin datos para: {', '.join(timed_out_metrics)}"
+                                    )
                                 
                                 # Guardar todos los resultados en session_state
                                 # El nombre de la métrica ya es el display name (viene de PREDEFINED_METRICS_QUICK)
                                 st.session_state['metrics_results'] = metrics_results
+                                # Cubo de funnels (métrica × segmento × variante × fecha × paso) para la pestaña de estadísticas
+                                st.session_state['funnel_cube'] = FunnelCube.from_metrics_results(metrics_results)
                                 st.session_state['analysis_experiment_id'] = experiment_id_quick
                                 st.session_state['analysis_experiment_name'] = selected_row.get('name', experiment_id_quick)
                                 
@@ -1431,6 +1493,12 @@ def run_ui():
                 metrics_results = st.session_state['metrics_results']
                 # HARDENING: Materializar available_metrics como lista explícita
                 available_metrics = list([(name, df) for name, df in metrics_results.items() if df is not None and not df.empty])
+                # Métricas que no alcanzaron a consultarse antes del deadline del análisis
+                if st.session_state.get('analysis_timed_out_metrics'):
+                    st.warning(
+                        "⏱️ Resultados parciales: sin datos por límite de tiempo para "
+                        + ", ".join(st.session_state['analysis_timed_out_metrics'])
+                    )
                 
                 if not available_metrics:
                     st.warning("⚠️ No hay métricas con datos disponibles para análisis")
@@ -1457,7 +1525,7 @@ def run_ui():
                         prepare_variants_from_dataframe,
                         calculate_ab_test,
                         calculate_chi_square_test,
-                        calculate_single_comparison,
+                        get_pairwise_comparisons,
                         create_metric_card,
                         create_multivariant_card
                     )
@@ -1521,13 +1589,11 @@ def run_ui():
                             # Obtener etapas únicas del funnel
                             available_stages = df_analysis['Funnel Stage'].unique().tolist()
                             
-                            # Obtener el orden correcto de eventos desde la configuración de la métrica
-                            # Cargar métricas automáticamente para buscar la configuración
+                            # Obtener el orden correcto de eventos desde la definición compilada de la métrica
+                            # (incluye el Ghost Anchor y hidden_first_step; es una consulta al registro, sin recargar módulos)
                             metric_config = None
                             try:
-                                from src.utils.metrics_loader import get_all_metrics_flat
-                                all_metrics = get_all_metrics_flat()
-                                metric_config = all_metrics.get(metric_display_name)
+                                metric_config = get_compiled_metrics().get(metric_display_name)
                             except Exception:
                                 # Si no se pueden cargar, continuar sin configuración
                                 pass
@@ -1801,12 +1867,17 @@ def run_ui():
                                                 )
                                             ]
                                     
-                                    # Preparar variantes usando el DataFrame filtrado
-                                    variants = prepare_variants_from_dataframe(
-                                        df_analysis_filtered,
-                                        initial_stage=initial_stage,
-                                        final_stage=final_stage
-                                    )
+                                    # Preparar variantes: leer n/x directamente del cubo de funnels si está disponible
+                                    # (las etapas inicial/final nunca son el ancla, así que no hace falta filtrarlo)
+                                    funnel_cube = st.session_state.get('funnel_cube')
+                                    if funnel_cube is not None and funnel_cube.has_metric(metric_display_name):
+                                        variants = funnel_cube.variant_counts(metric_display_name, initial_stage, final_stage)
+                                    else:
+                                        variants = prepare_variants_from_dataframe(
+                                            df_analysis_filtered,
+                                            initial_stage=initial_stage,
+                                            final_stage=final_stage
+                                        )
                                     
                                     # Ordenar variantes correctamente: control primero, luego variant-1, variant-2, etc.
                                     variants = sort_variants_correctly(variants, experiment_id_stat)
@@ -1837,8 +1908,10 @@ def run_ui():
                                                 try:
                                                     analysis_params = st.session_state.get('analysis_params', {})
                                                     if analysis_params and metric_config and 'events' in metric_config:
-                                                        metric_events = metric_config['events']
-                                                        metric_filters = metric_config.get('filters', {})
+                                                        # Misma query que el análisis de conversión (con el Ghost Anchor de la definición compilada)
+                                                        metric_query = metric_to_process(metric_config)
+                                                        metric_events = metric_query['events']
+                                                        metric_filters = metric_query['filters']
                                                         all_variants_raw = get_all_variants_raw_data(
                                                             start_date=analysis_params.get('start_date'),
                                                             end_date=analysis_params.get('end_date'),
@@ -1923,8 +1996,10 @@ def run_ui():
                                                 try:
                                                     analysis_params = st.session_state.get('analysis_params', {})
                                                     if analysis_params and metric_config and 'events' in metric_config:
-                                                        metric_events = metric_config['events']
-                                                        metric_filters = metric_config.get('filters', {})
+                                                        # Misma query que el análisis de conversión (con el Ghost Anchor de la definición compilada)
+                                                        metric_query = metric_to_process(metric_config)
+                                                        metric_events = metric_query['events']
+                                                        metric_filters = metric_query['filters']
                                                         all_variants_raw = get_all_variants_raw_data(
                                                             start_date=analysis_params.get('start_date'),
                                                             end_date=analysis_params.get('end_date'),
@@ -1960,7 +2035,8 @@ def run_ui():
                                                     mode_for_card_multivariant = "conversion"
                                             
                                             # Acumular para exportación CSV (multivariante: P2BB y % Improvement vs control)
-                                            baseline_multi = variants[0]
+                                            # Mismas comparaciones memoizadas que usa la tarjeta multivariante (métrica, subtítulo)
+                                            pairwise_multi = get_pairwise_comparisons(variants, metric=metric_display_name, segment=metric_display_name)
                                             for i, v in enumerate(variants):
                                                 n, x = v.get("n", 0), v.get("x", 0)
                                                 tasa = round((x / n) * 100, 4) if n else 0
@@ -1969,7 +2045,7 @@ def run_ui():
                                                     improvement_val = ""
                                                     pval = round(chi_square_result["p_value"], 5) if chi_square_result and chi_square_result.get("p_value") is not None else ""
                                                 else:
-                                                    comp = calculate_single_comparison(baseline_multi, v)
+                                                    comp = pairwise_multi.get(0, i)
                                                     p2bb_val = round(comp.get("p2bb", 0) * 100, 2) if comp.get("p2bb") is not None else ""
                                                     improvement_val = round(comp.get("relative_lift", 0), 2) if comp.get("relative_lift") is not None else ""
                                                     pval = round(comp["p_value"], 5) if comp.get("p_value") is not None else ""
@@ -2086,7 +2162,8 @@ def run_ui():
                                     chi_square_result = calculate_chi_square_test(variants)
                                     
                                     # Acumular para exportación CSV (sin funnel, multivariante: P2BB y % Improvement vs control)
-                                    baseline_multi = variants[0]
+                                    # Mismas comparaciones memoizadas que usa la tarjeta multivariante (métrica, subtítulo)
+                                    pairwise_multi = get_pairwise_comparisons(variants, metric=metric_display_name, segment=metric_display_name)
                                     for i, v in enumerate(variants):
                                         n, x = v.get("n", 0), v.get("x", 0)
                                         tasa = round((x / n) * 100, 4) if n else 0
@@ -2095,7 +2172,7 @@ def run_ui():
                                             improvement_val = ""
                                             pval = round(chi_square_result["p_value"], 5) if chi_square_result and chi_square_result.get("p_value") is not None else ""
                                         else:
-                                            comp = calculate_single_comparison(baseline_multi, v)
+                                            comp = pairwise_multi.get(0, i)
                                             p2bb_val = round(comp.get("p2bb", 0) * 100, 2) if comp.get("p2bb") is not None else ""
                                             improvement_val = round(comp.get("relative_lift", 0), 2) if comp.get("relative_lift") is not None else ""
                                             pval = round(comp["p_value"], 5) if comp.get("p_value") is not None else ""
@@ -2320,6 +2397,8 @@ def run_ui():
                                     if len(segments_to_process) > 0:
                                         # Acumular filas para exportación CSV de segmentación
                                         segmentation_export_rows = []
+                                        # Deadline del desglose (todas las métricas): al vencer, los segmentos pendientes quedan marcados sin datos
+                                        breakdown_deadline = Deadline.from_env()
                                         # Procesar cada métrica con desglose
                                         for metric_info in original_metrics:
                                             metric_display_name = metric_info['name']
@@ -2332,110 +2411,97 @@ def run_ui():
                                             # Importar funciones de renderizado
                                             from src.utils.statistical_analysis import (
                                                 create_multivariant_card,
-                                                calculate_single_comparison,
+                                                calculate_batch_comparisons,
                                                 create_segmentation_table_html
                                             )
                                             import streamlit.components.v1 as components
                                             
                                             # OPTIMIZACIÓN #3: Paralelización de desgloses
+                                            def build_segment_params(segment_value):
+                                                """Parámetros de final_pipeline / final_pipeline_cumulative para un segmento del desglose"""
+                                                # Función auxiliar para normalizar y obtener valores seguros
+                                                def get_safe_param(param_name, default_value):
+                                                    value = original_params.get(param_name, default_value)
+                                                    if value is None:
+                                                        return default_value
+                                                    if isinstance(value, str):
+                                                        value_str = value.strip()
+                                                        if value_str.upper() == "ALL":
+                                                            return "ALL"
+                                                    return value
+                                                
+                                                # Construir parámetros de query
+                                                query_params = {
+                                                    'start_date': original_params.get('start_date'),
+                                                    'end_date': original_params.get('end_date'),
+                                                    'experiment_id': original_params.get('experiment_id'),
+                                                    'event_list': metric_events,
+                                                    'device': get_safe_param('device', 'ALL'),
+                                                    'culture': get_safe_param('culture', 'ALL'),
+                                                    'country': get_safe_param('country', None),
+                                                    'flow_type': get_safe_param('flow_type', 'ALL'),
+                                                    'bundle_profile': get_safe_param('bundle_profile', 'ALL'),
+                                                    'trip_type': get_safe_param('trip_type', 'ALL'),
+                                                    'travel_group': get_safe_param('travel_group', 'ALL'),
+                                                    'conversion_window': original_params.get('conversion_window', 1800),
+                                                    'event_filters_map': metric_filters if metric_filters else None
+                                                }
+                                                if original_params.get('active_variants') is not None:
+                                                    query_params['active_variants'] = original_params['active_variants']
+                                                if metric_info.get('hidden_first_step', False):
+                                                    query_params['hidden_first_step'] = True
+                                                
+                                                # Sobrescribir parámetro del segmento
+                                                if breakdown_selected == 'Device':
+                                                    query_params['device'] = segment_value
+                                                elif breakdown_selected == 'Culture':
+                                                    # Si el segment es "INTER", agrupar los países INTER
+                                                    if segment_value == 'INTER':
+                                                        query_params['culture'] = ['BR', 'UY', 'PY', 'EC', 'US', 'DO']
+                                                    else:
+                                                        query_params['culture'] = segment_value
+                                                elif breakdown_selected == 'Country':
+                                                    query_params['country'] = segment_value  # Nombre de país (propiedad nativa Amplitude)
+                                                elif breakdown_selected == 'Flow Type':
+                                                    query_params['flow_type'] = segment_value
+                                                elif breakdown_selected == 'Trip Type':
+                                                    query_params['trip_type'] = segment_value
+                                                elif breakdown_selected == 'Flight Profile':
+                                                    query_params['bundle_profile'] = segment_value
+                                                elif breakdown_selected == 'Travel Group':
+                                                    query_params['travel_group'] = segment_value
+                                                
+                                                # Remover event_filters_map si es None
+                                                call_params = query_params.copy()
+                                                if call_params.get('event_filters_map') is None:
+                                                    call_params.pop('event_filters_map', None)
+                                                return call_params
+                                            
                                             # Función helper para procesar un segmento individual (ejecutada en paralelo)
                                             def process_segment(segment_value):
                                                 """Procesa un segmento individual y retorna los datos para renderizar"""
                                                 try:
-                                                    # Función auxiliar para normalizar y obtener valores seguros
-                                                    def get_safe_param(param_name, default_value):
-                                                        value = original_params.get(param_name, default_value)
-                                                        if value is None:
-                                                            return default_value
-                                                        if isinstance(value, str):
-                                                            value_str = value.strip()
-                                                            if value_str.upper() == "ALL":
-                                                                return "ALL"
-                                                        return value
-                                                    
-                                                    # Construir parámetros de query
-                                                    query_params = {
-                                                        'start_date': original_params.get('start_date'),
-                                                        'end_date': original_params.get('end_date'),
-                                                        'experiment_id': original_params.get('experiment_id'),
-                                                        'event_list': metric_events,
-                                                        'device': get_safe_param('device', 'ALL'),
-                                                        'culture': get_safe_param('culture', 'ALL'),
-                                                        'country': get_safe_param('country', None),
-                                                        'flow_type': get_safe_param('flow_type', 'ALL'),
-                                                        'bundle_profile': get_safe_param('bundle_profile', 'ALL'),
-                                                        'trip_type': get_safe_param('trip_type', 'ALL'),
-                                                        'travel_group': get_safe_param('travel_group', 'ALL'),
-                                                        'conversion_window': original_params.get('conversion_window', 1800),
-                                                        'event_filters_map': metric_filters if metric_filters else None
-                                                    }
-                                                    if original_params.get('active_variants') is not None:
-                                                        query_params['active_variants'] = original_params['active_variants']
-                                                    if metric_info.get('hidden_first_step', False):
-                                                        query_params['hidden_first_step'] = True
+                                                    call_params = build_segment_params(segment_value)
+                                                    if segment_value in grouped_segments:
+                                                        # Resultados del group-by: caché propia, separada del análisis normal
+                                                        call_params['grouped_breakdown'] = breakdown_selected
                                                     
                                                     # Validar parámetros obligatorios
                                                     required_params = ['start_date', 'end_date', 'experiment_id', 'event_list']
-                                                    missing_params = [p for p in required_params if query_params.get(p) is None]
+                                                    missing_params = [p for p in required_params if call_params.get(p) is None]
                                                     if missing_params:
                                                         return {'error': f"Parámetros faltantes: {missing_params}", 'segment': segment_value}
                                                     
-                                                    # Sobrescribir parámetro del segmento
-                                                    if breakdown_selected == 'Device':
-                                                        query_params['device'] = segment_value
-                                                    elif breakdown_selected == 'Culture':
-                                                        # Si el segment es "INTER", agrupar los países INTER
-                                                        if segment_value == 'INTER':
-                                                            query_params['culture'] = ['BR', 'UY', 'PY', 'EC', 'US', 'DO']
+                                                    # Hacer llamada API (los reintentos ante 429/5xx los maneja el cliente de Amplitude)
+                                                    try:
+                                                        if use_cumulative_breakdown:
+                                                            df_segment = final_pipeline_cumulative(**call_params, _deadline=breakdown_deadline)
                                                         else:
-                                                            query_params['culture'] = segment_value
-                                                    elif breakdown_selected == 'Country':
-                                                        query_params['country'] = segment_value  # Nombre de país (propiedad nativa Amplitude)
-                                                    elif breakdown_selected == 'Flow Type':
-                                                        query_params['flow_type'] = segment_value
-                                                    elif breakdown_selected == 'Trip Type':
-                                                        query_params['trip_type'] = segment_value
-                                                    elif breakdown_selected == 'Flight Profile':
-                                                        query_params['bundle_profile'] = segment_value
-                                                    elif breakdown_selected == 'Travel Group':
-                                                        query_params['travel_group'] = segment_value
-                                                    
-                                                    # Remover event_filters_map si es None
-                                                    call_params = query_params.copy()
-                                                    if call_params.get('event_filters_map') is None:
-                                                        call_params.pop('event_filters_map', None)
-                                                    
-                                                    # Hacer llamada API con retry y backoff
-                                                    max_retries = 3
-                                                    attempt = 0
-                                                    df_segment = None
-                                                    
-                                                    while attempt < max_retries:
-                                                        try:
-                                                            # Intentar obtener datos
-                                                            if use_cumulative_breakdown:
-                                                                df_segment = final_pipeline_cumulative(**call_params)
-                                                            else:
-                                                                df_segment = final_pipeline(**call_params)
-                                                            
-                                                            # Validar si la respuesta es útil (no vacía)
-                                                            if df_segment is not None and not df_segment.empty:
-                                                                break  # ¡Éxito! Salimos del bucle de reintentos
-                                                            
-                                                            # Si llegamos aquí, el DataFrame está vacío
-                                                            attempt += 1
-                                                            if attempt < max_retries:
-                                                                time.sleep(0.5)  # Esperamos medio segundo antes de reintentar
-                                                            else:
-                                                                return {'error': 'DataFrame vacío después de múltiples intentos', 'segment': segment_value}
-                                                        
-                                                        except Exception as api_error:
-                                                            # Si hay un error en la llamada API, reintentar
-                                                            attempt += 1
-                                                            if attempt < max_retries:
-                                                                time.sleep(0.5)  # Esperamos medio segundo antes de reintentar
-                                                            else:
-                                                                return {'error': f'Error en API después de {max_retries} intentos: {str(api_error)}', 'segment': segment_value}
+                                                            df_segment = final_pipeline(**call_params, _deadline=breakdown_deadline)
+                                                    except DeadlineExceededError:
+                                                        return {'error': 'Límite de tiempo del desglose', 'segment': segment_value, 'timed_out': True}
+                                                    except Exception as api_error:
+                                                        return {'error': f'Error en API: {str(api_error)}', 'segment': segment_value}
                                                     
                                                     # Verificación final de seguridad
                                                     if df_segment is None or df_segment.empty:
@@ -2450,9 +2516,7 @@ def run_ui():
                                                         
                                                         metric_config = None
                                                         try:
-                                                            from src.utils.metrics_loader import get_all_metrics_flat
-                                                            all_metrics = get_all_metrics_flat()
-                                                            metric_config = all_metrics.get(metric_display_name)
+                                                            metric_config = get_compiled_metrics().get(metric_display_name)
                                                         except Exception:
                                                             pass
                                                         
@@ -2555,8 +2619,9 @@ def run_ui():
                                                     if not initial_stage or not final_stage or initial_stage == final_stage:
                                                         return {'error': 'No se encontraron stages válidos', 'segment': segment_value}
                                                     
-                                                    # Filtrar DataFrame si hidden_first_step
-                                                    df_segment_filtered = df_segment.copy()
+                                                    # Filtrar DataFrame si hidden_first_step (df_segment es una vista de solo
+                                                    # lectura del caché Arrow; el filtro crea un DataFrame nuevo, no hace falta copiar)
+                                                    df_segment_filtered = df_segment
                                                     if metric_config and metric_config.get('hidden_first_step', False):
                                                         anchor_event_name = None
                                                         if 'events' in metric_config and metric_config['events']:
@@ -2608,20 +2673,43 @@ def run_ui():
                                             breakdown_progress = st.progress(0)
                                             total_segments = len(segments_to_process)
                                             segment_results = []
+                                            timed_out_segments = []
                                             
-                                            with ThreadPoolExecutor(max_workers=2) as executor:
-                                                # Enviar tareas en paralelo (2 a la vez para no superar límite de concurrencia de Amplitude)
-                                                future_to_segment = {executor.submit(process_segment, segment_value): segment_value for segment_value in segments_to_process}
-                                                
-                                                # Recopilar resultados a medida que completan
-                                                completed = 0
-                                                for future in as_completed(future_to_segment):
+                                            # OPTIMIZACIÓN: Group-by pushdown - una query agrupada por variante llena la caché de todos los
+                                            # segmentos; process_segment los sirve sin requests extra (o hace su query si no se pudo empujar)
+                                            # Solo los segmentos que el prefetch dejó en caché se leen del desglose agrupado; el resto
+                                            # hace su query normal y reutiliza la caché del análisis principal
+                                            grouped_segments = set()
+                                            try:
+                                                breakdown_segment_params = {segment_value: build_segment_params(segment_value) for segment_value in segments_to_process}
+                                                with deadline_scope(breakdown_deadline):
+                                                    grouped_segments = prefetch_segment_breakdown(breakdown_selected, breakdown_segment_params)
+                                            except Exception as e:
+                                                print(f"⚠️ Desglose agrupado no disponible ({e}); se usan queries por segmento")
+                                            
+                                            # Enviar tareas al planificador compartido (el gobernador de Amplitude limita las requests reales)
+                                            scheduler = get_task_scheduler()
+                                            future_to_segment = {scheduler.submit(process_segment, segment_value): segment_value for segment_value in segments_to_process}
+                                            
+                                            # Recopilar resultados a medida que completan
+                                            completed = 0
+                                            pending_segments = dict(future_to_segment)
+                                            try:
+                                                for future in scheduler.as_completed(future_to_segment, timeout=breakdown_deadline.remaining()):
+                                                    pending_segments.pop(future)
                                                     completed += 1
                                                     breakdown_progress.progress(completed / total_segments)
                                                     
                                                     result = future.result()
                                                     if 'error' not in result:
                                                         segment_results.append(result)
+                                                    elif result.get('timed_out'):
+                                                        timed_out_segments.append(result['segment'])
+                                            except FuturesTimeoutError:
+                                                # No esperar más allá del deadline del desglose
+                                                for pending_future, segment_value in pending_segments.items():
+                                                    scheduler.cancel(pending_future)
+                                                    timed_out_segments.append(segment_value)
                                             
                                             breakdown_progress.empty()
                                             
@@ -2631,9 +2719,14 @@ def run_ui():
                                             # Verificación de integridad: asegurar que tenemos resultados para todos los segmentos esperados
                                             segments_processed = {r.get('segment') for r in segment_results if 'error' not in r}
                                             segments_expected = set(segments_to_process)
-                                            missing_segments = segments_expected - segments_processed
+                                            missing_segments = segments_expected - segments_processed - set(timed_out_segments)
                                             if missing_segments and not show_cards:  # Solo mostrar warning en modo tabla
                                                 st.warning(f"⚠️ Algunos segmentos no retornaron datos: {sorted(missing_segments)}")
+                                            if timed_out_segments:
+                                                st.warning(
+                                                    f"⏱️ Resultados parciales: se alcanzó el límite de {breakdown_deadline.seconds:.0f}s del desglose; "
+                                                    f"sin datos para {sorted(timed_out_segments)}"
+                                                )
                                             
                                             # Ordenar resultados según el tipo de desglose
                                             if breakdown_selected == 'Device':
@@ -2699,9 +2792,19 @@ def run_ui():
                                                 # Los resultados ya vienen en el orden correcto de segment_values
                                                 pass
                                             
+                                            # OPTIMIZACIÓN: Estadísticas de todos los segmentos (control vs cada variante) en una sola pasada vectorizada
+                                            max_variants = max((len(r['variants']) for r in segment_results), default=0)
+                                            segment_n, segment_x, segment_valid = [], [], []
+                                            for result in segment_results:
+                                                padding = [0] * (max_variants - len(result['variants']))
+                                                segment_n.append([v['n'] for v in result['variants']] + padding)
+                                                segment_x.append([v['x'] for v in result['variants']] + padding)
+                                                segment_valid.append([True] * len(result['variants']) + [False] * len(padding))
+                                            batch_stats = calculate_batch_comparisons(segment_n, segment_x, 'control', segment_valid) if max_variants > 1 else None
+                                            
                                             # Construir data_rows para tabla y/o exportación CSV (siempre)
                                             data_rows = []
-                                            for result in segment_results:
+                                            for row_idx, result in enumerate(segment_results):
                                                 try:
                                                     variants = result['variants']
                                                     segment_value = result['segment']
@@ -2713,7 +2816,11 @@ def run_ui():
                                                         for i in range(1, len(variants)):
                                                             variant = variants[i]
                                                             variant_name = variant.get('name', f'Variant-{i}')
-                                                            comparison = calculate_single_comparison(baseline, variant)
+                                                            # El par (0, i) es la columna i - 1 del resultado batch
+                                                            comparison = {
+                                                                key: batch_stats[key][row_idx, i - 1].item()
+                                                                for key in ('relative_lift', 'p_value', 'p2bb', 'significant')
+                                                            }
                                                             cr_variant = (variant['x'] / variant['n']) * 100 if variant['n'] > 0 else 0
                                                             p2bb_value = comparison.get('p2bb', 0)
                                                             p2bb_display = f"{round(p2bb_value * 100)}%" if p2bb_value is not None else "-"
@@ -0,0 +1,131 @@
+"""
+Benchmark del parser columnar de funnels (src/utils/funnel_parser.py).
+
+Compara el parser anterior (un pd.concat y un pd.to_datetime por fila) contra el
+parser columnar, con respuestas sintéticas del tamaño de una corrida diaria típica
+(90 días, 6 pasos, 4 variantes). No llama a Amplitude.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_funnel_parser.py [--days 90] [--steps 6] [--variants 4] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.utils.funnel_parser import parse_cumulative_funnel, parse_daily_funnel  # noqa: E402
+
+
+def make_websites(days, steps, seed):
+    """Genera el `data` de una respuesta de funnel sintética."""
+    rnd = random.Random(seed)
+    start = date(2024, 1, 1)
+    x_values = [(start + timedelta(days=d)).isoformat() for d in range(days)]
+    series = []
+    for _ in range(days):
+        value = rnd.randint(1000, 5000)
+        row = []
+        for _ in range(steps):
+            row.append(value)
+            value = int(value * rnd.uniform(0.4, 0.9))
+        series.append(row)
+    return [{
+        'dayFunnels': {'series': series, 'xValues': x_values},
+        'events': [f'step_{s}' for s in range(steps)],
+        'cumulativeRaw': [sum(row[s] for row in series) for s in range(steps)],
+    }]
+
+
+def legacy_daily(websites, experiment_id, culture, device, variant):
+    """Parser diario anterior: un pd.concat por (fecha, paso)."""
+    df = pd.DataFrame({'Date': [], 'ExperimentID': [], 'Culture': [], 'Device': [], 'Variant': [], 'Event Count': []})
+    for website_funnel in websites:
+        for day, data in zip(website_funnel['dayFunnels']['xValues'], website_funnel['dayFunnels']['series']):
+            for stage_name, value in zip(website_funnel['events'], data):
+                new_row = {
+                    'Date': pd.to_datetime(day),
+                    'ExperimentID': experiment_id,
+                    'Funnel Stage': stage_name,
+                    'Culture': culture,
+                    'Device': device,
+                    'Variant': variant,
+                    'Event Count': int(value),
+                }
+                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+    return df
+
+
+def legacy_cumulative(websites, experiment_id, culture, device, variant, start, end):
+    """Parser acumulado anterior: un pd.concat por paso."""
+    df = pd.DataFrame({'Start Date': [], 'End Date': [], 'ExperimentID': [], 'Culture': [], 'Device': [],
+                       'Variant': [], 'Funnel Stage': [], 'Event Count': []})
+    for website_funnel in websites:
+        for stage_name, value in zip(website_funnel['events'], website_funnel['cumulativeRaw']):
+            new_row = {
+                'Start Date': pd.to_datetime(start),
+                'End Date': pd.to_datetime(end),
+                'ExperimentID': experiment_id,
+                'Culture': culture,
+                'Device': device,
+                'Variant': variant,
+                'Funnel Stage': stage_name,
+                'Event Count': int(value),
+            }
+            df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+    return df
+
+
+def best_of(fn, repeat):
+    """Devuelve el mejor tiempo (segundos) de `repeat` ejecuciones."""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--steps', type=int, default=6)
+    parser.add_argument('--variants', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    variants = [(f'variant_{i}', make_websites(args.days, args.steps, seed=i)) for i in range(args.variants)]
+    start, end = '2024-01-01 00:00:00', '2024-03-30 23:59:59'
+
+    def run_legacy_daily():
+        return [legacy_daily(w, 'exp', ['CL', 'AR'], 'All', name) for name, w in variants]
+
+    def run_columnar_daily():
+        return [parse_daily_funnel(w, 'exp', ['CL', 'AR'], 'All', name) for name, w in variants]
+
+    def run_legacy_cumulative():
+        return [legacy_cumulative(w, 'exp', ['CL', 'AR'], 'All', name, start, end) for name, w in variants]
+
+    def run_columnar_cumulative():
+        return [parse_cumulative_funnel(w, 'exp', ['CL', 'AR'], 'All', name, start, end) for name, w in variants]
+
+    rows = args.days * args.steps * args.variants
+    print(f"Funnel sintético: {args.days} días x {args.steps} pasos x {args.variants} variantes = {rows} filas diarias")
+    for label, legacy, columnar in (
+        ('Diario', run_legacy_daily, run_columnar_daily),
+        ('Acumulado', run_legacy_cumulative, run_columnar_cumulative),
+    ):
+        t_legacy = best_of(legacy, args.repeat)
+        t_columnar = best_of(columnar, args.repeat)
+        print(f"{label:<10} anterior: {t_legacy * 1000:9.1f} ms | columnar: {t_columnar * 1000:7.2f} ms | "
+              f"speedup: {t_legacy / t_columnar:7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
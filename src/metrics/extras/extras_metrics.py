@@ -148,16 +148,37 @@ def has_purchased_priority_filter():
 # 1. ANCHOR: Define el denominador correcto (Sesiones en la página de extras)
 # 2. INTENTION: Filtra qué tipo de extra queremos medir (excluye airportCheckin)
 # 3. GOAL: Confirmación de pago (si pasó por el paso 2 y pagó, asumimos que pagó lo que seleccionó)
-EXTRAS_GENERAL_CR = {'events': [
-    ('extras_dom_loaded', []),  # 1. ANCHOR: Recibe filtros globales, iguala el denominador del A2C
-    ('extra_selected', [{  # 2. INTENTION: Filtro OR simple - excluye airportCheckin
-        'subprop_type': 'event',
-        'subprop_key': 'type',  # Propiedad que contiene el tipo de extra
-        'subprop_op': 'is not',  # "Todo lo que NO sea Checkin" = Extras Generales
-        'subprop_value': ['airportCheckin']
-    }]),
-    ('revenue_amount', [])  # 3. GOAL: Confirmación de pago (sin filtros adicionales)
-]}
+# MÉTRICA COMPUESTA: los conteos salen del OR de las compras de Flexi, Pet y Priority
+# (ancla = máximo, conversión = suma; ver src/utils/composite_metrics.py)
+EXTRAS_GENERAL_CR = {
+    'events': [
+        ('extras_dom_loaded', []),  # 1. ANCHOR: Recibe filtros globales, iguala el denominador del A2C
+        ('extra_selected', [{  # 2. INTENTION: Filtro OR simple - excluye airportCheckin
+            'subprop_type': 'event',
+            'subprop_key': 'type',  # Propiedad que contiene el tipo de extra
+            'subprop_op': 'is not',  # "Todo lo que NO sea Checkin" = Extras Generales
+            'subprop_value': ['airportCheckin']
+        }]),
+        ('revenue_amount', [])  # 3. GOAL: Confirmación de pago (sin filtros adicionales)
+    ],
+    'composite': {
+        'combine': 'or',
+        'sub_metrics': [
+            {'name': 'flexi', 'events': [
+                ('extras_dom_loaded', []),
+                ('revenue_amount', [has_purchased_flexi_filter()])
+            ]},
+            {'name': 'pet', 'events': [
+                ('extras_dom_loaded', []),
+                ('revenue_amount', [has_purchased_pet_filter()])
+            ]},
+            {'name': 'priority', 'events': [
+                ('extras_dom_loaded', []),
+                ('revenue_amount', [has_purchased_priority_filter()])
+            ]},
+        ],
+    },
+}
 
 # CR Flexi
 # CORREGIDO: Incluye paso intermedio extra_selected para igualar el embudo con FLEXI_A2C
@@ -0,0 +1,617 @@
+"""
+Capas de caché y deduplicación de queries a Amplitude.
+
+Caché en memoria (ResponseMemoryCache): LRU con TTL, particionado en shards con
+un lock cada uno y con presupuesto en bytes según el tamaño medido (JSON) de cada
+respuesta. Permite invalidar todas las respuestas de un experimento.
+
+Store persistente (ResponseStore): guarda las respuestas crudas de Amplitude en
+SQLite (comprimidas con zlib) para que sobrevivan a reinicios. Las respuestas de
+ventanas de fechas que terminaron antes de "hoy" (en la zona horaria del proyecto)
+son inmutables y no expiran; las que tocan el día de hoy tienen un TTL corto.
+El store tiene un presupuesto de tamaño y se compacta (expirados primero, luego
+menos usados recientemente) cuando lo supera.
+
+Single-flight: si varias llamadas (hilos o sesiones de Streamlit distintas) piden
+la misma query mientras otra idéntica está en vuelo, solo la primera llega a
+Amplitude; el resto espera su resultado y lo comparte. El caché de respuestas
+solo ayuda cuando una respuesta ya terminó; esta capa cubre la ventana en que
+la request todavía está en curso (ej. el pre-check de volumen y el análisis
+principal, o dos analistas abriendo el mismo experimento).
+
+Configuración (variables de entorno opcionales):
+- AMPLITUDE_MEMORY_CACHE_MB: Presupuesto del caché en memoria en MB (default: 256)
+- AMPLITUDE_MEMORY_CACHE_TTL_S: TTL en segundos de las entradas en memoria (default: 3600)
+- AMPLITUDE_STORE_PATH: Archivo SQLite del store (default: .cache/amplitude_responses.sqlite3)
+- AMPLITUDE_STORE_MAX_MB: Tamaño máximo del store en MB (default: 512)
+- AMPLITUDE_STORE_OPEN_TTL_S: TTL en segundos de ventanas que incluyen hoy (default: 900)
+- PROJECT_TIMEZONE: Zona horaria del proyecto de Amplitude (default: America/Santiago)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from src.utils.deadline import DeadlineExceededError, current_deadline
+
+
+DEFAULT_MEMORY_CACHE_MB = 256
+DEFAULT_MEMORY_CACHE_TTL_S = 3600
+MEMORY_CACHE_SHARDS = 16
+DEFAULT_STORE_PATH = Path(__file__).resolve().parents[2] / '.cache' / 'amplitude_responses.sqlite3'
+DEFAULT_STORE_MAX_MB = 512
+DEFAULT_OPEN_WINDOW_TTL_S = 900
+DEFAULT_PROJECT_TIMEZONE = 'America/Santiago'
+# Al compactar, bajar hasta este porcentaje del presupuesto para no compactar en cada escritura
+COMPACTION_TARGET_RATIO = 0.8
+
+
+def _read_float_env(name: str, default: float) -> float:
+    """
+    Lee una variable de entorno decimal positiva, usando el valor por defecto si no es válida.
+
+    Args:
+        name: Nombre de la variable de entorno
+        default: Valor por defecto
+
+    Returns:
+        float: Valor leído (siempre > 0)
+    """
+    try:
+        value = float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+def measure_response_size(value: Any) -> int:
+    """
+    Mide el tamaño de una respuesta como la longitud de su serialización JSON.
+
+    Args:
+        value: Respuesta JSON de Amplitude
+
+    Returns:
+        int: Tamaño aproximado en bytes
+    """
+    try:
+        return len(json.dumps(value, separators=(',', ':'), default=str))
+    except (TypeError, ValueError):
+        return len(str(value))
+
+
+class _CacheShard:
+    """Partición del caché en memoria: OrderedDict en orden LRU protegido por su propio lock."""
+
+    def __init__(self, max_bytes: int):
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+
+class ResponseMemoryCache:
+    """
+    Caché en memoria de respuestas de Amplitude, acotado y thread-safe.
+
+    Cada entrada guarda (valor, tamaño, expiración, experiment_id). Las claves se
+    reparten en shards para que hilos y sesiones distintas no compitan por un solo
+    lock. Cada shard desaloja por LRU cuando supera su parte del presupuesto.
+    """
+
+    def __init__(self, max_bytes: int = None, ttl: float = None, shards: int = MEMORY_CACHE_SHARDS):
+        """
+        Args:
+            max_bytes: Presupuesto total en bytes (se reparte entre los shards)
+            ttl: Segundos de vida de cada entrada
+            shards: Número de particiones
+        """
+        if max_bytes is None:
+            max_bytes = int(_read_float_env('AMPLITUDE_MEMORY_CACHE_MB', DEFAULT_MEMORY_CACHE_MB) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.ttl = ttl or _read_float_env('AMPLITUDE_MEMORY_CACHE_TTL_S', DEFAULT_MEMORY_CACHE_TTL_S)
+        self._shards = [_CacheShard(max_bytes // shards) for _ in range(shards)]
+
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+    def _shard(self, key: str) -> _CacheShard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Obtiene una respuesta del caché.
+
+        Args:
+            key: Fingerprint de la query (ver amplitude_query.fingerprint_query)
+
+        Returns:
+            Any o None: Respuesta cacheada, o None si no existe o expiró
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None:
+                value, size, expires_at, _ = entry
+                if expires_at > time.monotonic():
+                    shard.entries.move_to_end(key)
+                    hit = True
+                else:
+                    del shard.entries[key]
+                    shard.bytes -= size
+                    hit = False
+                    self._count('expirations')
+            else:
+                hit = False
+        self._count('hits' if hit else 'misses')
+        return value if hit else None
+
+    def put(self, key: str, value: Any, experiment_id: str = None) -> None:
+        """
+        Guarda una respuesta, desalojando las menos usadas si el shard supera su presupuesto.
+
+        Args:
+            key: Fingerprint de la query
+            value: Respuesta JSON de Amplitude
+            experiment_id: Experimento al que pertenece (para invalidación selectiva)
+        """
+        size = measure_response_size(value)
+        shard = self._shard(key)
+        if size > shard.max_bytes:
+            # Una respuesta que no cabe en el shard desalojaría todo sin poder quedarse
+            self._count('rejected')
+            return
+        evicted = 0
+        with shard.lock:
+            previous = shard.entries.pop(key, None)
+            if previous is not None:
+                shard.bytes -= previous[1]
+            shard.entries[key] = (value, size, time.monotonic() + self.ttl, experiment_id)
+            shard.bytes += size
+            while shard.bytes > shard.max_bytes:
+                _, (_, old_size, _, _) = shard.entries.popitem(last=False)
+                shard.bytes -= old_size
+                evicted += 1
+        if evicted:
+            self._count('evictions', evicted)
+
+    def invalidate_experiment(self, experiment_id: str) -> int:
+        """
+        Elimina todas las respuestas de un experimento.
+
+        Args:
+            experiment_id: ID del experimento
+
+        Returns:
+            int: Número de entradas eliminadas
+        """
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                keys = [k for k, entry in shard.entries.items() if entry[3] == experiment_id]
+                for k in keys:
+                    shard.bytes -= shard.entries.pop(k)[1]
+                removed += len(keys)
+        return removed
+
+    def clear(self) -> int:
+        """
+        Elimina todas las respuestas.
+
+        Returns:
+            int: Número de entradas eliminadas
+        """
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                removed += len(shard.entries)
+                shard.entries.clear()
+                shard.bytes = 0
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene las estadísticas del caché en memoria.
+
+        Returns:
+            dict: Entradas, tamaño usado/presupuesto y contadores de hits, misses y desalojos
+        """
+        entries = 0
+        used = 0
+        for shard in self._shards:
+            with shard.lock:
+                entries += len(shard.entries)
+                used += shard.bytes
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'size_mb': round(used / (1024 * 1024), 2),
+                'max_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejected_too_large': self.rejected,
+            }
+
+
+def get_project_timezone() -> ZoneInfo:
+    """
+    Obtiene la zona horaria del proyecto de Amplitude (PROJECT_TIMEZONE).
+
+    Returns:
+        ZoneInfo: Zona horaria configurada (America/Santiago si no es válida)
+    """
+    try:
+        return ZoneInfo(os.getenv('PROJECT_TIMEZONE', DEFAULT_PROJECT_TIMEZONE))
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_PROJECT_TIMEZONE)
+
+
+def is_closed_window(end: str, tz: ZoneInfo = None) -> bool:
+    """
+    Indica si una ventana de fechas terminó antes de hoy en la zona horaria del proyecto.
+
+    Args:
+        end: Fecha fin en formato de Amplitude (YYYYMMDD o YYYYMMDDHHmmss)
+        tz: Zona horaria del proyecto (por defecto, PROJECT_TIMEZONE)
+
+    Returns:
+        bool: True si los datos de la ventana ya no pueden cambiar
+    """
+    try:
+        end_day = datetime.strptime(str(end)[:8], '%Y%m%d').date()
+    except ValueError:
+        return False
+    today = datetime.now(tz or get_project_timezone()).date()
+    return end_day < today
+
+
+class ResponseStore:
+    """
+    Store persistente de respuestas crudas de Amplitude sobre SQLite.
+
+    Cada entrada guarda el JSON comprimido, su tamaño, el último acceso y su
+    expiración (NULL = inmutable). Es seguro para usar desde varios hilos.
+    """
+
+    def __init__(self, path=None, max_bytes: int = None, open_window_ttl: float = None):
+        """
+        Args:
+            path: Ruta del archivo SQLite
+            max_bytes: Tamaño máximo de las respuestas almacenadas (bytes comprimidos)
+            open_window_ttl: TTL en segundos de respuestas cuya ventana incluye hoy
+        """
+        self.path = Path(path or os.getenv('AMPLITUDE_STORE_PATH') or DEFAULT_STORE_PATH)
+        if max_bytes is None:
+            max_bytes = int(_read_float_env('AMPLITUDE_STORE_MAX_MB', DEFAULT_STORE_MAX_MB) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        if open_window_ttl is None:
+            open_window_ttl = _read_float_env('AMPLITUDE_STORE_OPEN_TTL_S', DEFAULT_OPEN_WINDOW_TTL_S)
+        self.open_window_ttl = open_window_ttl
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.compactions = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Se abre bajo demanda; llamar siempre con self._lock tomado
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' value BLOB NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' last_access REAL NOT NULL,'
+                ' expires_at REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)')
+            conn.commit()
+            self._total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Obtiene una respuesta almacenada.
+
+        Args:
+            key: Clave de la query (fingerprint de amplitude_query.fingerprint_query)
+
+        Returns:
+            Any o None: Respuesta JSON deserializada, o None si no existe o expiró
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute('SELECT value, size, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                value, size, expires_at = row
+                if expires_at is not None and expires_at <= now:
+                    conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    conn.commit()
+                    self._total_bytes -= size
+                    self.misses += 1
+                    return None
+                conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+                conn.commit()
+                self.hits += 1
+            return json.loads(zlib.decompress(value))
+        except (sqlite3.Error, OSError, zlib.error, ValueError):
+            # Un store dañado o inaccesible no debe romper la consulta: se trata como miss
+            return None
+
+    def contains(self, key: str) -> bool:
+        """
+        Indica si hay una respuesta vigente para la key, sin leer ni descomprimir el valor.
+
+        Args:
+            key: Clave de la query (fingerprint de amplitude_query.fingerprint_query)
+
+        Returns:
+            bool: True si la entrada existe y no expiró
+        """
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    'SELECT 1 FROM responses WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                    (key, time.time()),
+                ).fetchone()
+            return row is not None
+        except (sqlite3.Error, OSError):
+            return False
+
+    def put(self, key: str, value: Any, end: str) -> None:
+        """
+        Guarda una respuesta. Si la ventana ya cerró, la entrada no expira.
+
+        Args:
+            key: Clave de la query (fingerprint de amplitude_query.fingerprint_query)
+            value: Respuesta JSON de Amplitude
+            end: Fecha fin de la query en formato de Amplitude (define si la ventana cerró)
+        """
+        now = time.time()
+        expires_at = None if is_closed_window(end) else now + self.open_window_ttl
+        blob = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+        try:
+            with self._lock:
+                conn = self._connection()
+                previous = conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, blob, len(blob), now, now, expires_at),
+                )
+                conn.commit()
+                self._total_bytes += len(blob) - (previous[0] if previous else 0)
+                self.writes += 1
+                if self._total_bytes > self.max_bytes:
+                    self._compact_locked()
+        except (sqlite3.Error, OSError):
+            # Si no se puede persistir, la consulta sigue siendo válida (solo se pierde el caché)
+            pass
+
+    def compact(self) -> None:
+        """Elimina entradas expiradas y, si hace falta, las menos usadas hasta volver al presupuesto."""
+        with self._lock:
+            self._compact_locked()
+
+    def _compact_locked(self) -> None:
+        conn = self._connection()
+        deleted = conn.execute(
+            'DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),)
+        ).rowcount
+        self._total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        target = int(self.max_bytes * COMPACTION_TARGET_RATIO)
+        if self._total_bytes > target:
+            # Recorrer de menos a más recientemente usado hasta liberar lo necesario
+            to_free = self._total_bytes - target
+            victims = []
+            for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access ASC'):
+                if to_free <= 0:
+                    break
+                victims.append((key,))
+                to_free -= size
+            conn.executemany('DELETE FROM responses WHERE key = ?', victims)
+            deleted += len(victims)
+            self._total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        conn.commit()
+
+        if deleted:
+            # Devolver el espacio liberado al sistema de archivos
+            conn.execute('VACUUM')
+        self.evictions += deleted
+        self.compactions += 1
+
+    def clear(self) -> None:
+        """Elimina todas las respuestas almacenadas."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('DELETE FROM responses')
+            conn.commit()
+            conn.execute('VACUUM')
+            self._total_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene las estadísticas del store.
+
+        Returns:
+            dict: Entradas (totales e inmutables), tamaño, hits/misses, escrituras y desalojos
+        """
+        with self._lock:
+            conn = self._connection()
+            entries, immutable = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(expires_at IS NULL), 0) FROM responses'
+            ).fetchone()
+            return {
+                'path': str(self.path),
+                'entries': entries,
+                'immutable_entries': immutable,
+                'size_mb': round(self._total_bytes / (1024 * 1024), 2),
+                'max_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'compactions': self.compactions,
+            }
+
+
+class SingleFlight:
+    """
+    Coalesce llamadas concurrentes con la misma clave en una sola ejecución.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Ejecuta fn() una sola vez por clave entre las llamadas concurrentes.
+
+        La primera llamada (líder) ejecuta fn; las que llegan mientras está en vuelo
+        esperan y reciben el mismo resultado (o la misma excepción).
+
+        Args:
+            key: Clave de la query
+            fn: Función sin argumentos que ejecuta la query
+
+        Returns:
+            Any: Resultado de fn
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            # Con deadline activo, no esperar la query del líder más allá del tiempo restante
+            deadline = current_deadline()
+            if deadline is None:
+                return future.result()
+            try:
+                return future.result(timeout=deadline.remaining())
+            except DeadlineExceededError:
+                raise
+            except FutureTimeoutError:
+                # En Python >= 3.11 es el TimeoutError builtin: solo es nuestro si el futuro sigue pendiente
+                if future.done():
+                    raise
+                raise DeadlineExceededError(f"Se superó el límite de {deadline.seconds:.0f}s del análisis")
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene los contadores de la capa single-flight.
+
+        Returns:
+            dict: Queries ejecutadas, llamadas duplicadas ahorradas y queries en vuelo
+        """
+        with self._lock:
+            return {
+                'executed': self.executed,
+                'duplicates_saved': self.coalesced,
+                'in_flight': len(self._in_flight),
+            }
+
+
+# Instancias compartidas por todo el proceso (todas las sesiones de Streamlit)
+_single_flight = SingleFlight()
+_memory_cache = ResponseMemoryCache()
+_response_store = ResponseStore()
+
+
+def get_memory_cache() -> ResponseMemoryCache:
+    """
+    Obtiene el caché en memoria de respuestas compartido por el proceso.
+
+    Returns:
+        ResponseMemoryCache: Caché compartido
+    """
+    return _memory_cache
+
+
+def get_response_store() -> ResponseStore:
+    """
+    Obtiene el store persistente de respuestas compartido por el proceso.
+
+    Returns:
+        ResponseStore: Store compartido
+    """
+    return _response_store
+
+
+def single_flight(key: str, fn: Callable[[], Any]) -> Any:
+    """
+    Ejecuta fn() a través de la capa single-flight compartida.
+
+    Args:
+        key: Clave de la query (fingerprint de amplitude_query.fingerprint_query)
+        fn: Función sin argumentos que ejecuta la query
+
+    Returns:
+        Any: Resultado de fn
+    """
+    return _single_flight.do(key, fn)
+
+
+def get_single_flight_stats() -> Dict[str, Any]:
+    """
+    Obtiene los contadores de la capa single-flight compartida.
+
+    Returns:
+        dict: Queries ejecutadas, llamadas duplicadas ahorradas y queries en vuelo
+    """
+    return _single_flight.get_stats()
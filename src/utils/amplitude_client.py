@@ -0,0 +1,550 @@
+"""
+Cliente HTTP compartido para todas las llamadas a Amplitude.
+
+Centraliza el transporte de las requests a la API de Amplitude (Dashboard REST API
+y Management API de Experiment) en una única sesión de `requests` con pool de
+conexiones keep-alive. Así, las requests por variante, segmento y sub-métrica
+reutilizan conexiones TCP/TLS ya abiertas en lugar de repetir el handshake.
+
+Además, toda request pasa por un gobernador de concurrencia único por proceso
+(AmplitudeRateGovernor) que limita las requests en vuelo y las requests por segundo
+sin importar cuántos ThreadPoolExecutor anidados las originen.
+
+Los fallos transitorios (429, 5xx, conexiones cortadas, timeouts) se reintentan
+dentro del cliente con backoff exponencial con jitter completo, respetando el
+header Retry-After. Los errores permanentes (ej. 400 por payload inválido) se
+devuelven de inmediato. Cada query lógica tiene un presupuesto de reintentos.
+
+Configuración (variables de entorno opcionales):
+- AMPLITUDE_POOL_CONNECTIONS: Número de pools por host que se mantienen (default: 4)
+- AMPLITUDE_POOL_MAXSIZE: Conexiones keep-alive máximas por host (default: 10)
+- AMPLITUDE_MAX_CONCURRENT: Requests simultáneas máximas a Amplitude (default: 5)
+- AMPLITUDE_MAX_RPS: Requests por segundo máximas a Amplitude (default: 5)
+- AMPLITUDE_FANOUT_WORKERS: Workers del planificador de tareas compartido (default: 8)
+- AMPLITUDE_MAX_ATTEMPTS: Intentos máximos por query, incluyendo el primero (default: 4)
+- AMPLITUDE_RETRY_BUDGET_S: Segundos máximos de espera entre reintentos por query (default: 60)
+- AMPLITUDE_CONNECT_TIMEOUT_S: Timeout de conexión de cada request (default: 5)
+- AMPLITUDE_READ_TIMEOUT_S: Timeout de lectura de cada request (default: 60)
+
+Si hay un deadline de análisis activo (src/utils/deadline.py), la espera en el gobernador,
+el read timeout y los reintentos se recortan al tiempo restante y, al vencer, se lanza
+DeadlineExceededError.
+"""
+
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from src.utils.deadline import DeadlineExceededError, current_deadline
+
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+# Límite documentado de Amplitude: 5 queries concurrentes por proyecto
+DEFAULT_MAX_CONCURRENT = 5
+DEFAULT_MAX_RPS = 5
+DEFAULT_FANOUT_WORKERS = 8
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_RETRY_BUDGET_S = 60.0
+RETRY_BASE_DELAY_S = 0.5
+RETRY_MAX_DELAY_S = 20.0
+DEFAULT_CONNECT_TIMEOUT_S = 5.0
+DEFAULT_READ_TIMEOUT_S = 60.0
+
+# Status HTTP que indican un fallo transitorio (rate limit o error del servidor)
+TRANSIENT_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+def _read_int_env(name: str, default: int) -> int:
+    """
+    Lee una variable de entorno entera, usando el valor por defecto si no es válida.
+
+    Args:
+        name: Nombre de la variable de entorno
+        default: Valor por defecto
+
+    Returns:
+        int: Valor leído (siempre >= 1)
+    """
+    try:
+        value = int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value >= 1 else default
+
+
+def _read_float_env(name: str, default: float) -> float:
+    """
+    Lee una variable de entorno decimal positiva, usando el valor por defecto si no es válida.
+
+    Args:
+        name: Nombre de la variable de entorno
+        default: Valor por defecto
+
+    Returns:
+        float: Valor leído (siempre > 0)
+    """
+    try:
+        value = float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+# Workers del planificador de tareas compartido (variantes, segmentos, métricas; ver task_scheduler).
+# Pueden superar el límite de Amplitude: el gobernador es quien limita las requests reales.
+FANOUT_MAX_WORKERS = _read_int_env('AMPLITUDE_FANOUT_WORKERS', DEFAULT_FANOUT_WORKERS)
+# Timeout (connect, read) de las requests que no indican uno propio: una conexión colgada
+# no puede bloquear un hilo del pool indefinidamente
+DEFAULT_TIMEOUT = (
+    _read_float_env('AMPLITUDE_CONNECT_TIMEOUT_S', DEFAULT_CONNECT_TIMEOUT_S),
+    _read_float_env('AMPLITUDE_READ_TIMEOUT_S', DEFAULT_READ_TIMEOUT_S),
+)
+
+
+class AmplitudeRateGovernor:
+    """
+    Gobernador de concurrencia y tasa para todas las requests a Amplitude del proceso.
+
+    Cada request debe ejecutarse dentro de `with governor.acquire():`. El gobernador
+    garantiza como máximo `max_concurrent` requests en vuelo y espacia los inicios
+    para no superar `max_rps` requests por segundo. También expone métricas de cola
+    (profundidad actual/máxima) y de tiempo de espera.
+    """
+
+    def __init__(self, max_concurrent: int = None, max_rps: float = None):
+        """
+        Args:
+            max_concurrent: Requests simultáneas máximas
+            max_rps: Requests por segundo máximas
+        """
+        self.max_concurrent = max_concurrent or _read_int_env(
+            'AMPLITUDE_MAX_CONCURRENT', DEFAULT_MAX_CONCURRENT
+        )
+        self.max_rps = max_rps or _read_float_env('AMPLITUDE_MAX_RPS', DEFAULT_MAX_RPS)
+        self._min_interval = 1.0 / self.max_rps
+
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._next_start = 0.0
+
+        self._acquisitions = 0
+        self._max_queue_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @contextmanager
+    def acquire(self):
+        """
+        Reserva un hueco de concurrencia y un turno de tasa; lo libera al salir del bloque.
+        """
+        requested_at = time.monotonic()
+        deadline = current_deadline()
+        with self._condition:
+            self._waiting += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._waiting)
+            while self._in_flight >= self.max_concurrent:
+                if deadline is not None and deadline.expired():
+                    self._waiting -= 1
+                    deadline.check()
+                self._condition.wait(timeout=deadline.remaining() if deadline is not None else None)
+            self._waiting -= 1
+            self._in_flight += 1
+
+            # Token de tasa: cada request reserva el siguiente turno libre
+            now = time.monotonic()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self._min_interval
+
+        delay = start_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._record_wait(time.monotonic() - requested_at)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def _record_wait(self, waited: float) -> None:
+        with self._condition:
+            self._acquisitions += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene las métricas de cola y espera del gobernador.
+
+        Returns:
+            dict: Límites configurados, requests en vuelo, profundidad de cola y tiempos de espera
+        """
+        with self._condition:
+            acquisitions = self._acquisitions
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_rps': self.max_rps,
+                'in_flight': self._in_flight,
+                'queue_depth': self._waiting,
+                'max_queue_depth': self._max_queue_depth,
+                'acquisitions': acquisitions,
+                'avg_wait_ms': round(self._total_wait / acquisitions * 1000, 2) if acquisitions else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 2),
+                'total_wait_s': round(self._total_wait, 3),
+            }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Interpreta el header Retry-After (segundos o fecha HTTP).
+
+    Args:
+        value: Valor del header
+
+    Returns:
+        float o None: Segundos a esperar, o None si el header no existe o no es válido
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryPolicy:
+    """
+    Política de reintentos para queries a Amplitude.
+
+    Clasifica cada resultado como transitorio o permanente y calcula la espera
+    con backoff exponencial y jitter completo: espera = U(0, min(max_delay, base * 2^intento)).
+    Si el servidor envía Retry-After, se espera al menos ese tiempo.
+    """
+
+    def __init__(self, max_attempts: int = None, budget_seconds: float = None,
+                 base_delay: float = RETRY_BASE_DELAY_S, max_delay: float = RETRY_MAX_DELAY_S):
+        """
+        Args:
+            max_attempts: Intentos máximos por query (incluye el primero)
+            budget_seconds: Tiempo total máximo de espera entre reintentos por query
+            base_delay: Espera base del backoff (segundos)
+            max_delay: Tope de la espera de un reintento (segundos)
+        """
+        self.max_attempts = max_attempts or _read_int_env('AMPLITUDE_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.budget_seconds = budget_seconds or _read_float_env('AMPLITUDE_RETRY_BUDGET_S', DEFAULT_RETRY_BUDGET_S)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def is_transient_response(response: requests.Response) -> bool:
+        """Indica si el status de la respuesta justifica reintentar."""
+        return response.status_code in TRANSIENT_STATUS_CODES
+
+    @staticmethod
+    def is_transient_exception(error: Exception) -> bool:
+        """Indica si la excepción es un fallo de red transitorio (conexión cortada, timeout)."""
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Calcula la espera antes del siguiente intento.
+
+        Args:
+            attempt: Número de reintento (0 para el primero)
+            retry_after: Segundos indicados por el header Retry-After, si existe
+
+        Returns:
+            float: Segundos a esperar
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class ConnectionStats:
+    """
+    Contadores thread-safe de uso del pool de conexiones y de reintentos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.connections_opened = 0
+        self.retries = 0
+        self.retries_by_reason: Dict[str, int] = {}
+        self.retry_budget_exhausted = 0
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests_sent += 1
+
+    def record_retry(self, reason: str) -> None:
+        with self._lock:
+            self.retries += 1
+            self.retries_by_reason[reason] = self.retries_by_reason.get(reason, 0) + 1
+
+    def record_retry_budget_exhausted(self) -> None:
+        with self._lock:
+            self.retry_budget_exhausted += 1
+
+    def record_new_connection(self) -> None:
+        with self._lock:
+            self.connections_opened += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Devuelve una copia de los contadores con las métricas de reutilización derivadas.
+
+        Returns:
+            dict: requests_sent, connections_opened, connections_reused, reuse_ratio y reintentos
+        """
+        with self._lock:
+            sent = self.requests_sent
+            opened = self.connections_opened
+            retries = self.retries
+            retries_by_reason = dict(self.retries_by_reason)
+            exhausted = self.retry_budget_exhausted
+        reused = max(sent - opened, 0)
+        return {
+            'requests_sent': sent,
+            'connections_opened': opened,
+            'connections_reused': reused,
+            'reuse_ratio': round(reused / sent, 4) if sent else 0.0,
+            'retries': retries,
+            'retries_by_reason': retries_by_reason,
+            'retry_budget_exhausted': exhausted,
+        }
+
+
+def _counting_pool_class(base_cls, stats: ConnectionStats):
+    """
+    Crea una subclase del pool de urllib3 que contabiliza cada conexión nueva.
+
+    Args:
+        base_cls: HTTPConnectionPool o HTTPSConnectionPool
+        stats: Contadores donde registrar las conexiones abiertas
+
+    Returns:
+        type: Subclase de base_cls
+    """
+    class CountingConnectionPool(base_cls):
+        def _new_conn(self):
+            stats.record_new_connection()
+            return super()._new_conn()
+
+    return CountingConnectionPool
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter que usa pools instrumentados para medir la reutilización de conexiones.
+    """
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool_class(HTTPConnectionPool, self._stats),
+            'https': _counting_pool_class(HTTPSConnectionPool, self._stats),
+        }
+
+
+def _split_timeout(timeout) -> Tuple[float, float]:
+    """Normaliza el timeout de una request a (connect, read), usando DEFAULT_TIMEOUT si es None."""
+    if timeout is None:
+        return DEFAULT_TIMEOUT
+    if isinstance(timeout, (tuple, list)):
+        return timeout[0], timeout[1]
+    return timeout, timeout
+
+
+class AmplitudeClient:
+    """
+    Cliente HTTP de Amplitude con una sesión compartida y pool de conexiones keep-alive.
+
+    Todas las funciones que consultan Amplitude deben usar este cliente
+    (vía get_amplitude_client()) en lugar de llamar a requests.get directamente.
+    """
+
+    def __init__(self, pool_connections: int = None, pool_maxsize: int = None,
+                 governor: AmplitudeRateGovernor = None, retry_policy: RetryPolicy = None):
+        """
+        Args:
+            pool_connections: Número de pools por host a mantener en caché
+            pool_maxsize: Conexiones keep-alive máximas por host
+            governor: Gobernador de concurrencia (por defecto, el compartido del proceso)
+            retry_policy: Política de reintentos (por defecto, configurada por variables de entorno)
+        """
+        self.pool_connections = pool_connections or _read_int_env(
+            'AMPLITUDE_POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS
+        )
+        self.pool_maxsize = pool_maxsize or _read_int_env(
+            'AMPLITUDE_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE
+        )
+        self.governor = governor or get_amplitude_governor()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.stats = ConnectionStats()
+
+        self.session = requests.Session()
+        adapter = _CountingHTTPAdapter(
+            self.stats,
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url: str, params=None, headers=None, auth=None, timeout=None) -> requests.Response:
+        """
+        Ejecuta un GET reutilizando las conexiones del pool, respetando el gobernador de concurrencia.
+
+        Los fallos transitorios se reintentan según la política de reintentos. La espera
+        entre intentos ocurre fuera del gobernador, para no bloquear cupos de concurrencia.
+        Si se agotan los intentos o el presupuesto, se devuelve la última respuesta
+        (o se relanza la última excepción de red) para que el llamador la reporte.
+
+        Args:
+            url: URL de la API de Amplitude
+            params: Parámetros de query
+            headers: Headers HTTP
+            auth: Autenticación (ej. HTTPBasicAuth)
+            timeout: Timeout de requests (segundos o tupla connect/read; por defecto DEFAULT_TIMEOUT)
+
+        Returns:
+            requests.Response: Respuesta HTTP (sin validar el status code)
+
+        Raises:
+            DeadlineExceededError: Si vence el deadline de análisis activo
+        """
+        policy = self.retry_policy
+        deadline = current_deadline()
+        connect_timeout, read_timeout = _split_timeout(timeout)
+        waited = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            response = None
+            try:
+                with self.governor.acquire():
+                    if deadline is not None:
+                        deadline.check()
+                        read_timeout_now = max(0.001, min(read_timeout, deadline.remaining()))
+                    else:
+                        read_timeout_now = read_timeout
+                    self.stats.record_request()
+                    response = self.session.get(url, params=params, headers=headers, auth=auth,
+                                                timeout=(connect_timeout, read_timeout_now))
+            except requests.exceptions.RequestException as e:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceededError(f"Se superó el límite de {deadline.seconds:.0f}s del análisis") from e
+                if not policy.is_transient_exception(e):
+                    raise
+                error, reason, retry_after = e, type(e).__name__, None
+            else:
+                if not policy.is_transient_response(response):
+                    return response
+                error, reason = None, f'http_{response.status_code}'
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+            delay = policy.backoff(attempt - 1, retry_after)
+            if deadline is not None and delay >= deadline.remaining():
+                # El reintento no alcanzaría a terminar antes del deadline
+                if error is not None:
+                    raise DeadlineExceededError(f"Se superó el límite de {deadline.seconds:.0f}s del análisis") from error
+                return response
+            if attempt >= policy.max_attempts or waited + delay > policy.budget_seconds:
+                self.stats.record_retry_budget_exhausted()
+                if error is not None:
+                    raise error
+                return response
+
+            self.stats.record_retry(reason)
+            waited += delay
+            time.sleep(delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene las estadísticas de reutilización de conexiones, reintentos y la configuración del pool.
+
+        Returns:
+            dict: Estadísticas del cliente
+        """
+        stats = self.stats.snapshot()
+        stats['pool_connections'] = self.pool_connections
+        stats['pool_maxsize'] = self.pool_maxsize
+        stats['governor'] = self.governor.get_stats()
+        return stats
+
+    def close(self) -> None:
+        """Cierra la sesión y libera las conexiones del pool."""
+        self.session.close()
+
+
+_governor: Optional[AmplitudeRateGovernor] = None
+_client: Optional[AmplitudeClient] = None
+_client_lock = threading.Lock()
+_governor_lock = threading.Lock()
+
+
+def get_amplitude_governor() -> AmplitudeRateGovernor:
+    """
+    Obtiene el gobernador de concurrencia compartido por todo el proceso.
+
+    Returns:
+        AmplitudeRateGovernor: Gobernador compartido
+    """
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = AmplitudeRateGovernor()
+    return _governor
+
+
+def get_amplitude_client() -> AmplitudeClient:
+    """
+    Obtiene el cliente de Amplitude compartido por todo el proceso (se crea bajo demanda).
+
+    Returns:
+        AmplitudeClient: Cliente compartido
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = AmplitudeClient()
+    return _client
+
+
+def get_amplitude_client_stats() -> Dict[str, Any]:
+    """
+    Obtiene las estadísticas de reutilización de conexiones del cliente compartido.
+
+    Returns:
+        dict: Estadísticas del cliente (requests, conexiones abiertas/reutilizadas, pool)
+    """
+    return get_amplitude_client().get_stats()
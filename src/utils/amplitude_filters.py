@@ -1,5 +1,10 @@
 # Funciones para obtener los filtros de Amplitude
 
+import json
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Tuple
+
 def get_culture_digital_filter_multiple(country_codes):
     """
     Obtiene un filtro combinado para múltiples códigos de país (OR lógico).
@@ -775,3 +780,308 @@ def get_filters_culture_device_traffic_type():
             for device in devices 
             for traffic_type in traffic_types] 
 
+
+# ==============================================================================
+# COMPILADOR DE FILTROS
+# Arma los filtros de cada evento de una query de funnel (estrategia Global Ghost Anchor)
+# y los serializa a JSON una sola vez por combinación de filtros. Las requests siguientes
+# con la misma combinación (ej. las variantes y segmentos de un desglose) solo hacen una
+# búsqueda en la caché y reutilizan los fragmentos ya serializados.
+# ==============================================================================
+
+# Combinaciones de filtros compiladas que se conservan (LRU)
+FILTER_CACHE_MAX_ENTRIES = 4096
+
+_compiled_filters = OrderedDict()
+_compiled_filters_lock = threading.Lock()
+_compiled_filters_stats = {'hits': 0, 'misses': 0}
+
+
+class CompiledEventPayloads(NamedTuple):
+    """Filtros compilados de una query: compartidos entre requests, no se deben modificar."""
+    payloads: Tuple[str, ...]             # JSON de cada evento, listo para el parámetro `e`
+    events: Tuple[dict, ...]              # {'event_type', 'filters', 'group_by'} de cada evento
+    segmentation_filters: Tuple[dict, ...]  # Filtros globales de Device/Culture/Country
+
+
+def build_event_filters(event_list, event_filters_map, device, culture, country, flow_type, bundle_profile, trip_type, pax_adult_count, travel_group):
+    """
+    Construye los filtros de cada evento de un funnel (estrategia Global Ghost Anchor).
+    
+    Args:
+        event_list: Eventos del funnel (strings o tuplas ('evento', [filtros]))
+        event_filters_map: Filtros técnicos de la métrica {evento: [filtros]}
+        device, culture, country, flow_type, bundle_profile, trip_type, pax_adult_count, travel_group:
+            Filtros globales de la query (string, lista o "ALL")
+        
+    Returns:
+        tuple: (event_filters_grouped, segmentation_filters)
+    """
+    # Construir filtros base de segmentación (GLOBAL GHOST ANCHOR)
+    # ESTRATEGIA GLOBAL GHOST ANCHOR: Todos los filtros globales (Device, Culture, Flow Type, etc.)
+    # se aplican EXCLUSIVAMENTE al primer evento (índice 0). Los eventos siguientes (Steps/Goal)
+    # solo reciben filtros técnicos específicos de la métrica para evitar "ceros" en conversiones.
+    # Esto resuelve el problema sistémico donde revenue_amount y otros eventos finales no tienen
+    # propiedades de segmentación, causando que los filtros fallen y devuelvan 0 conversiones.
+    segmentation_filters = []
+
+    # Manejo de filtros con soporte para listas (multiselect)
+    # Si el valor es una lista, usar funciones _multiple; si es string, usar funciones individuales
+    # Lista vacía o "ALL" significa "sin filtro" (todos los valores)
+
+    # Culture filter
+    if culture:
+        if isinstance(culture, list):
+            if len(culture) > 0:
+                culture_filter = get_culture_digital_filter_multiple(culture)
+                if culture_filter:  # Solo agregar si no está vacío
+                    segmentation_filters.append(culture_filter)
+        else:
+            if str(culture).upper() != "ALL":
+                culture_filter = get_culture_digital_filter(culture)
+                if culture_filter:  # Solo agregar si no está vacío (devuelve dict o "")
+                    segmentation_filters.append(culture_filter)
+
+    # Device filter
+    if device:
+        if isinstance(device, list):
+            if len(device) > 0:
+                device_filter = get_device_type_multiple(device)
+                if device_filter and isinstance(device_filter, dict):  # Solo agregar si es un dict válido
+                    segmentation_filters.append(device_filter)
+        else:
+            if str(device).upper() != "ALL":
+                # Normalizar device a minúsculas porque get_device_type espera 'mobile' o 'desktop'
+                device_normalized = str(device).lower().strip()
+                device_filter = get_device_type(device_normalized)
+                # get_device_type devuelve dict si encuentra, [] si no encuentra
+                if device_filter and isinstance(device_filter, dict):  # Solo agregar si es un dict válido
+                    segmentation_filters.append(device_filter)
+                elif device_filter == []:
+                    # Si devuelve lista vacía, el valor no es reconocido
+                    # Intentar con el valor original por si acaso
+                    device_filter_alt = get_device_type(device)
+                    if device_filter_alt and isinstance(device_filter_alt, dict):
+                        segmentation_filters.append(device_filter_alt)
+
+    # Country filter (propiedad nativa de usuario en Amplitude)
+    if country:
+        country_filter = get_country_filter(country)
+        if country_filter:
+            segmentation_filters.append(country_filter)
+
+    # ============================================================
+    # CONSOLIDACIÓN: Construir lista unificada de filtros globales
+    # ============================================================
+    # NOTA: Estos filtros se aplicarán SOLO al evento 0 (Anchor) como parte
+    # de la estrategia Global Ghost Anchor para evitar "ceros" en conversiones
+
+    # PASO B: Construir filtros contextuales (Flow Type, Bundle Profile, Trip Type, Pax Adult Count)
+    # Verificar primero si la métrica tiene filtros explícitos para evitar duplicados
+    has_explicit_flow_type_filter = False
+    has_explicit_trip_type_filter = False
+    has_explicit_bundle_filter = False
+    has_explicit_pax_filter = False
+
+    # Revisar todos los eventos en event_filters_map para detectar filtros explícitos
+    if event_filters_map:
+        for event_name, filters in event_filters_map.items():
+            if filters:
+                filters_list = filters if isinstance(filters, list) else [filters]
+                for filt in filters_list:
+                    if isinstance(filt, dict):
+                        subprop_key = filt.get('subprop_key')
+                        if subprop_key == 'flow_type':
+                            has_explicit_flow_type_filter = True
+                        elif subprop_key == 'trip_type':
+                            has_explicit_trip_type_filter = True
+                        elif subprop_key == 'bundle_profile' or 'bundle' in str(subprop_key).lower():
+                            has_explicit_bundle_filter = True
+                        elif subprop_key == 'pax_adult_count' or 'pax' in str(subprop_key).lower():
+                            has_explicit_pax_filter = True
+
+    # ============================================================
+    # CONSTRUCCIÓN DE EVENTOS: ESTRATEGIA GLOBAL GHOST ANCHOR
+    # ============================================================
+    # Evento 0 (Anchor): Filtros globales + filtros técnicos de métrica
+    # Eventos > 0 (Steps/Goal): SOLO filtros técnicos de métrica
+    # ============================================================
+    event_filters_grouped = []
+    for idx, event in enumerate(event_list):
+        # PASO A: Iniciar lista de filtros para este evento
+        event_filters = []
+
+        # Extraer el nombre del evento (puede venir como tupla ('evento', [filtros]) o como string)
+        if isinstance(event, tuple) and len(event) > 0:
+            event_name = event[0]
+        elif isinstance(event, str):
+            event_name = event
+        else:
+            event_name = str(event)
+
+        # PASO B: ESTRATEGIA GLOBAL GHOST ANCHOR
+        # ============================================================
+        # REGLA DE NEGOCIO: Aplicar filtros globales SOLO al Evento 0 (Anchor)
+        # ============================================================
+        # - Evento 0 (Anchor): Aplica TODOS los filtros globales (Device, Culture, Flow Type, etc.)
+        #                     + filtros técnicos específicos de la métrica
+        # - Eventos > 0 (Steps/Goal): IGNORA filtros globales, aplica SOLO filtros técnicos
+        #                             de la métrica (definidos en event_filters_map)
+        # ============================================================
+        # Esto resuelve el problema de "ceros" en métricas de conversión donde revenue_amount
+        # y otros eventos finales no tienen propiedades de segmentación.
+        # ============================================================
+        is_anchor_event = (idx == 0)
+        is_strict_anchor = (idx == 0)
+
+        # SOLO el evento 0 (Anchor) recibe filtros globales de segmentación
+        # Los eventos siguientes (Steps/Goal) NO reciben filtros globales para evitar "ceros"
+        if is_strict_anchor:
+            # Device y Culture se aplican SOLO al evento ancla
+            event_filters.extend(segmentation_filters)
+
+        # PASO C: Construir filtros contextuales (Flow Type, Trip Type, Bundle, Travel Group)
+        # Estos filtros ya están configurados para aplicarse solo al evento 0 (is_strict_anchor)
+        # como parte de la estrategia Global Ghost Anchor
+
+        # 1. TRAVEL GROUP: Solo aplicar en el primer paso
+        # "ALL", None y [] significan lo mismo (sin filtro), igual que en la query canónica del caché
+        filters_travel_group = (
+            len(travel_group) > 0 if isinstance(travel_group, list)
+            else bool(travel_group) and str(travel_group).upper() != "ALL"
+        )
+        if filters_travel_group:
+            if is_strict_anchor:
+                if isinstance(travel_group, list):
+                    travel_group_filters = get_travel_group_filter_multiple(travel_group, event_name)
+                else:
+                    travel_group_filters = get_travel_group_filter(travel_group, event_name)
+                if travel_group_filters:
+                    event_filters.extend(travel_group_filters)
+
+        # 2. PAX ADULT COUNT: Solo aplicar en el primer paso (compatibilidad hacia atrás), si no hay travel group
+        elif pax_adult_count and str(pax_adult_count).upper() != "ALL" and not has_explicit_pax_filter:
+            if is_strict_anchor:
+                pax_adult_count_filter = get_pax_adult_count_filter(pax_adult_count)
+                if pax_adult_count_filter:
+                    event_filters.append(pax_adult_count_filter)
+
+        # 3. TRIP TYPE: Solo aplicar en el primer paso
+        if trip_type and not has_explicit_trip_type_filter:
+            if isinstance(trip_type, list):
+                if len(trip_type) > 0 and is_strict_anchor:
+                    trip_type_filter = get_trip_type_filter_multiple(trip_type)
+                    if trip_type_filter:
+                        event_filters.append(trip_type_filter)
+            else:
+                if str(trip_type).upper() != "ALL" and is_strict_anchor:
+                    trip_type_filter = get_trip_type_filter(trip_type)
+                    if trip_type_filter:
+                        event_filters.append(trip_type_filter)
+
+        # 4. FLOW TYPE: Solo aplicar en el primer paso
+        if flow_type and not has_explicit_flow_type_filter:
+            if isinstance(flow_type, list):
+                if len(flow_type) > 0 and is_strict_anchor:
+                    flow_type_filter = get_flow_type_filter_multiple(flow_type)
+                    if flow_type_filter:
+                        event_filters.append(flow_type_filter)
+            else:
+                if str(flow_type).upper() != "ALL" and is_strict_anchor:
+                    flow_type_filter = get_flow_type_filter(flow_type)
+                    if flow_type_filter:
+                        event_filters.append(flow_type_filter)
+
+        # 5. BUNDLE PROFILE: Solo aplicar en el primer paso
+        if bundle_profile and not has_explicit_bundle_filter:
+            if isinstance(bundle_profile, list):
+                if len(bundle_profile) > 0 and is_strict_anchor:
+                    bundle_filters = get_bundle_filters_multiple(bundle_profile)
+                    if bundle_filters:
+                        event_filters.extend(bundle_filters)
+            else:
+                if str(bundle_profile).upper() != "ALL" and is_strict_anchor:
+                    bundle_filters = get_bundle_filters(bundle_profile)
+                    if bundle_filters:
+                        event_filters.extend(bundle_filters)
+
+        # PASO D: Agregar filtros técnicos específicos de la métrica si existen para este evento
+        # Estos filtros se aplican a TODOS los eventos (0 y > 0) como parte de la lógica de negocio
+        # de la métrica. Son filtros técnicos (ej: seats_count > 0) que validan condiciones específicas.
+        if event_filters_map and event_name in event_filters_map:
+            additional_filters = event_filters_map[event_name]
+            if additional_filters:
+                # Si additional_filters es una lista, extender
+                if isinstance(additional_filters, list):
+                    event_filters.extend(additional_filters)
+                else:
+                    # Si es un solo filtro, agregarlo
+                    event_filters.append(additional_filters)
+
+        event_filters_grouped.append({
+            "event_type": event_name,  # Usar el nombre extraído del evento
+            "filters": event_filters,
+            "group_by": []
+        })
+
+
+    return event_filters_grouped, segmentation_filters
+
+
+def _freeze(value):
+    """Convierte listas y dicts anidados en tuplas (clave hasheable de la caché de filtros)."""
+    if isinstance(value, dict):
+        return tuple(sorted((str(key), _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def compile_event_payloads(event_list, event_filters_map, device, culture, country, flow_type, bundle_profile, trip_type, pax_adult_count, travel_group):
+    """
+    Compila (o toma de la caché) los filtros de los eventos de un funnel.
+    
+    Args:
+        Igual que build_event_filters
+        
+    Returns:
+        CompiledEventPayloads: Fragmentos JSON por evento, eventos y filtros de segmentación
+    """
+    key = _freeze((
+        [event[0] if isinstance(event, tuple) and len(event) > 0 else event for event in event_list],
+        event_filters_map or {}, device, culture, country,
+        flow_type, bundle_profile, trip_type, pax_adult_count, travel_group,
+    ))
+    with _compiled_filters_lock:
+        compiled = _compiled_filters.get(key)
+        if compiled is not None:
+            _compiled_filters.move_to_end(key)
+            _compiled_filters_stats['hits'] += 1
+            return compiled
+        _compiled_filters_stats['misses'] += 1
+    
+    event_filters_grouped, segmentation_filters = build_event_filters(
+        event_list, event_filters_map, device, culture, country,
+        flow_type, bundle_profile, trip_type, pax_adult_count, travel_group
+    )
+    compiled = CompiledEventPayloads(
+        payloads=tuple(json.dumps(event) for event in event_filters_grouped),
+        events=tuple(event_filters_grouped),
+        segmentation_filters=tuple(segmentation_filters),
+    )
+    with _compiled_filters_lock:
+        _compiled_filters[key] = compiled
+        while len(_compiled_filters) > FILTER_CACHE_MAX_ENTRIES:
+            _compiled_filters.popitem(last=False)
+    return compiled
+
+
+def get_filter_compiler_stats():
+    """
+    Estadísticas del compilador de filtros.
+    
+    Returns:
+        dict: Combinaciones en caché, aciertos y compilaciones
+    """
+    with _compiled_filters_lock:
+        return {'entries': len(_compiled_filters), **_compiled_filters_stats}
@@ -0,0 +1,216 @@
+"""
+Modelo canónico de queries de funnel a Amplitude.
+
+Dos llamadas que piden lo mismo deben compartir caché aunque lleguen por caminos
+distintos de la UI: cultures en otro orden, "ALL" vs [] vs None, o
+"2024-01-01" vs "2024-01-01 00:00:00". Este módulo normaliza los parámetros de
+get_funnel_data_experiment a una forma canónica y genera un fingerprint estable
+que comparten todas las capas de caché (memoria, store en disco, single-flight
+y st.cache_data).
+"""
+
+import hashlib
+import json
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import pandas as pd
+
+
+# Versión del formato canónico: cambiarla invalida todos los fingerprints previos
+QUERY_MODEL_VERSION = 1
+
+def normalize_date_for_amplitude(date_input, default_time="00:00:00", is_end_date=False):
+    """
+    Normaliza una fecha para enviarla a la API de Amplitude con precisión horaria.
+    
+    Args:
+        date_input: Puede ser:
+            - str en formato ISO (YYYY-MM-DDTHH:mm:ss o YYYY-MM-DD)
+            - datetime object
+            - pd.Timestamp
+            - None
+        default_time: Hora por defecto si solo se proporciona la fecha (formato HH:mm:ss)
+        is_end_date: Si es True y solo hay fecha, usa 23:59:59 en lugar de default_time
+        
+    Returns:
+        str: Fecha formateada como YYYYMMDDHHmmss para la API de Amplitude
+    """
+    if isinstance(date_input, str):
+        # Las fechas en texto se repiten en cada request de un análisis: se parsean una sola vez
+        return _normalize_date_string(date_input, default_time, is_end_date)
+    return _normalize_date(date_input, default_time, is_end_date)
+
+
+@lru_cache(maxsize=1024)
+def _normalize_date_string(date_input, default_time, is_end_date):
+    return _normalize_date(date_input, default_time, is_end_date)
+
+
+def _normalize_date(date_input, default_time, is_end_date):
+    """Implementación de normalize_date_for_amplitude (sin memoización)."""
+    if date_input is None or pd.isna(date_input):
+        return None
+    
+    # Convertir a datetime si es string
+    if isinstance(date_input, str):
+        # Intentar parsear diferentes formatos
+        try:
+            # Formato ISO completo con hora
+            if 'T' in date_input or ' ' in date_input:
+                dt = pd.to_datetime(date_input)
+            else:
+                # Solo fecha, agregar hora
+                date_str = date_input.strip()
+                if is_end_date:
+                    time_str = "23:59:59"
+                else:
+                    time_str = default_time
+                dt = pd.to_datetime(f"{date_str} {time_str}")
+        except Exception:
+            # Fallback: asumir formato YYYY-MM-DD
+            date_str = date_input.strip()
+            if is_end_date:
+                time_str = "23:59:59"
+            else:
+                time_str = default_time
+            dt = pd.to_datetime(f"{date_str} {time_str}")
+    elif isinstance(date_input, (pd.Timestamp, datetime)):
+        dt = pd.to_datetime(date_input)
+        # Si no tiene hora (00:00:00), aplicar la hora por defecto según el tipo
+        if dt.hour == 0 and dt.minute == 0 and dt.second == 0:
+            if is_end_date:
+                dt = dt.replace(hour=23, minute=59, second=59)
+            # Si es start_date y es 00:00:00, mantenerlo así (ya es el default)
+    else:
+        # Intentar convertir con pandas
+        dt = pd.to_datetime(date_input)
+        # Si después de la conversión no tiene hora, aplicar la hora por defecto
+        if dt.hour == 0 and dt.minute == 0 and dt.second == 0:
+            if is_end_date:
+                dt = dt.replace(hour=23, minute=59, second=59)
+    
+    # Formatear como YYYYMMDDHHmmss para la API de Amplitude
+    return dt.strftime('%Y%m%d%H%M%S')
+
+
+def _canonical_date(date_input, is_end_date: bool) -> Optional[str]:
+    """
+    Normaliza una fecha al instante exacto que se envía a Amplitude.
+
+    Se devuelve en formato 'YYYY-MM-DD HH:MM:SS' para que normalize_date_for_amplitude
+    la vuelva a interpretar sin cambios al construir el payload.
+    """
+    formatted = normalize_date_for_amplitude(date_input, default_time="00:00:00", is_end_date=is_end_date)
+    if formatted is None:
+        return None
+    return datetime.strptime(formatted, '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _canonical_multiselect(value, all_in_list_means_all=False):
+    """
+    Normaliza un filtro multiselect para que los valores que arman el mismo payload compartan
+    fingerprint: None si no filtra, str si filtra por un solo valor ("CL" y ["CL"] son la misma
+    query) y lista ordenada sin duplicados si filtra por varios.
+
+    Args:
+        value: Valor del filtro (str, lista o None)
+        all_in_list_means_all: Si "ALL" dentro de una lista anula el filtro (get_device_type_multiple);
+                               si no, los "ALL" de una lista se ignoran como en el resto de los filtros
+    """
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        values = {str(v).strip() for v in value if v is not None and str(v).strip()}
+        if any(v.upper() == 'ALL' for v in values):
+            if all_in_list_means_all:
+                return None
+            values = {v for v in values if v.upper() != 'ALL'}
+        if len(values) == 1:
+            value = values.pop()
+        else:
+            return sorted(values) or None
+    value = str(value).strip()
+    if not value or value.upper() == 'ALL':
+        return None
+    return value
+
+
+def _canonical_country(country):
+    """
+    Normaliza el filtro de país (get_country_filter trata un str como lista de un elemento).
+    """
+    if country is None:
+        return None
+    values = [country] if isinstance(country, str) else list(country)
+    values = sorted({str(c).strip() for c in values if c and str(c).strip() and str(c).strip().upper() != 'ALL'})
+    return values or None
+
+
+def canonicalize_funnel_query(start_date, end_date, experiment_id, device, variant, culture, event_list,
+                              conversion_window=1800, event_filters_map=None, flow_type="ALL",
+                              bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL",
+                              travel_group="ALL", country=None, hidden_first_step=False,
+                              include_time_data=False) -> Dict[str, Any]:
+    """
+    Construye la forma canónica de una query de funnel.
+
+    Recibe los mismos parámetros que get_funnel_data_experiment y devuelve un dict con
+    esas mismas claves, listo para volver a pasarse como kwargs: el payload enviado a
+    Amplitude es idéntico al de los parámetros originales.
+
+    Args:
+        start_date, end_date, experiment_id, device, variant, culture, event_list,
+        conversion_window, event_filters_map, flow_type, bundle_profile, trip_type,
+        pax_adult_count, travel_group, country, hidden_first_step, include_time_data:
+            mismos que get_funnel_data_experiment
+
+    Returns:
+        dict: Parámetros canónicos
+    """
+    query = {
+        'start_date': _canonical_date(start_date, is_end_date=False),
+        'end_date': _canonical_date(end_date, is_end_date=True),
+        'experiment_id': str(experiment_id),
+        'variant': variant,
+        # El orden de los eventos define el funnel, así que se conserva tal cual
+        'event_list': list(event_list),
+        'conversion_window': int(conversion_window),
+        'event_filters_map': {k: event_filters_map[k] for k in sorted(event_filters_map)} if event_filters_map else None,
+        'pax_adult_count': _canonical_multiselect(pax_adult_count),
+        'country': _canonical_country(country),
+        'hidden_first_step': bool(hidden_first_step),
+        'include_time_data': bool(include_time_data),
+    }
+    # Filtros multiselect: aceptan str o lista y "ALL"/[]/None significan "sin filtro"
+    query['device'] = _canonical_multiselect(device, all_in_list_means_all=True)
+    for name, value in (('culture', culture), ('flow_type', flow_type),
+                        ('bundle_profile', bundle_profile), ('trip_type', trip_type),
+                        ('travel_group', travel_group)):
+        query[name] = _canonical_multiselect(value)
+    return query
+
+
+def fingerprint_query(query: Dict[str, Any], scope: str = '') -> str:
+    """
+    Genera el fingerprint estable de una query canónica.
+
+    Args:
+        query: Query canónica (ver canonicalize_funnel_query)
+        scope: Identificador del proyecto/credencial (ej. api_key), para no mezclar proyectos
+
+    Returns:
+        str: Hash SHA-256 hexadecimal
+    """
+    payload = json.dumps(
+        {
+            'version': QUERY_MODEL_VERSION,
+            'scope': hashlib.sha256(str(scope).encode('utf-8')).hexdigest(),
+            'query': query,
+        },
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,381 @@
+"""
+Caché de resultados del pipeline (DataFrames) en tablas Arrow inmutables.
+
+final_pipeline y final_pipeline_cumulative guardan su DataFrame como archivo IPC de
+Arrow (sin compresión) en disco, una sola vez. Al abrir un resultado, el archivo se mapea
+en memoria (mmap) y el DataFrame se arma una vez por tabla abierta: las columnas numéricas
+y de fechas quedan como vistas sobre el archivo mapeado; las de texto y listas se
+materializan como objetos de Python en ese momento, y las fechas vuelven a su resolución
+original (ej. datetime64[ns]). Las tablas abiertas y su DataFrame se reutilizan entre
+llamadas (LRU), así que un acierto solo hace una copia superficial del DataFrame ya armado,
+a diferencia de st.cache_data, que hace unpickle de una copia completa en cada lectura.
+
+Los DataFrames devueltos comparten sus datos con el caché: las columnas numéricas son de
+solo lectura (modificarlas en el lugar falla con "assignment destination is read-only") y
+ningún valor se debe modificar en el lugar; filtrar o agregar columnas crea un DataFrame
+nuevo, y para modificar valores hay que copiar (df.copy()).
+
+Vigencia: igual que en el store de respuestas (amplitude_cache), los resultados de ventanas
+que terminaron antes de hoy duran AMPLITUDE_PIPELINE_CACHE_TTL_S y los de ventanas que
+incluyen hoy solo AMPLITUDE_STORE_OPEN_TTL_S (los datos de hoy todavía cambian).
+
+Cada escritura crea un archivo nuevo ({key}.{versión}.arrow) en lugar de reemplazar uno
+existente, y las versiones viejas se borran cuando se puede: en Windows un archivo mapeado
+(por una tabla abierta o un DataFrame que la sesión todavía usa) no se puede borrar ni
+reemplazar, así que esos archivos quedan pendientes y se reintenta borrarlos más tarde.
+
+La clave de cada resultado es el fingerprint de los argumentos de la función; igual que
+en st.cache_data, los parámetros con prefijo "_" (ej. _deadline) no forman parte de la clave.
+Los DataFrames que Arrow no puede representar (columnas object con tipos mezclados) no
+se cachean y se devuelven tal cual.
+
+Configuración (variables de entorno opcionales):
+- AMPLITUDE_PIPELINE_CACHE_DIR: Carpeta de los archivos IPC (default: .cache/pipeline_arrow)
+- AMPLITUDE_PIPELINE_CACHE_TTL_S: Segundos de validez de los resultados de ventanas cerradas (default: 86400)
+- AMPLITUDE_STORE_OPEN_TTL_S: Segundos de validez de los resultados de ventanas que incluyen hoy (default: 900)
+- AMPLITUDE_PIPELINE_CACHE_MAX_MB: Tamaño máximo de la carpeta en MB (default: 1024)
+"""
+
+import functools
+import inspect
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+
+from src.utils.amplitude_cache import DEFAULT_OPEN_WINDOW_TTL_S, is_closed_window, single_flight
+from src.utils.amplitude_query import fingerprint_query, normalize_date_for_amplitude
+
+
+DEFAULT_PIPELINE_CACHE_DIR = Path(__file__).resolve().parents[2] / '.cache' / 'pipeline_arrow'
+DEFAULT_PIPELINE_CACHE_TTL_S = 86400
+DEFAULT_PIPELINE_CACHE_MAX_MB = 1024
+# Tablas mapeadas que se mantienen abiertas (cada una retiene un descriptor de archivo)
+MAX_OPEN_TABLES = 256
+# Al compactar, bajar hasta este porcentaje del presupuesto para no compactar en cada escritura
+COMPACTION_TARGET_RATIO = 0.8
+# Metadata del schema con el instante de expiración (epoch) del resultado
+EXPIRES_AT_METADATA_KEY = b'abtest_expires_at'
+
+
+def _read_float_env(name: str, default: float) -> float:
+    try:
+        value = float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+def _table_to_frame(table: pa.Table) -> pd.DataFrame:
+    """
+    DataFrame sobre los buffers de la tabla (split_blocks: una columna por bloque, sin
+    consolidar; las columnas numéricas no se copian). Las columnas de listas se devuelven
+    como listas de Python y las fechas con la resolución que tenían al guardarse.
+    """
+    frame = table.to_pandas(split_blocks=True)
+    for field in table.schema:
+        if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+            frame[field.name] = pd.Series(table.column(field.name).to_pylist(), index=frame.index, dtype=object)
+    for column in (table.schema.pandas_metadata or {}).get('columns', []):
+        name, numpy_type = column.get('name'), str(column.get('numpy_type', ''))
+        if (column.get('pandas_type') == 'datetime' and numpy_type.startswith('datetime64')
+                and name in frame.columns and str(frame[name].dtype) != numpy_type):
+            frame[name] = frame[name].astype(numpy_type)
+    return frame
+
+
+class ArrowResultCache:
+    """
+    Resultados del pipeline como archivos IPC de Arrow, leídos con mmap y compartidos sin copias.
+    """
+
+    def __init__(self, directory=None, ttl: float = None, max_bytes: int = None):
+        """
+        Args:
+            directory: Carpeta de los archivos (default: AMPLITUDE_PIPELINE_CACHE_DIR)
+            ttl: Segundos de validez de cada resultado (default: AMPLITUDE_PIPELINE_CACHE_TTL_S)
+            max_bytes: Tamaño máximo de la carpeta (default: AMPLITUDE_PIPELINE_CACHE_MAX_MB)
+        """
+        self.directory = Path(directory or os.getenv('AMPLITUDE_PIPELINE_CACHE_DIR') or DEFAULT_PIPELINE_CACHE_DIR)
+        self.ttl = ttl if ttl is not None else _read_float_env('AMPLITUDE_PIPELINE_CACHE_TTL_S', DEFAULT_PIPELINE_CACHE_TTL_S)
+        self.max_bytes = max_bytes or int(
+            _read_float_env('AMPLITUDE_PIPELINE_CACHE_MAX_MB', DEFAULT_PIPELINE_CACHE_MAX_MB) * 1024 * 1024
+        )
+        self.open_window_ttl = _read_float_env('AMPLITUDE_STORE_OPEN_TTL_S', DEFAULT_OPEN_WINDOW_TTL_S)
+        self._lock = threading.Lock()
+        # key -> (tabla mapeada, DataFrame armado sobre la tabla, instante de expiración)
+        self._tables: 'OrderedDict[str, Tuple[pa.Table, pd.DataFrame, float]]' = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.unsupported = 0
+        self.write_errors = 0
+        self.evictions = 0
+        # Archivos que no se pudieron borrar (mapeados en Windows); se reintenta al escribir o limpiar
+        self._pending_deletes = set()
+
+    def _new_path(self, key: str) -> Path:
+        return self.directory / f"{key}.{time.time_ns():016x}{uuid.uuid4().hex[:8]}.arrow"
+
+    def _versions(self, key: str) -> List[Path]:
+        """Archivos vigentes de la key (sin los pendientes de borrar), del más antiguo al más nuevo."""
+        try:
+            paths = sorted(self.directory.glob(f"{key}.*.arrow"))
+        except OSError:
+            return []
+        with self._lock:
+            return [path for path in paths if path not in self._pending_deletes]
+
+    def _discard(self, path: Path) -> bool:
+        """Borra un archivo; si está en uso (mapeado en Windows) queda pendiente. True si se borró."""
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            with self._lock:
+                self._pending_deletes.add(path)
+            return False
+        with self._lock:
+            self._pending_deletes.discard(path)
+        return True
+
+    def _retry_deletes(self) -> None:
+        with self._lock:
+            pending = list(self._pending_deletes)
+        for path in pending:
+            self._discard(path)
+
+    def _open(self, key: str) -> Optional[Tuple[pa.Table, pd.DataFrame, float]]:
+        """Mapea la versión más nueva de la key si existe y no expiró (None en caso contrario)."""
+        versions = self._versions(key)
+        if not versions:
+            return None
+        path = versions[-1]
+        for old_path in versions[:-1]:
+            self._discard(old_path)
+        try:
+            with pa.memory_map(str(path), 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+            metadata = table.schema.metadata or {}
+            if EXPIRES_AT_METADATA_KEY in metadata:
+                expires_at = float(metadata[EXPIRES_AT_METADATA_KEY])
+            else:
+                expires_at = path.stat().st_mtime + self.ttl
+        except (OSError, ValueError, pa.ArrowException):
+            return None
+        if expires_at <= time.time():
+            del table
+            self._discard(path)
+            return None
+        return table, _table_to_frame(table), expires_at
+
+    def _remember(self, key: str, table: pa.Table, frame: pd.DataFrame, expires_at: float) -> None:
+        self._tables[key] = (table, frame, expires_at)
+        self._tables.move_to_end(key)
+        while len(self._tables) > MAX_OPEN_TABLES:
+            self._tables.popitem(last=False)
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        """
+        Obtiene un resultado cacheado.
+
+        Args:
+            key: Fingerprint del resultado
+
+        Returns:
+            pd.DataFrame | None: Vista de solo lectura sobre la tabla, o None si no existe o expiró
+        """
+        with self._lock:
+            entry = self._tables.get(key)
+            if entry is not None and entry[2] <= time.time():
+                del self._tables[key]
+                entry = None
+            if entry is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            entry = self._open(key)
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                    return None
+                self._remember(key, *entry)
+                self.disk_hits += 1
+        return entry[1].copy(deep=False)
+
+    def put(self, key: str, frame: pd.DataFrame, ttl: float = None) -> pd.DataFrame:
+        """
+        Guarda un resultado y lo devuelve ya respaldado por el archivo mapeado.
+
+        Args:
+            key: Fingerprint del resultado
+            frame: DataFrame a guardar
+            ttl: Opcional. Segundos de validez (default: self.ttl)
+
+        Returns:
+            pd.DataFrame: Vista de solo lectura sobre la tabla guardada, o el mismo frame si
+                          Arrow no puede representarlo
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        try:
+            table = pa.Table.from_pandas(frame)
+        except (pa.ArrowException, TypeError, ValueError):
+            with self._lock:
+                self.unsupported += 1
+            return frame
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), EXPIRES_AT_METADATA_KEY: repr(expires_at).encode()}
+        )
+
+        path = self._new_path(key)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with pa.OSFile(str(tmp_path), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            # Nombre nuevo: nunca se reemplaza un archivo que otro lector pueda tener mapeado
+            os.rename(tmp_path, path)
+        except (OSError, pa.ArrowException):
+            self._discard(tmp_path)
+            with self._lock:
+                self.write_errors += 1
+            return _table_to_frame(table)
+
+        entry = self._open(key) or (table, _table_to_frame(table), expires_at)
+        with self._lock:
+            self._remember(key, *entry)
+            self.writes += 1
+        self._compact()
+        return entry[1].copy(deep=False)
+
+    def _compact(self) -> None:
+        """Borra los archivos más antiguos si la carpeta supera el presupuesto."""
+        self._retry_deletes()
+        try:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, Path(entry.path))
+                     for entry in os.scandir(self.directory) if entry.name.endswith('.arrow')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * COMPACTION_TARGET_RATIO
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            with self._lock:
+                self._tables.pop(path.name.split('.', 1)[0], None)
+            if not self._discard(path):
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Borra todos los resultados (memoria y disco). Los archivos que siguen mapeados (Windows)
+        quedan pendientes de borrar y ya no se vuelven a leer.
+        """
+        with self._lock:
+            self._tables.clear()
+        try:
+            paths = list(self.directory.glob('*.arrow')) + list(self.directory.glob('*.tmp'))
+        except OSError:
+            paths = []
+        for path in paths:
+            self._discard(path)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene los contadores del caché.
+
+        Returns:
+            dict: Tablas abiertas, tamaño en disco, aciertos (memoria / disco), fallos y escrituras
+        """
+        try:
+            disk_bytes = sum(path.stat().st_size for path in self.directory.glob('*.arrow'))
+        except OSError:
+            disk_bytes = 0
+        with self._lock:
+            return {
+                'open_tables': len(self._tables),
+                'disk_mb': round(disk_bytes / (1024 * 1024), 2),
+                'max_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'unsupported': self.unsupported,
+                'write_errors': self.write_errors,
+                'evictions': self.evictions,
+                'pending_deletes': len(self._pending_deletes),
+            }
+
+
+_arrow_cache: Optional[ArrowResultCache] = None
+_arrow_cache_lock = threading.Lock()
+
+
+def get_arrow_result_cache() -> ArrowResultCache:
+    """
+    Obtiene el caché Arrow compartido del proceso (se crea en el primer uso).
+
+    Returns:
+        ArrowResultCache: Caché compartido
+    """
+    global _arrow_cache
+    if _arrow_cache is None:
+        with _arrow_cache_lock:
+            if _arrow_cache is None:
+                _arrow_cache = ArrowResultCache()
+    return _arrow_cache
+
+
+def _result_ttl(cache: ArrowResultCache, end_date: Any) -> float:
+    """TTL de un resultado: corto si la ventana incluye hoy (mismo criterio que el store de respuestas)."""
+    if end_date is None:
+        return cache.ttl
+    try:
+        end = normalize_date_for_amplitude(end_date, is_end_date=True)
+    except (TypeError, ValueError):
+        return min(cache.ttl, cache.open_window_ttl)
+    return cache.ttl if is_closed_window(end) else min(cache.ttl, cache.open_window_ttl)
+
+
+def arrow_cached(fn: Callable[..., pd.DataFrame]) -> Callable[..., pd.DataFrame]:
+    """
+    Decorador que cachea el DataFrame de fn en el caché Arrow (reemplazo de st.cache_data).
+
+    Las llamadas idénticas en vuelo se comparten (single_flight) y las excepciones no se cachean.
+
+    Args:
+        fn: Función que devuelve un pd.DataFrame (si recibe end_date, la vigencia sigue la
+            regla de ventanas abiertas/cerradas)
+
+    Returns:
+        Callable: Función envuelta; devuelve DataFrames de solo lectura
+    """
+    signature = inspect.signature(fn)
+    scope = f"{fn.__module__}.{fn.__qualname__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key_params = {name: value for name, value in bound.arguments.items() if not name.startswith('_')}
+        key = fingerprint_query(key_params, scope=scope)
+        cache = get_arrow_result_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        ttl = _result_ttl(cache, key_params.get('end_date'))
+        return single_flight(f"arrow:{key}", lambda: cache.put(key, fn(*args, **kwargs), ttl=ttl))
+
+    return wrapper
@@ -0,0 +1,269 @@
+"""
+Métricas compuestas: una métrica cuyo resultado es la combinación (OR) de varias sub-métricas.
+
+Una métrica compuesta se declara en su archivo de métricas con sus 'events' de siempre
+(los stages que muestra la UI) y la clave 'composite':
+
+    EXTRAS_GENERAL_CR = {
+        'events': [('extras_dom_loaded', []), ('extra_selected', [...]), ('revenue_amount', [])],
+        'composite': {
+            'combine': 'or',
+            'sub_metrics': [
+                {'name': 'flexi', 'events': [('extras_dom_loaded', []), ('revenue_amount', [filtro])]},
+                {'name': 'pet', 'events': [...]},
+            ],
+        },
+    }
+
+Cuando _fetch_funnel_data recibe una query cuyos eventos y filtros coinciden con los de
+una métrica compuesta, en lugar de pedir ese funnel pide las sub-métricas en paralelo en
+el planificador compartido (el gobernador de amplitude_client sigue limitando las
+requests reales), alinea sus series por fecha con un índice hash y las combina con NumPy.
+Una compuesta nueva (ej. "compró cualquier ancillary") solo requiere declararla.
+
+Reglas de combinación ('combine'), aplicadas por paso a dayFunnels.series y cumulativeRaw:
+- 'or': paso 0 = máximo (las sub-métricas comparten el ancla, es el mismo denominador);
+  el resto de los pasos = suma (las sub-métricas se asumen disjuntas).
+- 'sum': todos los pasos se suman.
+
+La firma (eventos + filtros) de una compuesta no puede coincidir con la de otra métrica
+simple: esas firmas ambiguas se ignoran con un aviso y la query se resuelve como funnel normal.
+"""
+
+import json
+import threading
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from src.utils.deadline import DeadlineExceededError
+from src.utils.metrics_loader import get_compiled_metrics
+from src.utils.task_scheduler import get_task_scheduler
+
+
+def _combine_or(stacked: np.ndarray) -> np.ndarray:
+    combined = stacked.sum(axis=0)
+    combined[..., 0] = stacked[..., 0].max(axis=0)
+    return combined
+
+
+def _combine_sum(stacked: np.ndarray) -> np.ndarray:
+    return stacked.sum(axis=0)
+
+
+# Regla -> función que reduce el eje 0 (sub-métricas) de un arreglo [..., paso]
+COMBINE_RULES: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    'or': _combine_or,
+    'sum': _combine_sum,
+}
+
+_index_lock = threading.Lock()
+_indexed_from: Optional[Mapping[str, Any]] = None
+_index: Dict[Tuple, Mapping[str, Any]] = {}
+_stats = {'composite_queries': 0, 'sub_queries': 0, 'sub_query_errors': 0, 'ambiguous_signatures': 0}
+
+
+def _event_name(event: Any) -> str:
+    if isinstance(event, tuple) and len(event) > 0:
+        return event[0]
+    return event if isinstance(event, str) else str(event)
+
+
+def _signature(event_list: List[Any], event_filters_map: Optional[Mapping[str, Any]]) -> Tuple:
+    """Firma (evento, filtros en JSON canónico) de cada paso de una query, en orden."""
+    steps = []
+    for event in event_list or []:
+        name = _event_name(event)
+        filters = (event_filters_map or {}).get(name)
+        if filters is None and isinstance(event, tuple) and len(event) > 1:
+            filters = event[1]
+        filters_list = list(filters) if isinstance(filters, (list, tuple)) else [filters] if filters else []
+        steps.append((name, json.dumps(filters_list, sort_keys=True, default=str) if filters_list else ''))
+    return tuple(steps)
+
+
+def _composite_key(composite: Mapping[str, Any]) -> str:
+    """Representación comparable de la declaración 'composite' compilada."""
+    return json.dumps(
+        [composite['combine'], [[sub['name'], sub['events']] for sub in composite['sub_metrics']]],
+        sort_keys=True, default=str,
+    )
+
+
+def _get_index() -> Dict[Tuple, Mapping[str, Any]]:
+    """Índice firma -> declaración compuesta, reconstruido solo cuando cambian las métricas compiladas."""
+    global _indexed_from, _index
+    compiled = get_compiled_metrics()
+    with _index_lock:
+        if compiled is _indexed_from:
+            return _index
+        by_signature: Dict[Tuple, List[Mapping[str, Any]]] = {}
+        for metric in compiled.values():
+            signature = _signature(list(metric['event_names']), metric['filters'])
+            by_signature.setdefault(signature, []).append(metric)
+        index, ambiguous = {}, 0
+        for signature, metrics in by_signature.items():
+            composites = [metric for metric in metrics if metric.get('composite')]
+            if not composites:
+                continue
+            names = ', '.join(metric['name'] for metric in metrics)
+            if len(composites) != len(metrics) or len({_composite_key(m['composite']) for m in composites}) > 1:
+                print(f"⚠️ Métricas compuestas ignoradas: {names} comparten eventos y filtros con otra definición")
+                ambiguous += 1
+                continue
+            composite = composites[0]['composite']
+            if composite['combine'] not in COMBINE_RULES or not composite['sub_metrics']:
+                print(f"⚠️ Métrica compuesta ignorada: {names} (regla '{composite['combine']}' o sin sub-métricas)")
+                ambiguous += 1
+                continue
+            index[signature] = composite
+        _index, _indexed_from = index, compiled
+        _stats['ambiguous_signatures'] = ambiguous
+        return _index
+
+
+def get_composite(event_list: List[Any], event_filters_map: Optional[Mapping[str, Any]] = None) -> Optional[Mapping[str, Any]]:
+    """
+    Busca la métrica compuesta declarada con exactamente estos eventos y filtros.
+
+    Args:
+        event_list: Eventos de la query (strings o tuplas (evento, filtros))
+        event_filters_map: Filtros por evento de la query
+
+    Returns:
+        Mapping | None: {'combine', 'sub_metrics'} compilado, o None si la query es un funnel simple
+    """
+    if not event_list or len(event_list) < 2:
+        return None
+    return _get_index().get(_signature(event_list, event_filters_map))
+
+
+def sub_metric_query(sub_metric: Mapping[str, Any]) -> Tuple[List[str], Dict[str, List[Any]]]:
+    """
+    Eventos y mapa de filtros de una sub-métrica (formato de get_funnel_data_experiment).
+
+    Args:
+        sub_metric: Sub-métrica compilada {'name', 'events'}
+
+    Returns:
+        tuple: (lista de eventos, {evento: filtros} solo eventos con filtros)
+    """
+    event_list = [event_name for event_name, _ in sub_metric['events']]
+    event_filters_map = {event_name: list(filters) for event_name, filters in sub_metric['events'] if filters}
+    return event_list, event_filters_map
+
+
+def _website(response: Any) -> Optional[Dict[str, Any]]:
+    data = response.get('data') if isinstance(response, dict) else None
+    website = data[0] if isinstance(data, list) and data else data
+    return website if isinstance(website, dict) else None
+
+
+def combine_funnel_responses(responses: List[Dict[str, Any]], combine: str = 'or') -> Dict[str, Any]:
+    """
+    Combina las respuestas de funnel de las sub-métricas en una sola respuesta.
+
+    Las series diarias se alinean por fecha (unión de los xValues de todas las respuestas)
+    y cada paso se combina con la regla indicada. Las respuestas no se modifican.
+
+    Args:
+        responses: Respuestas JSON de Amplitude de cada sub-métrica (en orden)
+        combine: Regla de COMBINE_RULES
+
+    Returns:
+        dict: Respuesta con la estructura de la primera sub-métrica y los conteos combinados
+
+    Raises:
+        ValueError: Si la regla no existe o ninguna respuesta trae datos de funnel
+    """
+    if combine not in COMBINE_RULES:
+        raise ValueError(f"Regla de combinación desconocida: {combine}")
+    websites = [website for website in map(_website, responses) if website is not None]
+    if not websites:
+        raise ValueError("Ninguna sub-métrica devolvió datos de funnel para combinar")
+    base = websites[0]
+    n_steps = len(base.get('events', []))
+    dates = sorted({day for website in websites for day in website.get('dayFunnels', {}).get('xValues', [])})
+    date_index = {day: idx for idx, day in enumerate(dates)}
+
+    daily = np.zeros((len(websites), len(dates), n_steps), dtype=np.int64)
+    cumulative = np.zeros((len(websites), n_steps), dtype=np.int64)
+    for position, website in enumerate(websites):
+        day_funnels = website.get('dayFunnels', {})
+        x_values = day_funnels.get('xValues', [])
+        series = day_funnels.get('series', [])[:len(x_values)]
+        if series:
+            rows = [date_index[day] for day in x_values[:len(series)]]
+            daily[position, rows] = [(list(row) + [0] * n_steps)[:n_steps] for row in series]
+        raw = list(website.get('cumulativeRaw', []))[:n_steps]
+        cumulative[position, :len(raw)] = raw
+
+    rule = COMBINE_RULES[combine]
+    combined_website = {
+        **base,
+        'dayFunnels': {**base.get('dayFunnels', {}), 'xValues': dates, 'series': rule(daily).tolist()},
+        'cumulativeRaw': rule(cumulative).tolist(),
+    }
+    first = next(response for response in responses if _website(response) is base)
+    return {**first, 'data': [combined_website]}
+
+
+def fetch_composite(
+    composite: Mapping[str, Any],
+    fetch_sub_metric: Callable[[List[str], Dict[str, List[Any]]], Dict[str, Any]],
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Pide las sub-métricas en paralelo en el planificador compartido y combina sus respuestas.
+
+    Args:
+        composite: Declaración compilada (ver get_composite)
+        fetch_sub_metric: fetch_sub_metric(event_list, event_filters_map) -> respuesta JSON
+
+    Returns:
+        tuple: (respuesta combinada, True si todas las sub-métricas respondieron). Una
+               sub-métrica que falla se omite de la combinación con un aviso.
+
+    Raises:
+        DeadlineExceededError: Si vence el deadline del análisis (se cancelan las pendientes)
+        ValueError: Si ninguna sub-métrica respondió
+    """
+    sub_metrics = composite['sub_metrics']
+    scheduler = get_task_scheduler()
+    futures = {
+        scheduler.submit(fetch_sub_metric, *sub_metric_query(sub_metric)): position
+        for position, sub_metric in enumerate(sub_metrics)
+    }
+    responses: List[Optional[Dict[str, Any]]] = [None] * len(sub_metrics)
+    errors = []
+    for future in scheduler.as_completed(futures):
+        position = futures[future]
+        try:
+            responses[position] = future.result()
+        except DeadlineExceededError:
+            # Sin deadline no hay resultado compuesto válido: no combinar una suma incompleta
+            for pending_future in futures:
+                scheduler.cancel(pending_future)
+            raise
+        except Exception as e:
+            print(f"⚠️ Error obteniendo sub-métrica {sub_metrics[position]['name']}: {e}")
+            errors.append(str(e))
+    with _index_lock:
+        _stats['composite_queries'] += 1
+        _stats['sub_queries'] += len(sub_metrics)
+        _stats['sub_query_errors'] += len(errors)
+    succeeded = [response for response in responses if response is not None]
+    if not succeeded:
+        raise ValueError(f"Ninguna sub-métrica de la métrica compuesta respondió: {errors[0] if errors else ''}")
+    return combine_funnel_responses(succeeded, composite['combine']), not errors
+
+
+def get_composite_stats() -> Dict[str, Any]:
+    """
+    Estadísticas del motor de métricas compuestas.
+
+    Returns:
+        dict: Compuestas indexadas, queries combinadas, sub-queries y errores
+    """
+    index = _get_index()
+    with _index_lock:
+        return {'composites': len(index), **_stats}
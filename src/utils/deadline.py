@@ -0,0 +1,132 @@
+"""
+Deadline de análisis compartido por todas las requests a Amplitude.
+
+Un análisis (corrida principal o desglose por segmento) crea un Deadline y lo activa
+con deadline_scope(); el valor vive en un ContextVar, así que lo ven todas las
+funciones llamadas dentro del scope sin agregar parámetros a las capas cacheadas.
+Los pools que reparten trabajo lo propagan a sus hilos con bind_deadline().
+
+AmplitudeClient recorta el read timeout de cada request al tiempo restante y no
+reintenta más allá del deadline; la capa single-flight no espera una query en
+vuelo más allá del deadline. Al vencer se lanza DeadlineExceededError, que los
+pipelines dejan pasar (no se convierte en error de API ni se cachea) para que la
+UI muestre lo que sí terminó como resultado parcial.
+
+Configuración (variables de entorno opcionales):
+- AMPLITUDE_ANALYSIS_DEADLINE_S: Segundos máximos de un análisis (default: 300)
+"""
+
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+
+DEFAULT_ANALYSIS_DEADLINE_S = 300
+
+_current_deadline: contextvars.ContextVar = contextvars.ContextVar('amplitude_deadline', default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    """Se alcanzó el deadline del análisis antes de terminar la query."""
+
+
+class Deadline:
+    """
+    Instante límite (reloj monotónico) de un análisis.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_env(cls) -> 'Deadline':
+        """
+        Crea un deadline con la duración de AMPLITUDE_ANALYSIS_DEADLINE_S.
+
+        Returns:
+            Deadline: Deadline que vence dentro de esa cantidad de segundos
+        """
+        try:
+            seconds = float(os.getenv('AMPLITUDE_ANALYSIS_DEADLINE_S', DEFAULT_ANALYSIS_DEADLINE_S))
+        except (TypeError, ValueError):
+            seconds = DEFAULT_ANALYSIS_DEADLINE_S
+        return cls(seconds if seconds > 0 else DEFAULT_ANALYSIS_DEADLINE_S)
+
+    def remaining(self) -> float:
+        """Segundos que quedan (0 si ya venció)."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self) -> None:
+        """
+        Raises:
+            DeadlineExceededError: Si el deadline ya venció
+        """
+        if self.expired():
+            raise DeadlineExceededError(f"Se superó el límite de {self.seconds:.0f}s del análisis")
+
+
+def current_deadline() -> Optional[Deadline]:
+    """
+    Obtiene el deadline activo en el contexto actual.
+
+    Returns:
+        Deadline | None: Deadline activo, o None si no hay ninguno
+    """
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]):
+    """
+    Activa un deadline para el código del bloque (None no cambia el deadline activo).
+
+    Args:
+        deadline: Deadline a activar
+    """
+    if deadline is None:
+        yield current_deadline()
+        return
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def bind_deadline(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Envuelve fn para que, al ejecutarse en otro hilo (ej. un ThreadPoolExecutor), use el
+    deadline activo al momento de envolverla y falle de inmediato si ya venció.
+
+    Args:
+        fn: Función a ejecutar en el pool
+
+    Returns:
+        Callable: Función envuelta
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return fn
+
+    def _bound(*args, **kwargs):
+        deadline.check()
+        with deadline_scope(deadline):
+            return fn(*args, **kwargs)
+
+    return _bound
+
+
+def check_deadline() -> None:
+    """
+    Raises:
+        DeadlineExceededError: Si hay un deadline activo y ya venció
+    """
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
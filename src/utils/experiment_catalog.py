@@ -0,0 +1,238 @@
+"""
+Catálogo en memoria de experimentos de Amplitude Experiment (Management API).
+
+La lista de experimentos se descarga una vez (paginando con `cursor` / `nextCursor`
+hasta el final, sin tope de 1000) y se indexa por `key`, guardando para cada
+experimento sus variantes originales y normalizadas (espacios -> guiones, el formato
+de la user property del experimento). Así, cada búsqueda de variantes es una lectura
+O(1) en memoria en lugar de una descarga completa de la lista.
+
+Refresco: cuando el snapshot supera su TTL se sigue sirviendo (stale-while-revalidate)
+y se refresca en un hilo de fondo. El refresco es condicional: la primera página se
+pide con If-None-Match y, si la API responde 304, se conserva el snapshot sin volver
+a descargar ni reindexar. Si se pide un experimento que no está en el índice (ej. uno
+recién creado) y el snapshot tiene más de AMPLITUDE_CATALOG_MISS_REFRESH_S segundos,
+se refresca en línea una vez antes de responder.
+
+Configuración (variables de entorno opcionales):
+- AMPLITUDE_CATALOG_TTL_S: Segundos antes de refrescar el catálogo en segundo plano (default: 300)
+- AMPLITUDE_CATALOG_MISS_REFRESH_S: Antigüedad mínima para refrescar ante un experimento desconocido (default: 30)
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+
+DEFAULT_CATALOG_TTL_S = 300
+DEFAULT_MISS_REFRESH_S = 30
+# Tope de páginas por refresco (protege ante un cursor que no avanza)
+MAX_PAGES = 100
+
+# loader(cursor, etag) -> (respuesta JSON o None si la API respondió 304, etag de la respuesta)
+PageLoader = Callable[[Optional[str], Optional[str]], Tuple[Optional[Dict[str, Any]], Optional[str]]]
+
+
+def _read_float_env(name: str, default: float) -> float:
+    try:
+        value = float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+def normalize_variant_name(name: str) -> str:
+    """
+    Normaliza el nombre de una variante al formato de la user property del experimento.
+
+    Args:
+        name: Nombre original de la variante
+
+    Returns:
+        str: Nombre con los espacios reemplazados por guiones
+    """
+    return name.replace(' ', '-')
+
+
+def _original_variant_names(experiment: Dict[str, Any]) -> List[str]:
+    names = []
+    for variant in experiment.get('variants', []) or []:
+        if isinstance(variant, dict):
+            names.append(variant.get('name', variant.get('key', str(variant))))
+        else:
+            names.append(str(variant))
+    return names
+
+
+class ExperimentCatalog:
+    """
+    Índice de experimentos por key con refresco por TTL en segundo plano.
+    """
+
+    def __init__(self, loader: PageLoader, ttl: float = None, miss_refresh: float = None):
+        self.loader = loader
+        self.ttl = ttl if ttl is not None else _read_float_env('AMPLITUDE_CATALOG_TTL_S', DEFAULT_CATALOG_TTL_S)
+        self.miss_refresh = (
+            miss_refresh if miss_refresh is not None
+            else _read_float_env('AMPLITUDE_CATALOG_MISS_REFRESH_S', DEFAULT_MISS_REFRESH_S)
+        )
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._experiments: Optional[List[Dict[str, Any]]] = None
+        self._frame: Optional[pd.DataFrame] = None
+        self._index: Dict[str, Dict[str, Any]] = {}
+        self._etag: Optional[str] = None
+        self._loaded_at = 0.0
+        self._background: Optional[threading.Thread] = None
+        self.full_refreshes = 0
+        self.not_modified = 0
+        self.pages_loaded = 0
+        self.lookups = 0
+        self.refresh_errors = 0
+        self.last_error: Optional[str] = None
+
+    def _load_all(self) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str], int]:
+        """Descarga todas las páginas; devuelve (experimentos o None si no cambió, etag, páginas)."""
+        with self._lock:
+            etag = self._etag if self._experiments is not None else None
+        experiments: List[Dict[str, Any]] = []
+        cursor, new_etag, pages, seen_cursors = None, None, 0, set()
+        while pages < MAX_PAGES:
+            data, page_etag = self.loader(cursor, etag if cursor is None else None)
+            if data is None:
+                return None, etag, pages
+            pages += 1
+            if cursor is None:
+                new_etag = page_etag
+            experiments.extend(data.get('experiments', []))
+            cursor = data.get('nextCursor')
+            if not cursor or cursor in seen_cursors:
+                break
+            seen_cursors.add(cursor)
+        return experiments, new_etag, pages
+
+    def refresh(self) -> None:
+        """
+        Refresca el catálogo (bloqueante). Si otro hilo ya está refrescando, espera a que termine.
+
+        Raises:
+            ValueError, requests.RequestException: Errores del loader
+        """
+        started = time.monotonic()
+        with self._refresh_lock:
+            with self._lock:
+                if self._experiments is not None and self._loaded_at >= started:
+                    # Otro hilo terminó un refresco mientras esperábamos el lock
+                    return
+            experiments, etag, pages = self._load_all()
+            index = {}
+            if experiments is not None:
+                for experiment in experiments:
+                    key = experiment.get('key')
+                    if key is None:
+                        continue
+                    original = _original_variant_names(experiment)
+                    index[key] = {
+                        'variants': [normalize_variant_name(name) for name in original],
+                        'variants_original': original,
+                    }
+                frame = pd.DataFrame(experiments)
+            with self._lock:
+                self.pages_loaded += pages
+                if experiments is None:
+                    self.not_modified += 1
+                else:
+                    self._experiments, self._frame, self._index, self._etag = experiments, frame, index, etag
+                    self.full_refreshes += 1
+                self._loaded_at = time.monotonic()
+                self.last_error = None
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+                self.last_error = str(e)[:300]
+
+    def _ensure_loaded(self) -> None:
+        """Carga el catálogo si está vacío; si expiró, lanza un refresco de fondo y sirve el snapshot actual."""
+        with self._lock:
+            loaded = self._experiments is not None
+            stale = loaded and time.monotonic() - self._loaded_at > self.ttl
+            if stale and (self._background is None or not self._background.is_alive()):
+                self._background = threading.Thread(
+                    target=self._refresh_in_background, name='experiment-catalog-refresh', daemon=True
+                )
+                self._background.start()
+        if not loaded:
+            self.refresh()
+
+    def get_experiments_frame(self) -> pd.DataFrame:
+        """
+        Obtiene todos los experimentos como DataFrame (mismo formato que la respuesta de la API).
+
+        Returns:
+            pd.DataFrame: Copia del snapshot actual
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return self._frame.copy()
+
+    def _lookup(self, experiment_id: str) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        with self._lock:
+            self.lookups += 1
+            entry = self._index.get(experiment_id)
+            age = time.monotonic() - self._loaded_at
+        if entry is None and age > self.miss_refresh:
+            self.refresh()
+            with self._lock:
+                entry = self._index.get(experiment_id)
+        return entry
+
+    def get_variants(self, experiment_id: str, original: bool = False) -> Optional[List[str]]:
+        """
+        Obtiene las variantes de un experimento.
+
+        Args:
+            experiment_id: Key del experimento
+            original: Si es True, devuelve los nombres sin normalizar
+
+        Returns:
+            list | None: Copia de la lista de variantes, o None si el experimento no existe
+        """
+        entry = self._lookup(experiment_id)
+        if entry is None:
+            return None
+        return list(entry['variants_original' if original else 'variants'])
+
+    def invalidate(self) -> None:
+        """Descarta el snapshot; la próxima lectura vuelve a descargar el catálogo completo."""
+        with self._lock:
+            self._experiments, self._frame, self._index, self._etag = None, None, {}, None
+            self._loaded_at = 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene los contadores del catálogo.
+
+        Returns:
+            dict: Experimentos indexados, antigüedad del snapshot, refrescos y errores
+        """
+        with self._lock:
+            loaded = self._experiments is not None
+            return {
+                'experiments': len(self._index),
+                'age_s': round(time.monotonic() - self._loaded_at, 1) if loaded else None,
+                'ttl_s': self.ttl,
+                'full_refreshes': self.full_refreshes,
+                'not_modified': self.not_modified,
+                'pages_loaded': self.pages_loaded,
+                'lookups': self.lookups,
+                'refresh_errors': self.refresh_errors,
+                'last_error': self.last_error,
+            }
@@ -9,31 +9,70 @@ Este módulo contiene todas las funciones necesarias para:
 
 import os
 import json
+import threading
+from urllib.parse import urlencode
 import pandas as pd
 import requests
 from requests.auth import HTTPBasicAuth
 from datetime import date, datetime, time
-from src.utils.amplitude_filters import (
-    get_culture_digital_filter, get_culture_digital_filter_multiple,
-    get_country_filter,
-    get_device_type, get_device_type_multiple,
-    get_flow_type_filter, get_flow_type_filter_multiple,
-    get_bundle_filters, get_bundle_filters_multiple,
-    get_trip_type_filter, get_trip_type_filter_multiple,
-    get_pax_adult_count_filter,
-    get_travel_group_filter, get_travel_group_filter_multiple
-)
+from src.utils.amplitude_filters import compile_event_payloads
+from src.utils.amplitude_client import get_amplitude_client
+from src.utils.amplitude_cache import get_memory_cache, get_response_store, single_flight
+from src.utils.arrow_cache import arrow_cached, get_arrow_result_cache
+from src.utils.deadline import DeadlineExceededError, deadline_scope
+from src.utils.experiment_catalog import ExperimentCatalog
+from src.utils.amplitude_query import canonicalize_funnel_query, fingerprint_query, normalize_date_for_amplitude
+from src.utils.funnel_parser import parse_cumulative_funnel, parse_daily_funnel
+from src.utils.composite_metrics import fetch_composite, get_composite
+from src.utils.query_planner import truncate_funnel_response
+from src.utils.segment_breakdown import get_breakdown_group_by, split_grouped_response
+from src.utils.task_scheduler import get_task_scheduler
+from src.utils.tracing import count_steps, record_trace, trace_start
 import sys
 from io import StringIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import hashlib
 import streamlit as st
 
 # Variable global para almacenar logs
 _logs = []
 
-# Cache simple en memoria para requests a Amplitude (mejora velocidad)
-_amplitude_cache = {}
+AMPLITUDE_FUNNELS_URL = 'https://amplitude.com/api/2/funnels'
+AMPLITUDE_EXPERIMENTS_URL = 'https://experiment.amplitude.com/api/1/experiments'
+# Experimentos por página al descargar el catálogo (se pagina con cursor hasta el final)
+try:
+    EXPERIMENTS_PAGE_SIZE = max(1, int(os.getenv('AMPLITUDE_CATALOG_PAGE_SIZE', 1000)))
+except (TypeError, ValueError):
+    EXPERIMENTS_PAGE_SIZE = 1000
+
+# Queries multi-variante: todas las variantes pendientes en una sola request (un segmento por variante).
+# Si la query codificada supera BATCH_MAX_QUERY_CHARS (límite práctico de URL) se usan requests por variante.
+BATCH_VARIANTS_ENABLED = os.getenv('AMPLITUDE_BATCH_VARIANTS', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+try:
+    BATCH_MAX_QUERY_CHARS = max(1, int(os.getenv('AMPLITUDE_BATCH_MAX_QUERY_CHARS', 7000)))
+except (TypeError, ValueError):
+    BATCH_MAX_QUERY_CHARS = 7000
+
+# Desgloses por segmento con group-by: una query por variante agrupada por la propiedad del desglose
+# en lugar de una query por (variante, segmento). GROUP_BY_LIMIT es el máximo de grupos que devuelve Amplitude.
+BREAKDOWN_PUSHDOWN_ENABLED = os.getenv('AMPLITUDE_BREAKDOWN_PUSHDOWN', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+try:
+    GROUP_BY_LIMIT = max(1, int(os.getenv('AMPLITUDE_GROUP_BY_LIMIT', 1000)))
+except (TypeError, ValueError):
+    GROUP_BY_LIMIT = 1000
+
+_batch_stats = {
+    'batched_requests': 0,
+    'variants_batched': 0,
+    'variants_from_cache': 0,
+    'fallbacks_too_large': 0,
+    'fallbacks_error': 0,
+    'breakdown_grouped_requests': 0,
+    'breakdown_segments_served': 0,
+    'breakdown_fallbacks': 0,
+}
+_batch_stats_lock = threading.Lock()
+
+# Caché en memoria acotado y thread-safe para requests a Amplitude (compartido por todas las sesiones)
+_amplitude_cache = get_memory_cache()
 
 def get_logs():
     """Obtiene y limpia los logs capturados"""
@@ -43,26 +82,25 @@ def get_logs():
     return logs
 
 
-def _generate_cache_key(*args, **kwargs):
+def clear_amplitude_cache(experiment_id=None):
     """
-    Genera una clave única para el caché basada en los parámetros.
+    Limpia el caché de Amplitude.
+    
+    Args:
+        experiment_id: Si se indica, solo invalida las respuestas en memoria de ese experimento.
+                       Si es None, limpia el caché en memoria, el store persistente en disco,
+                       los resultados del pipeline (caché Arrow) y el catálogo de experimentos.
     
     Returns:
-        str: Hash MD5 de los parámetros
+        int: Número de entradas eliminadas del caché en memoria
     """
-    # Convertir todos los parámetros a string y crear un hash
-    key_str = json.dumps({
-        'args': str(args),
-        'kwargs': {k: str(v) for k, v in sorted(kwargs.items())}
-    }, sort_keys=True)
-    return hashlib.md5(key_str.encode()).hexdigest()
-
-
-def clear_amplitude_cache():
-    """Limpia el caché de Amplitude"""
-    global _amplitude_cache
-    _amplitude_cache = {}
-    return len(_amplitude_cache)
+    if experiment_id is not None:
+        return _amplitude_cache.invalidate_experiment(str(experiment_id))
+    removed = _amplitude_cache.clear()
+    get_response_store().clear()
+    get_arrow_result_cache().clear()
+    _experiment_catalog.invalidate()
+    return removed
 
 
 def get_credentials():
@@ -150,67 +188,6 @@ def extract_median_time_from_response(response_json, variant_name="control"):
         return None
 
 
-def normalize_date_for_amplitude(date_input, default_time="00:00:00", is_end_date=False):
-    """
-    Normaliza una fecha para enviarla a la API de Amplitude con precisión horaria.
-    
-    Args:
-        date_input: Puede ser:
-            - str en formato ISO (YYYY-MM-DDTHH:mm:ss o YYYY-MM-DD)
-            - datetime object
-            - pd.Timestamp
-            - None
-        default_time: Hora por defecto si solo se proporciona la fecha (formato HH:mm:ss)
-        is_end_date: Si es True y solo hay fecha, usa 23:59:59 en lugar de default_time
-        
-    Returns:
-        str: Fecha formateada como YYYYMMDDHHmmss para la API de Amplitude
-    """
-    if date_input is None or pd.isna(date_input):
-        return None
-    
-    # Convertir a datetime si es string
-    if isinstance(date_input, str):
-        # Intentar parsear diferentes formatos
-        try:
-            # Formato ISO completo con hora
-            if 'T' in date_input or ' ' in date_input:
-                dt = pd.to_datetime(date_input)
-            else:
-                # Solo fecha, agregar hora
-                date_str = date_input.strip()
-                if is_end_date:
-                    time_str = "23:59:59"
-                else:
-                    time_str = default_time
-                dt = pd.to_datetime(f"{date_str} {time_str}")
-        except Exception:
-            # Fallback: asumir formato YYYY-MM-DD
-            date_str = date_input.strip()
-            if is_end_date:
-                time_str = "23:59:59"
-            else:
-                time_str = default_time
-            dt = pd.to_datetime(f"{date_str} {time_str}")
-    elif isinstance(date_input, (pd.Timestamp, datetime)):
-        dt = pd.to_datetime(date_input)
-        # Si no tiene hora (00:00:00), aplicar la hora por defecto según el tipo
-        if dt.hour == 0 and dt.minute == 0 and dt.second == 0:
-            if is_end_date:
-                dt = dt.replace(hour=23, minute=59, second=59)
-            # Si es start_date y es 00:00:00, mantenerlo así (ya es el default)
-    else:
-        # Intentar convertir con pandas
-        dt = pd.to_datetime(date_input)
-        # Si después de la conversión no tiene hora, aplicar la hora por defecto
-        if dt.hour == 0 and dt.minute == 0 and dt.second == 0:
-            if is_end_date:
-                dt = dt.replace(hour=23, minute=59, second=59)
-    
-    # Formatear como YYYYMMDDHHmmss para la API de Amplitude
-    return dt.strftime('%Y%m%d%H%M%S')
-
-
 def apply_time_to_datetime_string(dt_string, t):
     """
     Sustituye la componente horaria de una fecha/hora por la indicada en t.
@@ -284,11 +261,22 @@ def build_analysis_datetime_strings(
     )
 
 
-@st.cache_data(persist="disk", show_spinner=False, ttl=86400)
-def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experiment_id, device, variant, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, include_time_data=False):
+def _cache_scope(api_key, grouped_breakdown=None):
+    """
+    Scope del fingerprint de una query. Los resultados de un desglose agrupado (group-by)
+    no equivalen a la query filtrada (cada usuario cae en un solo grupo), así que se guardan
+    bajo un scope propio y nunca los lee un análisis normal.
+    """
+    return api_key if grouped_breakdown is None else f"{api_key}|grouped:{grouped_breakdown}"
+
+
+def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experiment_id, device, variant, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, include_time_data=False, grouped_breakdown=None):
 	"""
 	Obtiene datos de funnel desde la API de Amplitude para un experimento específico.
-	OPTIMIZACIÓN: Incluye caché en memoria para evitar requests duplicadas.
+	OPTIMIZACIÓN: Los parámetros se normalizan a una query canónica (amplitude_query) y su
+	fingerprint es la clave compartida por todas las capas de caché (st.cache_data, memoria,
+	store en disco y single-flight), así la misma consulta pedida desde distintos caminos
+	de la UI reutiliza el mismo resultado.
 	
 	Args:
 		api_key: API key de Amplitude
@@ -308,113 +296,62 @@ def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experi
 		trip_type: Tipo de viaje ('ALL', 'Solo Ida (One Way)', 'Ida y Vuelta (Round Trip)')
 		pax_adult_count: Cantidad de adultos ('ALL', '1 Adulto', '2 Adultos', '3 Adultos', '4+ Adultos')
 		hidden_first_step: Si es True, aplica "Inmunidad Contextual": solo filtra Flow/Trip/Bundle en el paso 0 (ancla)
+		grouped_breakdown: Opcional. Desglose resuelto con group-by (prefetch_segment_breakdown):
+		                   la respuesta se busca y guarda en el scope de ese desglose
 		
 	Returns:
 		dict: Respuesta JSON de la API de Amplitude con los datos del funnel
 	"""
-	# OPTIMIZACIÓN #2: Verificar caché antes de hacer request
-	global _amplitude_cache
-	cache_key = _generate_cache_key(
-		start_date, end_date, experiment_id, device, variant, culture,
-		event_list, conversion_window, event_filters_map, flow_type,
-		bundle_profile, trip_type, pax_adult_count, travel_group, country, hidden_first_step
+	query = canonicalize_funnel_query(
+		start_date, end_date, experiment_id, device, variant, culture, event_list,
+		conversion_window, event_filters_map, flow_type, bundle_profile, trip_type,
+		pax_adult_count, travel_group, country, hidden_first_step, include_time_data
 	)
+	fingerprint = fingerprint_query(query, scope=_cache_scope(api_key, grouped_breakdown))
+	return _get_funnel_data_cached(fingerprint, api_key, secret_key, query)
+
+
+@st.cache_data(persist="disk", show_spinner=False, ttl=86400)
+def _get_funnel_data_cached(fingerprint, _api_key, _secret_key, _query):
+	"""
+	Capa st.cache_data de get_funnel_data_experiment, indexada solo por el fingerprint canónico
+	(los parámetros con prefijo "_" no forman parte de la clave de Streamlit).
+	"""
+	return _fetch_funnel_data(_api_key, _secret_key, fingerprint, **_query)
+
+
+def _fetch_funnel_data(api_key, secret_key, fingerprint, start_date, end_date, experiment_id, device, variant, culture, event_list, conversion_window, event_filters_map, flow_type, bundle_profile, trip_type, pax_adult_count, travel_group, country, hidden_first_step, include_time_data):
+	"""
+	Ejecuta la query de funnel canónica (ver get_funnel_data_experiment).
+	
+	Args:
+		api_key, secret_key: Credenciales de Amplitude
+		fingerprint: Fingerprint de la query canónica (clave de caché)
+		start_date, ..., include_time_data: Parámetros canónicos de la query
+		
+	Returns:
+		dict: Respuesta JSON de la API de Amplitude con los datos del funnel
+	"""
+	# Trazas opt-in (src/utils/tracing.py): con las trazas apagadas started es None y no se inspecciona nada
+	started = trace_start()
+	
+	# OPTIMIZACIÓN #2: Verificar caché antes de hacer request
+	cache_key = fingerprint
 	
-	if cache_key in _amplitude_cache:
+	cached_response = _amplitude_cache.get(cache_key)
+	if cached_response is not None:
 		# Retornar resultado cacheado (sin hacer request a Amplitude)
-		return _amplitude_cache[cache_key]
+		if started is not None:
+			record_trace(started, 'funnel', 'memory', experiment_id, variant, steps=count_steps(cached_response), fingerprint=cache_key)
+		return cached_response
 	# ============================================================
-	# COMPOSITE METRIC STRATEGY: EXTRAS_GENERAL_CR
+	# MÉTRICAS COMPUESTAS (ej. EXTRAS_GENERAL_CR)
 	# ============================================================
-	# Detectamos si esta es la métrica EXTRAS_GENERAL_CR que requiere
-	# lógica OR (suma de 3 sub-métricas: Flexi, Pet, Priority)
-	# Estructura esperada: extras_dom_loaded -> extra_selected (filtro) -> revenue_amount
-	is_extras_general_cr = False
-	if event_list and len(event_list) >= 3:
-		# Extraer nombres de eventos (puede venir como lista de strings o lista de tuplas)
-		first_event = event_list[0] if isinstance(event_list[0], str) else (event_list[0][0] if isinstance(event_list[0], tuple) else None)
-		second_event = event_list[1] if isinstance(event_list[1], str) else (event_list[1][0] if isinstance(event_list[1], tuple) else None)
-		third_event = event_list[2] if isinstance(event_list[2], str) else (event_list[2][0] if isinstance(event_list[2], tuple) else None)
-		
-		# Verificar estructura de EXTRAS_GENERAL_CR
-		if (first_event == 'extras_dom_loaded' and 
-		    second_event == 'extra_selected' and 
-		    third_event == 'revenue_amount'):
-			# Verificar que el filtro de extra_selected excluya airportCheckin
-			# Primero intentar desde event_filters_map (formato desde app.py)
-			second_event_filters = []
-			if event_filters_map and 'extra_selected' in event_filters_map:
-				second_event_filters = event_filters_map.get('extra_selected', [])
-			# Si no está en event_filters_map, intentar desde event_list (formato tupla)
-			elif isinstance(event_list[1], tuple) and len(event_list[1]) > 1:
-				second_event_filters = event_list[1][1] if isinstance(event_list[1][1], list) else [event_list[1][1]]
-			
-			# Buscar filtro que excluya airportCheckin
-			for filt in second_event_filters:
-				if isinstance(filt, dict):
-					if (filt.get('subprop_key') == 'type' and 
-					    filt.get('subprop_op') == 'is not' and 
-					    'airportCheckin' in filt.get('subprop_value', [])):
-						is_extras_general_cr = True
-						break
-	
-	# Si es EXTRAS_GENERAL_CR, usar estrategia de métrica compuesta
-	if is_extras_general_cr:
-		# Definir las 3 sub-métricas (Flexi, Pet, Priority)
-		sub_metrics = [
-			{
-				'name': 'flexi',
-				'event_list': [
-					('extras_dom_loaded', []),
-					('revenue_amount', [{
-						'subprop_type': 'event',
-						'subprop_key': 'flexi_smart_count',
-						'subprop_op': 'greater',
-						'subprop_value': [0]
-					}])
-				]
-			},
-			{
-				'name': 'pet',
-				'event_list': [
-					('extras_dom_loaded', []),
-					('revenue_amount', [{
-						'subprop_type': 'event',
-						'subprop_key': 'pet_in_cabin_count',
-						'subprop_op': 'greater',
-						'subprop_value': [0]
-					}])
-				]
-			},
-			{
-				'name': 'priority',
-				'event_list': [
-					('extras_dom_loaded', []),
-					('revenue_amount', [{
-						'subprop_type': 'event',
-						'subprop_key': 'priority_boarding_count',
-						'subprop_op': 'greater',
-						'subprop_value': [0]
-					}])
-				]
-			}
-		]
-		
-		# OPTIMIZACIÓN: Ejecutar las 3 sub-métricas en paralelo
-		def fetch_sub_metric(sub_metric):
-			"""Helper function para obtener una sub-métrica en paralelo"""
-			sub_event_list = sub_metric['event_list']
-			sub_event_filters_map = {}
-			
-			# Construir event_filters_map para esta sub-métrica
-			for event_item in sub_event_list:
-				if isinstance(event_item, tuple) and len(event_item) > 1:
-					event_name = event_item[0]
-					event_filters = event_item[1] if isinstance(event_item[1], list) else [event_item[1]]
-					if event_filters:
-						sub_event_filters_map[event_name] = event_filters
-			
-			# Llamar recursivamente a get_funnel_data_experiment para esta sub-métrica
+	# Si los eventos y filtros coinciden con una métrica declarada con 'composite', se piden
+	# sus sub-métricas en paralelo y se combinan (src/utils/composite_metrics.py)
+	composite = get_composite(event_list, event_filters_map)
+	if composite is not None:
+		def fetch_sub_metric(sub_event_list, sub_event_filters_map):
 			return get_funnel_data_experiment(
 				api_key, secret_key, start_date, end_date, experiment_id,
 				device, variant, culture, sub_event_list,
@@ -422,344 +359,18 @@ def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experi
 				flow_type, bundle_profile, trip_type, pax_adult_count, travel_group, country, hidden_first_step
 			)
 		
-		# Ejecutar las 3 sub-métricas en paralelo usando ThreadPoolExecutor
-		sub_results = []
-		with ThreadPoolExecutor(max_workers=3) as executor:
-			# Enviar todas las tareas en paralelo
-			future_to_metric = {executor.submit(fetch_sub_metric, sub_metric): sub_metric for sub_metric in sub_metrics}
-			
-			# Recopilar resultados a medida que completan (mantener orden)
-			sub_results_ordered = [None] * len(sub_metrics)
-			for future in as_completed(future_to_metric):
-				sub_metric = future_to_metric[future]
-				try:
-					sub_result = future.result()
-					# Mantener el orden original de las sub-métricas
-					metric_idx = sub_metrics.index(sub_metric)
-					sub_results_ordered[metric_idx] = sub_result
-				except Exception as e:
-					# Si una sub-métrica falla, agregar error en lugar de fallar todo
-					print(f"⚠️ Error obteniendo sub-métrica {sub_metric.get('name', 'unknown')}: {e}")
-					metric_idx = sub_metrics.index(sub_metric)
-					sub_results_ordered[metric_idx] = {'error': str(e)}
-			
-			# Filtrar None y usar resultados ordenados
-			sub_results = [r for r in sub_results_ordered if r is not None]
-		
-		# Combinar resultados: sumar conversiones de las 3 sub-métricas
-		# La estructura de respuesta de Amplitude: data[0] = {dayFunnels: {series: [[val1, val2], ...], xValues: [dates]}, events: [...]}
-		combined_result = sub_results[0].copy() if sub_results else {}
-		
-		if 'data' in combined_result and sub_results and len(sub_results) > 0:
-			from collections import defaultdict
-			
-			# Obtener la primera sub-métrica como base para estructura
-			base_data = sub_results[0].get('data', [])
-			if not base_data:
-				return combined_result
-			
-			base_website = base_data[0] if isinstance(base_data, list) else base_data
-			base_events = base_website.get('events', [])
-			base_dates = base_website.get('dayFunnels', {}).get('xValues', [])
-			
-			# Inicializar estructura combinada
-			combined_series = defaultdict(lambda: defaultdict(int))  # {date_index: {step_index: value}}
-			
-			# Procesar cada sub-métrica
-			for sub_result in sub_results:
-				sub_data = sub_result.get('data', [])
-				if not sub_data:
-					continue
-				
-				sub_website = sub_data[0] if isinstance(sub_data, list) else sub_data
-				sub_series = sub_website.get('dayFunnels', {}).get('series', [])
-				sub_dates = sub_website.get('dayFunnels', {}).get('xValues', [])
-				
-				# Sumar valores por fecha y step
-				for date_idx, date_series in enumerate(sub_series):
-					if date_idx < len(sub_dates):
-						date_key = sub_dates[date_idx]
-						# Buscar índice de fecha en base_dates
-						if date_key in base_dates:
-							base_date_idx = base_dates.index(date_key)
-							for step_idx, step_value in enumerate(date_series):
-								# Solo sumar el último step (conversión)
-								if step_idx == len(date_series) - 1:
-									combined_series[base_date_idx][step_idx] += step_value
-								# Para el primer step (anchor), tomar el máximo (mismo denominador)
-								elif step_idx == 0:
-									combined_series[base_date_idx][step_idx] = max(
-										combined_series[base_date_idx][step_idx],
-										step_value
-									)
-			
-			# Reconstruir estructura combinada
-			combined_series_list = []
-			for date_idx in range(len(base_dates)):
-				date_series = []
-				for step_idx in range(len(base_events)):
-					value = combined_series[date_idx].get(step_idx, 0)
-					date_series.append(value)
-				combined_series_list.append(date_series)
-			
-			# Actualizar resultado combinado
-			combined_website = base_website.copy()
-			combined_website['dayFunnels']['series'] = combined_series_list
-			combined_result['data'] = [combined_website]
-		
-		# OPTIMIZACIÓN #2: Guardar resultado compuesto en caché
-		_amplitude_cache[cache_key] = combined_result
-		
+		combined_result, complete = fetch_composite(composite, fetch_sub_metric)
+		# OPTIMIZACIÓN #2: Guardar resultado compuesto en caché (solo si respondieron todas las sub-métricas)
+		if complete:
+			_amplitude_cache.put(cache_key, combined_result, experiment_id)
 		return combined_result
 	
-	# Si no es EXTRAS_GENERAL_CR, continuar con el flujo normal
-	url = 'https://amplitude.com/api/2/funnels'
-
-	# Construir filtros base de segmentación (GLOBAL GHOST ANCHOR)
-	# ESTRATEGIA GLOBAL GHOST ANCHOR: Todos los filtros globales (Device, Culture, Flow Type, etc.)
-	# se aplican EXCLUSIVAMENTE al primer evento (índice 0). Los eventos siguientes (Steps/Goal)
-	# solo reciben filtros técnicos específicos de la métrica para evitar "ceros" en conversiones.
-	# Esto resuelve el problema sistémico donde revenue_amount y otros eventos finales no tienen
-	# propiedades de segmentación, causando que los filtros fallen y devuelvan 0 conversiones.
-	segmentation_filters = []
-
-	# Manejo de filtros con soporte para listas (multiselect)
-	# Si el valor es una lista, usar funciones _multiple; si es string, usar funciones individuales
-	# Lista vacía o "ALL" significa "sin filtro" (todos los valores)
-	
-	# Culture filter
-	if culture:
-		if isinstance(culture, list):
-			if len(culture) > 0:
-				culture_filter = get_culture_digital_filter_multiple(culture)
-				if culture_filter:  # Solo agregar si no está vacío
-					segmentation_filters.append(culture_filter)
-		else:
-			if str(culture).upper() != "ALL":
-				culture_filter = get_culture_digital_filter(culture)
-				if culture_filter:  # Solo agregar si no está vacío (devuelve dict o "")
-					segmentation_filters.append(culture_filter)
-	
-	# Device filter
-	if device:
-		if isinstance(device, list):
-			if len(device) > 0:
-				device_filter = get_device_type_multiple(device)
-				if device_filter and isinstance(device_filter, dict):  # Solo agregar si es un dict válido
-					segmentation_filters.append(device_filter)
-		else:
-			if str(device).upper() != "ALL":
-				# Normalizar device a minúsculas porque get_device_type espera 'mobile' o 'desktop'
-				device_normalized = str(device).lower().strip()
-				device_filter = get_device_type(device_normalized)
-				# get_device_type devuelve dict si encuentra, [] si no encuentra
-				if device_filter and isinstance(device_filter, dict):  # Solo agregar si es un dict válido
-					segmentation_filters.append(device_filter)
-				elif device_filter == []:
-					# Si devuelve lista vacía, el valor no es reconocido
-					# Intentar con el valor original por si acaso
-					device_filter_alt = get_device_type(device)
-					if device_filter_alt and isinstance(device_filter_alt, dict):
-						segmentation_filters.append(device_filter_alt)
-
-	# Country filter (propiedad nativa de usuario en Amplitude)
-	if country:
-		country_filter = get_country_filter(country)
-		if country_filter:
-			segmentation_filters.append(country_filter)
-
-	# ============================================================
-	# CONSOLIDACIÓN: Construir lista unificada de filtros globales
-	# ============================================================
-	# NOTA: Estos filtros se aplicarán SOLO al evento 0 (Anchor) como parte
-	# de la estrategia Global Ghost Anchor para evitar "ceros" en conversiones
-	
-	# PASO B: Construir filtros contextuales (Flow Type, Bundle Profile, Trip Type, Pax Adult Count)
-	# Verificar primero si la métrica tiene filtros explícitos para evitar duplicados
-	has_explicit_flow_type_filter = False
-	has_explicit_trip_type_filter = False
-	has_explicit_bundle_filter = False
-	has_explicit_pax_filter = False
-	
-	# Revisar todos los eventos en event_filters_map para detectar filtros explícitos
-	if event_filters_map:
-		for event_name, filters in event_filters_map.items():
-			if filters:
-				filters_list = filters if isinstance(filters, list) else [filters]
-				for filt in filters_list:
-					if isinstance(filt, dict):
-						subprop_key = filt.get('subprop_key')
-						if subprop_key == 'flow_type':
-							has_explicit_flow_type_filter = True
-						elif subprop_key == 'trip_type':
-							has_explicit_trip_type_filter = True
-						elif subprop_key == 'bundle_profile' or 'bundle' in str(subprop_key).lower():
-							has_explicit_bundle_filter = True
-						elif subprop_key == 'pax_adult_count' or 'pax' in str(subprop_key).lower():
-							has_explicit_pax_filter = True
-	
-	# ============================================================
-	# CONSTRUCCIÓN DE EVENTOS: ESTRATEGIA GLOBAL GHOST ANCHOR
-	# ============================================================
-	# Evento 0 (Anchor): Filtros globales + filtros técnicos de métrica
-	# Eventos > 0 (Steps/Goal): SOLO filtros técnicos de métrica
-	# ============================================================
-	event_filters_grouped = []
-	for idx, event in enumerate(event_list):
-		# PASO A: Iniciar lista de filtros para este evento
-		event_filters = []
-		
-		# Extraer el nombre del evento (puede venir como tupla ('evento', [filtros]) o como string)
-		if isinstance(event, tuple) and len(event) > 0:
-			event_name = event[0]
-		elif isinstance(event, str):
-			event_name = event
-		else:
-			event_name = str(event)
-		
-		# PASO B: ESTRATEGIA GLOBAL GHOST ANCHOR
-		# ============================================================
-		# REGLA DE NEGOCIO: Aplicar filtros globales SOLO al Evento 0 (Anchor)
-		# ============================================================
-		# - Evento 0 (Anchor): Aplica TODOS los filtros globales (Device, Culture, Flow Type, etc.)
-		#                     + filtros técnicos específicos de la métrica
-		# - Eventos > 0 (Steps/Goal): IGNORA filtros globales, aplica SOLO filtros técnicos
-		#                             de la métrica (definidos en event_filters_map)
-		# ============================================================
-		# Esto resuelve el problema de "ceros" en métricas de conversión donde revenue_amount
-		# y otros eventos finales no tienen propiedades de segmentación.
-		# ============================================================
-		is_anchor_event = (idx == 0)
-		is_strict_anchor = (idx == 0)
-		
-		# SOLO el evento 0 (Anchor) recibe filtros globales de segmentación
-		# Los eventos siguientes (Steps/Goal) NO reciben filtros globales para evitar "ceros"
-		if is_strict_anchor:
-			# Device y Culture se aplican SOLO al evento ancla
-			event_filters.extend(segmentation_filters)
-		
-		# PASO C: Construir filtros contextuales (Flow Type, Trip Type, Bundle, Travel Group)
-		# Estos filtros ya están configurados para aplicarse solo al evento 0 (is_strict_anchor)
-		# como parte de la estrategia Global Ghost Anchor
-		
-		# 1. TRAVEL GROUP: Solo aplicar en el primer paso
-		if travel_group:
-			if isinstance(travel_group, list):
-				if len(travel_group) > 0 and is_strict_anchor:
-					travel_group_filters = get_travel_group_filter_multiple(travel_group, event_name)
-					if travel_group_filters:
-						event_filters.extend(travel_group_filters)
-			else:
-				if str(travel_group).upper() != "ALL" and is_strict_anchor:
-					travel_group_filters = get_travel_group_filter(travel_group, event_name)
-					if travel_group_filters:
-						event_filters.extend(travel_group_filters)
-		
-		# 2. PAX ADULT COUNT: Solo aplicar en el primer paso (compatibilidad hacia atrás)
-		elif pax_adult_count and str(pax_adult_count).upper() != "ALL" and not has_explicit_pax_filter:
-			if is_strict_anchor:
-				pax_adult_count_filter = get_pax_adult_count_filter(pax_adult_count)
-				if pax_adult_count_filter:
-					event_filters.append(pax_adult_count_filter)
-		
-		# 3. TRIP TYPE: Solo aplicar en el primer paso
-		if trip_type and not has_explicit_trip_type_filter:
-			if isinstance(trip_type, list):
-				if len(trip_type) > 0 and is_strict_anchor:
-					trip_type_filter = get_trip_type_filter_multiple(trip_type)
-					if trip_type_filter:
-						event_filters.append(trip_type_filter)
-			else:
-				if str(trip_type).upper() != "ALL" and is_strict_anchor:
-					trip_type_filter = get_trip_type_filter(trip_type)
-					if trip_type_filter:
-						event_filters.append(trip_type_filter)
-		
-		# 4. FLOW TYPE: Solo aplicar en el primer paso
-		if flow_type and not has_explicit_flow_type_filter:
-			if isinstance(flow_type, list):
-				if len(flow_type) > 0 and is_strict_anchor:
-					flow_type_filter = get_flow_type_filter_multiple(flow_type)
-					if flow_type_filter:
-						event_filters.append(flow_type_filter)
-			else:
-				if str(flow_type).upper() != "ALL" and is_strict_anchor:
-					flow_type_filter = get_flow_type_filter(flow_type)
-					if flow_type_filter:
-						event_filters.append(flow_type_filter)
-		
-		# 5. BUNDLE PROFILE: Solo aplicar en el primer paso
-		if bundle_profile and not has_explicit_bundle_filter:
-			if isinstance(bundle_profile, list):
-				if len(bundle_profile) > 0 and is_strict_anchor:
-					bundle_filters = get_bundle_filters_multiple(bundle_profile)
-					if bundle_filters:
-						event_filters.extend(bundle_filters)
-			else:
-				if str(bundle_profile).upper() != "ALL" and is_strict_anchor:
-					bundle_filters = get_bundle_filters(bundle_profile)
-					if bundle_filters:
-						event_filters.extend(bundle_filters)
-		
-		# PASO D: Agregar filtros técnicos específicos de la métrica si existen para este evento
-		# Estos filtros se aplican a TODOS los eventos (0 y > 0) como parte de la lógica de negocio
-		# de la métrica. Son filtros técnicos (ej: seats_count > 0) que validan condiciones específicas.
-		if event_filters_map and event_name in event_filters_map:
-			additional_filters = event_filters_map[event_name]
-			if additional_filters:
-				# Si additional_filters es una lista, extender
-				if isinstance(additional_filters, list):
-					event_filters.extend(additional_filters)
-				else:
-					# Si es un solo filtro, agregarlo
-					event_filters.append(additional_filters)
-		
-		event_filters_grouped.append({
-			"event_type": event_name,  # Usar el nombre extraído del evento
-			"filters": event_filters,
-			"group_by": []
-		})
-
-
-    
-    
-	segments = [
-						{
-							'group_type': 'User',
-							'prop': f'gp:[Experiment] {experiment_id}',
-							'prop_type': 'user',
-							'op': 'is',
-							'type': 'property',
-							'values': [
-								variant,
-							],
-						},
-						# {
-						# 	'group_type': 'User',
-						# 	'prop': 'device_type',
-						# 	'prop_type': 'user',
-						# 	'op': 'is',
-						# 	'type': 'property',
-						# 	'values': get_device_type(device)
-						# },
-					],
-
-	# Normalizar fechas con precisión horaria para la API de Amplitude
-	start_date_formatted = normalize_date_for_amplitude(start_date, default_time="00:00:00", is_end_date=False)
-	end_date_formatted = normalize_date_for_amplitude(end_date, default_time="00:00:00", is_end_date=True)
-	
-	params = {
-		'e': [json.dumps(event) for event in event_filters_grouped],
-		'start': start_date_formatted,
-		'end': end_date_formatted,
-		'cs': conversion_window,
-		's': [json.dumps(segment) for segment in segments],
-		
-	}
-	
-	# Si se solicita tiempo de conversión, agregar parámetro view
-	if include_time_data:
-		params['view'] = 'time_to_convert'
+	url = AMPLITUDE_FUNNELS_URL
+	params, event_filters_grouped, segmentation_filters = _build_funnel_params(
+		start_date, end_date, experiment_id, device, [variant], culture, event_list,
+		conversion_window, event_filters_map, flow_type, bundle_profile, trip_type,
+		pax_adult_count, travel_group, country, include_time_data
+	)
 
 	headers = {
 		'Authorization': f'Basic {api_key}:{secret_key}'
@@ -863,76 +474,29 @@ def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experi
 		# Si streamlit no está disponible o hay error, continuar sin debug
 		pass
 	
-	try:
-		response = requests.get(url, headers=headers, params=params, auth=HTTPBasicAuth(api_key, secret_key))
+	fetch_info = {}
+	
+	def _fetch_funnel():
+		response = get_amplitude_client().get(url, headers=headers, params=params, auth=HTTPBasicAuth(api_key, secret_key))
 		response.raise_for_status()  # Lanza excepción si el status code indica error
-		
-		response_json = response.json()
-		
-		# ============================================================
-		# DIAGNÓSTICO: Inspección de estructura de respuesta para TTC
-		# ============================================================
-		print("\n" + "="*80)
-		print("🔍 DIAGNÓSTICO: Estructura de respuesta de Amplitude")
-		print("="*80)
-		print(f"Keys del JSON raíz: {list(response_json.keys())}")
-		
-		if 'data' in response_json:
-			data = response_json['data']
-			if isinstance(data, list) and len(data) > 0:
-				first_item = data[0]
-				print(f"\nTipo de 'data': {type(data)}")
-				print(f"Keys del primer elemento de 'data': {list(first_item.keys()) if isinstance(first_item, dict) else 'No es dict'}")
-				
-				if isinstance(first_item, dict):
-					# Inspeccionar estructura de dayFunnels
-					if 'dayFunnels' in first_item:
-						day_funnels = first_item['dayFunnels']
-						print(f"Keys de 'dayFunnels': {list(day_funnels.keys()) if isinstance(day_funnels, dict) else 'No es dict'}")
-						
-						# Buscar campos relacionados con tiempo
-						if isinstance(day_funnels, dict):
-							for key in day_funnels.keys():
-								if any(time_word in key.lower() for time_word in ['time', 'interval', 'median', 'average', 'mean', 'duration']):
-									print(f"  ⏱️  Campo relacionado con tiempo encontrado: '{key}' = {day_funnels[key]}")
-					
-					# Inspeccionar eventos
-					if 'events' in first_item:
-						events = first_item['events']
-						print(f"\nTipo de 'events': {type(events)}")
-						if isinstance(events, list) and len(events) > 0:
-							print(f"Primer evento: {events[0]}")
-							if isinstance(events[0], dict):
-								print(f"  Keys del primer evento: {list(events[0].keys())}")
-					
-					# Buscar cualquier campo que contenga 'time', 'interval', 'median', etc.
-					print(f"\n🔎 Búsqueda de campos relacionados con tiempo en el primer elemento:")
-					def search_time_fields(obj, path=""):
-						if isinstance(obj, dict):
-							for key, value in obj.items():
-								current_path = f"{path}.{key}" if path else key
-								if any(time_word in key.lower() for time_word in ['time', 'interval', 'median', 'average', 'mean', 'duration', 'step']):
-									print(f"  ⏱️  {current_path}: {value}")
-								if isinstance(value, (dict, list)):
-									search_time_fields(value, current_path)
-						elif isinstance(obj, list):
-							for i, item in enumerate(obj):
-								search_time_fields(item, f"{path}[{i}]")
-					
-					search_time_fields(first_item)
-			elif isinstance(data, dict):
-				print(f"\nTipo de 'data': dict")
-				print(f"Keys de 'data': {list(data.keys())}")
-		
-		print("="*80 + "\n")
-		# ============================================================
-		# FIN DIAGNÓSTICO
-		# ============================================================
+		fetch_info['payload_bytes'] = len(response.content)
+		return response.json()
+	
+	try:
+		response_store = get_response_store()
+		# OPTIMIZACIÓN: Store persistente - las ventanas cerradas se sirven desde disco incluso tras reinicios
+		response_json = response_store.get(cache_key)
+		from_store = response_json is not None
+		if not from_store:
+			# OPTIMIZACIÓN: Single-flight - si la misma query ya está en vuelo (otro hilo u otra sesión),
+			# esperar su resultado en lugar de repetir la request a Amplitude
+			response_json = single_flight(cache_key, _fetch_funnel)
 		
 		# Verificar si la API devolvió un error
 		if 'error' in response_json:
 			error_msg = response_json.get('error', 'Error desconocido de Amplitude')
 			error_details = response_json.get('errorDetails', '')
+			record_trace(started, 'funnel', 'error', experiment_id, variant, fingerprint=cache_key, error=str(error_msg))
 			raise ValueError(
 				f"🚨 API Error de Amplitude: {error_msg}\n"
 				f"Detalles: {error_details}\n"
@@ -948,13 +512,24 @@ def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experi
 			)
 		
 		# OPTIMIZACIÓN #2: Guardar en caché antes de retornar
-		_amplitude_cache[cache_key] = response_json
+		_amplitude_cache.put(cache_key, response_json, experiment_id)
+		if not from_store:
+			response_store.put(cache_key, response_json, params['end'])
 		
+		if started is not None:
+			# Sin payload propio, la respuesta vino de otra request idéntica en vuelo (single-flight)
+			outcome = 'store' if from_store else 'network' if fetch_info else 'shared'
+			record_trace(
+				started, 'funnel', outcome, experiment_id, variant,
+				payload_bytes=fetch_info.get('payload_bytes'), steps=count_steps(response_json), fingerprint=cache_key
+			)
 		return response_json
 		
 	except requests.exceptions.HTTPError as e:
 		# Error HTTP (4xx, 5xx)
+		response = e.response
 		error_msg = f"🚨 HTTP Error {response.status_code} de Amplitude"
+		record_trace(started, 'funnel', 'error', experiment_id, variant, fingerprint=cache_key, error=f"HTTP {response.status_code}")
 		try:
 			error_response = response.json()
 			if 'error' in error_response:
@@ -967,12 +542,308 @@ def get_funnel_data_experiment(api_key, secret_key, start_date, end_date, experi
 		)
 	except requests.exceptions.RequestException as e:
 		# Error de conexión, timeout, etc.
+		record_trace(started, 'funnel', 'error', experiment_id, variant, fingerprint=cache_key, error=str(e))
 		raise ValueError(
 			f"🚨 Error de conexión con Amplitude: {str(e)}\n"
 			f"Payload enviado: {json.dumps(params, indent=2)}"
 		)
 
 
+def _build_funnel_params(start_date, end_date, experiment_id, device, variants, culture, event_list, conversion_window, event_filters_map, flow_type, bundle_profile, trip_type, pax_adult_count, travel_group, country, include_time_data):
+	"""
+	Construye los parámetros de /api/2/funnels (eventos con filtros Ghost Anchor y segmentos).
+	
+	Args:
+		start_date, ..., include_time_data: Parámetros canónicos de la query (ver _fetch_funnel_data)
+		variants: Lista de variantes; cada una se envía como un valor de `s` (arreglo JSON con su filtro)
+		
+	Returns:
+		tuple: (params, event_filters_grouped, segmentation_filters); los eventos y filtros vienen
+		       del compilador de filtros y son compartidos: no modificarlos (copiar antes)
+	"""
+	# OPTIMIZACIÓN: Filtros compilados (amplitude_filters.compile_event_payloads) - el JSON de cada evento
+	# se arma una sola vez por combinación de filtros y las requests siguientes solo lo reutilizan
+	compiled_events = compile_event_payloads(
+		event_list, event_filters_map, device, culture, country,
+		flow_type, bundle_profile, trip_type, pax_adult_count, travel_group
+	)
+	
+	segments = [
+		{
+			'group_type': 'User',
+			'prop': f'gp:[Experiment] {experiment_id}',
+			'prop_type': 'user',
+			'op': 'is',
+			'type': 'property',
+			'values': [
+				variant,
+			],
+		}
+		# Un segmento por variante: Amplitude devuelve un elemento de 'data' por segmento, en el mismo orden
+		for variant in variants
+	]
+
+	# Normalizar fechas con precisión horaria para la API de Amplitude
+	start_date_formatted = normalize_date_for_amplitude(start_date, default_time="00:00:00", is_end_date=False)
+	end_date_formatted = normalize_date_for_amplitude(end_date, default_time="00:00:00", is_end_date=True)
+	
+	params = {
+		'e': list(compiled_events.payloads),
+		'start': start_date_formatted,
+		'end': end_date_formatted,
+		'cs': conversion_window,
+		# Cada `s` es un arreglo JSON de filtros de segmento (uno por variante, como en el formato original)
+		's': [json.dumps([segment]) for segment in segments],
+		
+	}
+	
+	# Si se solicita tiempo de conversión, agregar parámetro view
+	if include_time_data:
+		params['view'] = 'time_to_convert'
+
+	return params, list(compiled_events.events), list(compiled_events.segmentation_filters)
+
+
+def _record_batch_stat(key, amount=1):
+    with _batch_stats_lock:
+        _batch_stats[key] += amount
+
+
+def get_funnel_batch_stats():
+    """
+    Estadísticas del modo multi-variante (requests agrupadas, variantes servidas y fallbacks).
+
+    Returns:
+        dict: Copia de los contadores
+    """
+    with _batch_stats_lock:
+        return dict(_batch_stats)
+
+
+def fetch_funnel_variants_batch(api_key, secret_key, start_date, end_date, experiment_id, device, variants, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, include_time_data=False, grouped_breakdown=None):
+    """
+    Obtiene el funnel de varias variantes con una sola request a Amplitude.
+    
+    Cada variante viaja como un segmento de `s` y la respuesta (un elemento de `data` por
+    segmento, en el mismo orden) se separa en una respuesta por variante, que se guarda en
+    la caché en memoria y en el store con el fingerprint de su query individual; así
+    get_funnel_data_experiment la reutiliza sin volver a llamar a la API.
+    
+    Args:
+        api_key, secret_key: Credenciales de Amplitude
+        variants: Lista de variantes a consultar
+        start_date, ..., include_time_data, grouped_breakdown: Igual que get_funnel_data_experiment
+        
+    Returns:
+        dict: {variante: respuesta JSON} solo para las variantes resueltas (caché o request
+              agrupada). Las variantes ausentes deben pedirse por separado (fallback).
+    """
+    response_store = get_response_store()
+    resolved = {}
+    pending = []  # [(variante, query canónica, fingerprint)]
+    for variant in variants:
+        query = canonicalize_funnel_query(
+            start_date, end_date, experiment_id, device, variant, culture, event_list,
+            conversion_window, event_filters_map, flow_type, bundle_profile, trip_type,
+            pax_adult_count, travel_group, country, hidden_first_step, include_time_data
+        )
+        fingerprint = fingerprint_query(query, scope=_cache_scope(api_key, grouped_breakdown))
+        cached = _amplitude_cache.get(fingerprint)
+        if cached is None:
+            cached = response_store.get(fingerprint)
+            if cached is not None:
+                _amplitude_cache.put(fingerprint, cached, experiment_id)
+        if cached is not None:
+            resolved[variant] = cached
+        else:
+            pending.append((variant, query, fingerprint))
+    _record_batch_stat('variants_from_cache', len(resolved))
+
+    # Las métricas compuestas hacen sus propias sub-queries; con una sola variante no hay nada que agrupar
+    if len(pending) < 2 or get_composite(event_list, event_filters_map) is not None:
+        return resolved
+
+    query = pending[0][1]
+    params, _, _ = _build_funnel_params(
+        query['start_date'], query['end_date'], query['experiment_id'], query['device'],
+        [variant for variant, _, _ in pending], query['culture'], query['event_list'],
+        query['conversion_window'], query['event_filters_map'], query['flow_type'],
+        query['bundle_profile'], query['trip_type'], query['pax_adult_count'],
+        query['travel_group'], query['country'], query['include_time_data']
+    )
+    if len(urlencode(params, doseq=True)) > BATCH_MAX_QUERY_CHARS:
+        _record_batch_stat('fallbacks_too_large')
+        return resolved
+
+    fetch_info = {}
+
+    def _fetch_batch():
+        response = get_amplitude_client().get(AMPLITUDE_FUNNELS_URL, params=params, auth=HTTPBasicAuth(api_key, secret_key))
+        response.raise_for_status()
+        fetch_info['payload_bytes'] = len(response.content)
+        return response.json()
+
+    batch_key = fingerprint_query({'batch': [fingerprint for _, _, fingerprint in pending]}, scope=_cache_scope(api_key, grouped_breakdown))
+    started = trace_start()
+    try:
+        response_json = single_flight(batch_key, _fetch_batch)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        record_trace(started, 'batch', 'error', experiment_id, f"{len(pending)} variantes", fingerprint=batch_key, error=str(e))
+        print(f"⚠️ Request multi-variante falló ({e}); se usan requests por variante")
+        _record_batch_stat('fallbacks_error')
+        return resolved
+
+    data = response_json.get('data') if isinstance(response_json, dict) else None
+    if 'error' in (response_json or {}) or not isinstance(data, list) or len(data) != len(pending):
+        print("⚠️ Respuesta multi-variante inesperada; se usan requests por variante")
+        _record_batch_stat('fallbacks_error')
+        return resolved
+
+    for (variant, _, fingerprint), website in zip(pending, data):
+        variant_json = {**response_json, 'data': [website]}
+        _amplitude_cache.put(fingerprint, variant_json, experiment_id)
+        response_store.put(fingerprint, variant_json, params['end'])
+        resolved[variant] = variant_json
+    _record_batch_stat('batched_requests')
+    _record_batch_stat('variants_batched', len(pending))
+    if started is not None:
+        record_trace(
+            started, 'batch', 'network' if fetch_info else 'shared', experiment_id, f"{len(pending)} variantes",
+            payload_bytes=fetch_info.get('payload_bytes'), steps=count_steps(response_json), fingerprint=batch_key
+        )
+    return resolved
+
+
+def _segment_query(call_params, variant):
+    """Query canónica que get_all_variants_raw_data arma para una variante con los parámetros de final_pipeline."""
+    return canonicalize_funnel_query(
+        call_params['start_date'], call_params['end_date'], call_params['experiment_id'],
+        call_params.get('device', 'ALL'), variant, call_params.get('culture', 'ALL'), call_params['event_list'],
+        call_params.get('conversion_window', 1800), call_params.get('event_filters_map'),
+        call_params.get('flow_type', 'ALL'), call_params.get('bundle_profile', 'ALL'),
+        call_params.get('trip_type', 'ALL'), call_params.get('pax_adult_count', 'ALL'),
+        call_params.get('travel_group', 'ALL'), call_params.get('country'),
+        call_params.get('hidden_first_step', False), False
+    )
+
+
+def get_grouped_breakdown(breakdown, segment_params):
+    """
+    Indica si un desglose se resuelve con group-by (prefetch_segment_breakdown).
+    
+    Args:
+        breakdown: Nombre del desglose ('Device', 'Culture', 'Country', ...)
+        segment_params: {segmento: kwargs de final_pipeline / final_pipeline_cumulative para ese segmento}
+        
+    Returns:
+        str | None: El desglose, para pasarlo como grouped_breakdown a final_pipeline de cada
+                    segmento, o None si el desglose no se puede empujar (propiedades de
+                    evento como Culture, Flight Profile, Travel Group, filtros explícitos
+                    sobre la propiedad, métricas compuestas)
+    """
+    if not BREAKDOWN_PUSHDOWN_ENABLED or not segment_params:
+        return None
+    segments = list(segment_params)
+    base_params = segment_params[segments[0]]
+    if get_breakdown_group_by(breakdown, segments, base_params.get('event_filters_map')) is None:
+        return None
+    if get_composite(base_params.get('event_list'), base_params.get('event_filters_map')) is not None:
+        return None
+    return breakdown
+
+
+def prefetch_segment_breakdown(breakdown, segment_params):
+    """
+    Resuelve un desglose por segmento con una query agrupada (group-by) por variante.
+    
+    OPTIMIZACIÓN: En lugar de una request por (variante, segmento), cada variante hace una sola
+    request agrupada (parámetro `g`) por la propiedad del desglose; la respuesta se
+    reparte en los buckets de la UI (segment_breakdown) y cada bucket se guarda en la caché en
+    memoria y en el store con el fingerprint de su query por segmento, en el scope del desglose
+    agrupado: un group-by asigna a cada usuario un solo grupo, así que el bucket no equivale a
+    la query filtrada y solo lo leen final_pipeline / final_pipeline_cumulative llamados con
+    grouped_breakdown (ver get_grouped_breakdown), y solo para los segmentos devueltos. Si el
+    desglose no se puede empujar o la request de una variante falla, esos segmentos usan su
+    query normal (sin grouped_breakdown, así reutilizan la caché del análisis).
+    
+    Args:
+        breakdown: Nombre del desglose ('Device', 'Culture', 'Country', ...)
+        segment_params: {segmento: kwargs de final_pipeline / final_pipeline_cumulative para ese segmento}
+        
+    Returns:
+        set: Segmentos con todas sus variantes en la caché del desglose agrupado
+    """
+    if get_grouped_breakdown(breakdown, segment_params) is None:
+        return set()
+    segments = list(segment_params)
+    base_params = segment_params[segments[0]]
+    param, group_by = get_breakdown_group_by(breakdown, segments, base_params.get('event_filters_map'))
+
+    # La query agrupada es la del segmento sin el filtro de la dimensión desglosada
+    neutral_params = {**base_params, param: None if param == 'country' else 'ALL'}
+    experiment_id = base_params['experiment_id']
+    if base_params.get('active_variants') is not None:
+        variants = list(base_params['active_variants'])
+    else:
+        variants = get_experiment_variants(experiment_id)
+    api_key, secret_key, _ = get_credentials()
+    scope = _cache_scope(api_key, breakdown)
+    response_store = get_response_store()
+
+    def _prefetch_variant(variant):
+        fingerprints = {
+            segment: fingerprint_query(_segment_query(params, variant), scope=scope)
+            for segment, params in segment_params.items()
+        }
+        missing = [
+            segment for segment, fingerprint in fingerprints.items()
+            if _amplitude_cache.get(fingerprint) is None and not response_store.contains(fingerprint)
+        ]
+        if not missing:
+            return 0
+
+        query = _segment_query(neutral_params, variant)
+        params, _, _ = _build_funnel_params(
+            query['start_date'], query['end_date'], query['experiment_id'], query['device'],
+            [variant], query['culture'], query['event_list'], query['conversion_window'],
+            query['event_filters_map'], query['flow_type'], query['bundle_profile'],
+            query['trip_type'], query['pax_adult_count'], query['travel_group'],
+            query['country'], query['include_time_data']
+        )
+        # Agrupar por la propiedad de usuario del desglose (los eventos compilados no se tocan)
+        params['g'] = group_by
+        params['limit'] = GROUP_BY_LIMIT
+
+        def _fetch_grouped():
+            response = get_amplitude_client().get(AMPLITUDE_FUNNELS_URL, params=params, auth=HTTPBasicAuth(api_key, secret_key))
+            response.raise_for_status()
+            return response.json()
+
+        grouped_key = fingerprint_query({'group_by': group_by, 'query': query}, scope=scope)
+        response_json = single_flight(grouped_key, _fetch_grouped)
+        if 'error' in response_json:
+            raise ValueError(f"API Error de Amplitude: {response_json.get('error')}")
+        _record_batch_stat('breakdown_grouped_requests')
+
+        for segment, segment_json in split_grouped_response(response_json, breakdown, missing).items():
+            _amplitude_cache.put(fingerprints[segment], segment_json, experiment_id)
+            response_store.put(fingerprints[segment], segment_json, params['end'])
+        _record_batch_stat('breakdown_segments_served', len(missing))
+        return len(missing)
+
+    # Un segmento solo se sirve del desglose agrupado si todas sus variantes quedaron en esa caché
+    grouped_segments = set(segments)
+    scheduler = get_task_scheduler()
+    future_to_variant = {scheduler.submit(_prefetch_variant, variant): variant for variant in variants}
+    for future in scheduler.as_completed(future_to_variant):
+        try:
+            future.result()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"⚠️ Desglose agrupado falló para {future_to_variant[future]} ({e}); se usan queries por segmento")
+            _record_batch_stat('breakdown_fallbacks')
+            grouped_segments.clear()
+    return grouped_segments
+
 def get_variant_funnel(variant):
     """
     Procesa los datos de una variante y genera un DataFrame con datos diarios.
@@ -995,15 +866,6 @@ def get_variant_funnel(variant):
             - Variant: Variante
             - Event Count: Cantidad de eventos
     """
-    
-    df = pd.DataFrame({
-        'Date': [],
-        'ExperimentID': [],
-        'Culture': [],
-        'Device': [],
-        'Variant': [],
-        'Event Count': []
-    })
 
     variant_data = variant.get('Data', {})
     
@@ -1046,34 +908,16 @@ def get_variant_funnel(variant):
     elif isinstance(variant_data['data'], dict):
         websites = [variant_data['data']]
     else:
-        return df
-
-    for website_funnel in websites:
-        funnel_website_conversion_data = website_funnel['dayFunnels']['series']
-        funnel_stages = website_funnel['events']
-        dates = website_funnel['dayFunnels']['xValues']
-
-        for date, data in zip(dates, funnel_website_conversion_data):
-            for funnel_stage, value in zip(funnel_stages, data):
-                # Si el paso viene como dict de Amplitude, tomar el nombre
-                if isinstance(funnel_stage, dict):
-                    stage_name = funnel_stage.get('event_type', str(funnel_stage))
-                else:
-                    stage_name = funnel_stage
-                
-                new_row = {
-                    'Date': pd.to_datetime(date),
-                    'ExperimentID': variant['ExperimentID'],
-                    'Funnel Stage': stage_name,
-                    'Culture': variant['Culture'],
-                    'Device': variant['Device'],
-                    'Variant': variant['Variant'],
-                    'Event Count': int(value)
-                }
-
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    
-    return df
+        websites = []
+
+    # OPTIMIZACIÓN: Parser columnar (NumPy) en lugar de un pd.concat por fila
+    return parse_daily_funnel(
+        websites,
+        variant['ExperimentID'],
+        variant['Culture'],
+        variant['Device'],
+        variant['Variant'],
+    )
 
 
 def get_variant_funnel_cum(variant, actual_start_date=None, actual_end_date=None):
@@ -1101,17 +945,6 @@ def get_variant_funnel_cum(variant, actual_start_date=None, actual_end_date=None
             - Funnel Stage: Paso del funnel
             - Event Count: Cantidad acumulada de eventos
     """
-    
-    df = pd.DataFrame({
-        'Start Date': [],
-        'End Date': [],
-        'ExperimentID': [],
-        'Culture': [],
-        'Device': [],
-        'Variant': [],
-        'Funnel Stage': [],
-        'Event Count': []
-    })
 
     variant_data = variant.get('Data', {})
     
@@ -1154,63 +987,19 @@ def get_variant_funnel_cum(variant, actual_start_date=None, actual_end_date=None
     elif isinstance(variant_data['data'], dict):
         websites = [variant_data['data']]
     else:
-        return df
-
-    for website_funnel in websites:
-        # Usar las fechas exactas de la query en lugar de x_values
-        if actual_start_date is not None:
-            # Convertir a datetime si es string
-            if isinstance(actual_start_date, str):
-                start_date_filter = pd.to_datetime(actual_start_date)
-            else:
-                start_date_filter = pd.to_datetime(actual_start_date)
-        else:
-            # Fallback: usar x_values si no se proporciona actual_start_date
-            day_funnels = website_funnel.get('dayFunnels', {})
-            x_values = day_funnels.get('xValues', [])
-            start_date_filter = pd.to_datetime(x_values[0]) if x_values else None
-        
-        if actual_end_date is not None:
-            # Convertir a datetime si es string
-            if isinstance(actual_end_date, str):
-                end_date_filter = pd.to_datetime(actual_end_date)
-            else:
-                end_date_filter = pd.to_datetime(actual_end_date)
-        else:
-            # Fallback: usar x_values si no se proporciona actual_end_date
-            day_funnels = website_funnel.get('dayFunnels', {})
-            x_values = day_funnels.get('xValues', [])
-            end_date_filter = pd.to_datetime(x_values[-1]) if x_values else None
-
-        # Pasos del funnel y acumulados
-        funnel_stages = website_funnel.get('events', [])
-        cumulative_raw = website_funnel.get('cumulativeRaw', [])
-
-        # Validaciones mínimas
-        if not cumulative_raw or not funnel_stages:
-            continue
-
-        # Alinear cada paso con su acumulado
-        for funnel_stage, value in zip(funnel_stages, cumulative_raw):
-            # Si el paso viene como dict de Amplitude, tomar el nombre
-            if isinstance(funnel_stage, dict):
-                stage_name = funnel_stage.get('event_type', str(funnel_stage))
-            else:
-                stage_name = funnel_stage
-
-            new_row = {
-                'Start Date': start_date_filter,
-                'End Date': end_date_filter,
-                'ExperimentID': variant['ExperimentID'],
-                'Culture': variant['Culture'],
-                'Device': variant['Device'],
-                'Variant': variant['Variant'],
-                'Funnel Stage': stage_name,
-                'Event Count': int(value)
-            }
-            df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-
-    return df
+        websites = []
+
+    # OPTIMIZACIÓN: Parser columnar (NumPy) en lugar de un pd.concat por fila.
+    # Se usan las fechas exactas de la query (con hora) en lugar de xValues si se proporcionan.
+    return parse_cumulative_funnel(
+        websites,
+        variant['ExperimentID'],
+        variant['Culture'],
+        variant['Device'],
+        variant['Variant'],
+        actual_start_date=actual_start_date,
+        actual_end_date=actual_end_date,
+    )
 
 
 def get_control_treatment_raw_data(
@@ -1321,8 +1110,8 @@ def get_control_treatment_raw_data(
     return control, treatment
 
 
-@st.cache_data(persist="disk", show_spinner=False, ttl=86400)
-def final_pipeline(start_date, end_date, experiment_id, device, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, active_variants=None):
+@arrow_cached
+def final_pipeline(start_date, end_date, experiment_id, device, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, active_variants=None, grouped_breakdown=None, _deadline=None):
     """
     Pipeline completo para análisis de experimentos AB Test.
     Si se pasa active_variants, solo se solicitan datos a la API para esas variantes (evita variantes fantasma).
@@ -1335,28 +1124,34 @@ def final_pipeline(start_date, end_date, experiment_id, device, culture, event_l
         country: Filtro de país (propiedad nativa Amplitude)
         hidden_first_step: Si es True, aplica "Inmunidad Contextual" en el paso 0 (ancla)
         active_variants: Opcional. Tuple o lista de variantes a incluir; si es None, se usan todas.
+        grouped_breakdown: Opcional. Desglose resuelto con group-by (ver prefetch_segment_breakdown);
+                           sus resultados se cachean aparte de los del análisis normal
+        _deadline: Opcional. Deadline del análisis (src/utils/deadline.py); no forma parte de la clave de caché
 
     Returns:
         pd.DataFrame: DataFrame combinado con datos de las variantes (activas o todas)
     """
-    all_variants_data = get_all_variants_raw_data(
-        start_date,
-        end_date,
-        experiment_id,
-        device,
-        culture,
-        event_list,
-        conversion_window,
-        event_filters_map,
-        flow_type,
-        bundle_profile,
-        trip_type,
-        pax_adult_count,
-        travel_group=travel_group,
-        country=country,
-        hidden_first_step=hidden_first_step,
-        active_variants=active_variants,
-    )
+    # El deadline del análisis (si hay) se propaga a las requests y a los hilos de get_all_variants_raw_data
+    with deadline_scope(_deadline):
+        all_variants_data = get_all_variants_raw_data(
+            start_date,
+            end_date,
+            experiment_id,
+            device,
+            culture,
+            event_list,
+            conversion_window,
+            event_filters_map,
+            flow_type,
+            bundle_profile,
+            trip_type,
+            pax_adult_count,
+            travel_group=travel_group,
+            country=country,
+            hidden_first_step=hidden_first_step,
+            active_variants=active_variants,
+            grouped_breakdown=grouped_breakdown,
+        )
 
     # Procesar cada variante
     all_dataframes = []
@@ -1445,11 +1240,11 @@ def get_variant_volumes_overall(
             return variant, 0
 
     volumes = {}
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_v = {executor.submit(_volume_for_variant, v): v for v in variants}
-        for future in as_completed(future_to_v):
-            v, count = future.result()
-            volumes[v] = count
+    scheduler = get_task_scheduler()
+    future_to_v = {scheduler.submit(_volume_for_variant, v): v for v in variants}
+    for future in scheduler.as_completed(future_to_v):
+        v, count = future.result()
+        volumes[v] = count
     return volumes
 
 
@@ -1489,12 +1284,16 @@ def filter_active_variants(
     return active
 
 
-def get_experiments_list():
+def _load_experiments_page(cursor=None, etag=None):
     """
-    Obtiene la lista de todos los experimentos disponibles en Amplitude.
+    Descarga una página de la lista de experimentos de la Management API (loader del catálogo).
     
+    Args:
+        cursor: Cursor de la página (nextCursor de la página anterior) o None para la primera
+        etag: ETag del snapshot actual; si la API responde 304, la lista no cambió
+        
     Returns:
-        pd.DataFrame: DataFrame con la información de todos los experimentos
+        tuple: (respuesta JSON o None si no hubo cambios, ETag de la respuesta)
         
     Raises:
         ValueError: Si las credenciales no están disponibles o la respuesta es inválida
@@ -1514,19 +1313,26 @@ def get_experiments_list():
         'Accept': 'application/json',
         'Authorization': f'Bearer {management_api_key}',
     }
+    if etag:
+        headers['If-None-Match'] = etag
 
     params = {
-        'limit': '1000',
+        'limit': str(EXPERIMENTS_PAGE_SIZE),
     }
+    if cursor:
+        params['cursor'] = cursor
 
     try:
-        response = requests.get(
-            'https://experiment.amplitude.com/api/1/experiments', 
+        response = get_amplitude_client().get(
+            AMPLITUDE_EXPERIMENTS_URL,
             params=params, 
             headers=headers,
             timeout=30
         )
         
+        if response.status_code == 304:
+            return None, etag
+        
         # Verificar el status code
         response.raise_for_status()
         
@@ -1555,18 +1361,48 @@ def get_experiments_list():
                 f"Response text (primeros 500 caracteres): {response.text[:500]}"
             )
         
-        return pd.DataFrame(data['experiments'])
+        return data, response.headers.get('ETag')
         
     except requests.exceptions.RequestException as e:
         raise requests.exceptions.RequestException(
             f"Error al realizar la petición a la API de Amplitude: {str(e)}\n"
-            f"URL: https://experiment.amplitude.com/api/1/experiments"
+            f"URL: {AMPLITUDE_EXPERIMENTS_URL}"
         )
 
 
+# OPTIMIZACIÓN: Catálogo de experimentos compartido por el proceso (índice por key, refresco por TTL)
+_experiment_catalog = ExperimentCatalog(_load_experiments_page)
+
+
+def get_experiment_catalog_stats():
+    """
+    Estadísticas del catálogo de experimentos (tamaño, antigüedad, refrescos).
+
+    Returns:
+        dict: Contadores del catálogo
+    """
+    return _experiment_catalog.get_stats()
+
+
+def get_experiments_list():
+    """
+    Obtiene la lista de todos los experimentos disponibles en Amplitude.
+    OPTIMIZACIÓN: Se sirve desde el catálogo en memoria (sin request mientras el snapshot es vigente).
+    
+    Returns:
+        pd.DataFrame: DataFrame con la información de todos los experimentos
+        
+    Raises:
+        ValueError: Si las credenciales no están disponibles o la respuesta es inválida
+        requests.RequestException: Si hay un error en la petición HTTP
+    """
+    return _experiment_catalog.get_experiments_frame()
+
+
 def get_experiment_variants(experiment_id):
     """
     Obtiene las variantes de un experimento específico.
+    OPTIMIZACIÓN: Lectura O(1) del catálogo en memoria.
     
     Args:
         experiment_id (str): ID del experimento
@@ -1574,88 +1410,15 @@ def get_experiment_variants(experiment_id):
     Returns:
         list: Lista de nombres de variantes del experimento CON GUIONES
     """
-    # Obtener credenciales
-    _, _, management_api_key = get_credentials()
-    
-    if not management_api_key:
-        raise ValueError(
-            "AMPLITUDE_MANAGEMENT_KEY no está configurada. "
-            "Por favor, verifica tus variables de entorno."
-        )
-    
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {management_api_key}',
-    }
-
-    params = {
-        'limit': '1000',
-    }
-
-    try:
-        response = requests.get(
-            'https://experiment.amplitude.com/api/1/experiments', 
-            params=params, 
-            headers=headers,
-            timeout=30
-        )
-        
-        response.raise_for_status()
-        
-        if not response.text or not response.text.strip():
-            raise ValueError(
-                f"La respuesta de la API está vacía. "
-                f"Status code: {response.status_code}"
-            )
-        
-        try:
-            data = json.loads(response.text)
-        except json.JSONDecodeError as e:
-            raise ValueError(
-                f"Error al parsear la respuesta JSON: {str(e)}\n"
-                f"Status code: {response.status_code}\n"
-                f"Response text (primeros 500 caracteres): {response.text[:500]}"
-            )
-        
-        if 'experiments' not in data:
-            raise ValueError(
-                f"La respuesta no contiene la clave 'experiments'. "
-                f"Claves disponibles: {list(data.keys())}"
-            )
-        
-        experiments = data['experiments']
-        
-        # Buscar el experimento específico
-        for exp in experiments:
-            if exp.get('key') == experiment_id:
-                variants = exp.get('variants', [])
-                variant_names = []
-                
-                
-                for variant in variants:
-                    if isinstance(variant, dict):
-                        name = variant.get('name', variant.get('key', str(variant)))
-                    else:
-                        name = str(variant)
-                    
-                    # SIMPLE: Reemplazar espacios por guiones
-                    processed_name = name.replace(' ', '-')
-                    variant_names.append(processed_name)
-                
-                return variant_names
-        
-        # Si no se encuentra el experimento, retornar variantes por defecto
-        return ['control', 'treatment']
-        
-    except requests.exceptions.RequestException as e:
-        raise requests.exceptions.RequestException(
-            f"Error al realizar la petición a la API de Amplitude: {str(e)}"
-        )
+    variants = _experiment_catalog.get_variants(experiment_id)
+    # Si no se encuentra el experimento, retornar variantes por defecto
+    return variants if variants is not None else ['control', 'treatment']
 
 
 def get_experiment_variants_original(experiment_id):
     """
     Obtiene las variantes originales (sin procesar) de un experimento específico.
+    OPTIMIZACIÓN: Lectura O(1) del catálogo en memoria.
     
     Args:
         experiment_id (str): ID del experimento
@@ -1663,85 +1426,11 @@ def get_experiment_variants_original(experiment_id):
     Returns:
         list: Lista de nombres originales de variantes del experimento
     """
-    # Obtener credenciales
-    _, _, management_api_key = get_credentials()
-    
-    if not management_api_key:
-        raise ValueError(
-            "AMPLITUDE_MANAGEMENT_KEY no está configurada. "
-            "Por favor, verifica tus variables de entorno."
-        )
-    
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {management_api_key}',
-    }
-
-    params = {
-        'limit': '1000',
-    }
-
-    try:
-        response = requests.get(
-            'https://experiment.amplitude.com/api/1/experiments', 
-            params=params, 
-            headers=headers,
-            timeout=30
-        )
-        
-        response.raise_for_status()
-        
-        if not response.text or not response.text.strip():
-            raise ValueError(
-                f"La respuesta de la API está vacía. "
-                f"Status code: {response.status_code}"
-            )
-        
-        try:
-            data = json.loads(response.text)
-        except json.JSONDecodeError as e:
-            raise ValueError(
-                f"Error al parsear la respuesta JSON: {str(e)}\n"
-                f"Status code: {response.status_code}\n"
-                f"Response text (primeros 500 caracteres): {response.text[:500]}"
-            )
-        
-        if 'experiments' not in data:
-            raise ValueError(
-                f"La respuesta no contiene la clave 'experiments'. "
-                f"Claves disponibles: {list(data.keys())}"
-            )
-        
-        experiments = data['experiments']
-        
-        # Buscar el experimento específico
-        for exp in experiments:
-            if exp.get('key') == experiment_id:
-                variants = exp.get('variants', [])
-                variant_names = []
-                
-                
-                for variant in variants:
-                    if isinstance(variant, dict):
-                        # Extraer el nombre original de la variante (sin procesar)
-                        name = variant.get('name', variant.get('key', str(variant)))
-                        variant_names.append(name)
-                    else:
-                        # Usar el nombre original (sin procesar)
-                        variant_names.append(str(variant))
-                
-                return variant_names
-        
-        # Si no se encuentra el experimento, retornar variantes por defecto
-        return ['control', 'treatment']
-        
-    except requests.exceptions.RequestException as e:
-        raise requests.exceptions.RequestException(
-            f"Error al realizar la petición a la API de Amplitude: {str(e)}"
-        )
+    variants = _experiment_catalog.get_variants(experiment_id, original=True)
+    # Si no se encuentra el experimento, retornar variantes por defecto
+    return variants if variants is not None else ['control', 'treatment']
 
 
-@st.cache_data(persist="disk", show_spinner=False, ttl=86400)
 def get_all_variants_raw_data(
     start_date,
     end_date,
@@ -1760,6 +1449,7 @@ def get_all_variants_raw_data(
     hidden_first_step=False,
     include_time_data=False,
     active_variants=None,
+    grouped_breakdown=None,
 ):
     """
     Obtiene los datos raw de las variantes activas de un experimento.
@@ -1781,6 +1471,7 @@ def get_all_variants_raw_data(
         include_time_data: Si se incluyen datos de tiempo de conversión
         active_variants: Opcional. Tuple o lista de nombres de variantes a consultar.
                          Si es None, se consultan todas las variantes del experimento.
+        grouped_breakdown: Opcional. Desglose resuelto con group-by (scope de caché propio)
 
     Returns:
         list: Lista de diccionarios con datos de cada variante (solo variantes activas si se pasó active_variants)
@@ -1794,7 +1485,7 @@ def get_all_variants_raw_data(
     # Obtener credenciales
     api_key, secret_key, _ = get_credentials()
     
-    # OPTIMIZACIÓN #1: Paralelización de requests con ThreadPoolExecutor
+    # OPTIMIZACIÓN #1: Paralelización de requests en el planificador de tareas compartido
     # Hacer todas las requests a Amplitude en paralelo en lugar de secuencial
     # Esto reduce el tiempo de espera de N×5seg a ~5seg (donde N es el número de variantes)
     
@@ -1819,7 +1510,8 @@ def get_all_variants_raw_data(
             travel_group,
             country,
             hidden_first_step,
-            include_time_data
+            include_time_data,
+            grouped_breakdown=grouped_breakdown,
         )
         
         return {
@@ -1830,36 +1522,69 @@ def get_all_variants_raw_data(
             'Variant': variant
         }
     
-    # Ejecutar requests en paralelo usando ThreadPoolExecutor
-    # max_workers=2: Limitar concurrencia para no superar límite de Amplitude (5 concurrent) en desgloses por segmento
-    all_variants_data = []
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        # Crear futures para cada variante
-        future_to_variant = {executor.submit(fetch_variant_data, variant): variant for variant in variants}
-        
-        # Recopilar resultados a medida que completan
-        for future in as_completed(future_to_variant):
-            variant = future_to_variant[future]
-            try:
-                variant_data = future.result()
-                all_variants_data.append(variant_data)
-            except Exception as e:
-                # Si una variante falla, agregar error en lugar de fallar todo
-                print(f"⚠️ Error obteniendo datos para variante {variant}: {e}")
-                # Agregar datos vacíos para no romper el análisis
-                all_variants_data.append({
-                    'Data': {'error': str(e)},
-                    'ExperimentID': experiment_id,
-                    'Culture': culture,
-                    'Device': device,
-                    'Variant': variant
-                })
+    # OPTIMIZACIÓN: Una sola request multi-segmento para todas las variantes; las que no se
+    # resuelvan así (payload muy grande, error, métrica compuesta) se piden por separado
+    batched = {}
+    if BATCH_VARIANTS_ENABLED and len(variants) > 1:
+        try:
+            batched = fetch_funnel_variants_batch(
+                api_key, secret_key, start_date, end_date, experiment_id, device, variants,
+                culture, event_list, conversion_window, event_filters_map, flow_type,
+                bundle_profile, trip_type, pax_adult_count, travel_group, country,
+                hidden_first_step, include_time_data, grouped_breakdown
+            )
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Error en request multi-variante: {e}. Se usan requests por variante.")
+            batched = {}
+    
+    all_variants_data = [
+        {
+            'Data': batched[variant],
+            'ExperimentID': experiment_id,
+            'Culture': culture,
+            'Device': device,
+            'Variant': variant
+        }
+        for variant in variants if variant in batched
+    ]
+    remaining_variants = [variant for variant in variants if variant not in batched]
+    
+    # Ejecutar requests en paralelo: una tarea (métrica × variante) por variante pendiente en el
+    # planificador compartido. La concurrencia real contra Amplitude la limita el gobernador
+    # (amplitude_client), así que aquí solo se reparte el trabajo entre variantes
+    scheduler = get_task_scheduler()
+    future_to_variant = {scheduler.submit(fetch_variant_data, variant): variant for variant in remaining_variants}
+    
+    # Recopilar resultados a medida que completan
+    for future in scheduler.as_completed(future_to_variant):
+        variant = future_to_variant[future]
+        try:
+            variant_data = future.result()
+            all_variants_data.append(variant_data)
+        except DeadlineExceededError:
+            # Cancelar las variantes pendientes; la corrida incompleta no se cachea
+            for pending_future in future_to_variant:
+                scheduler.cancel(pending_future)
+            raise
+        except Exception as e:
+            # Si una variante falla, agregar error en lugar de fallar todo
+            print(f"⚠️ Error obteniendo datos para variante {variant}: {e}")
+            # Agregar datos vacíos para no romper el análisis
+            all_variants_data.append({
+                'Data': {'error': str(e)},
+                'ExperimentID': experiment_id,
+                'Culture': culture,
+                'Device': device,
+                'Variant': variant
+            })
     
     return all_variants_data
 
 
-@st.cache_data(persist="disk", show_spinner=False, ttl=86400)
-def final_pipeline_cumulative(start_date, end_date, experiment_id, device, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, active_variants=None):
+@arrow_cached
+def final_pipeline_cumulative(start_date, end_date, experiment_id, device, culture, event_list, conversion_window=1800, event_filters_map=None, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, hidden_first_step=False, active_variants=None, grouped_breakdown=None, _deadline=None):
     """
     Pipeline completo para análisis de experimentos AB Test con datos acumulados.
     Si se pasa active_variants, solo se solicitan datos a la API para esas variantes.
@@ -1867,30 +1592,34 @@ def final_pipeline_cumulative(start_date, end_date, experiment_id, device, cultu
     Args:
         start_date, end_date, experiment_id, device, culture, event_list: parámetros del análisis
         conversion_window, event_filters_map, flow_type, bundle_profile, trip_type,
-        pax_adult_count, travel_group, country, hidden_first_step: igual que final_pipeline
+        pax_adult_count, travel_group, country, hidden_first_step, grouped_breakdown: igual que final_pipeline
         active_variants: Opcional. Tuple o lista de variantes a incluir; si es None, se usan todas.
+        _deadline: Opcional. Deadline del análisis (src/utils/deadline.py); no forma parte de la clave de caché
 
     Returns:
         pd.DataFrame: DataFrame combinado con datos acumulados de las variantes (activas o todas)
     """
-    all_variants_data = get_all_variants_raw_data(
-        start_date,
-        end_date,
-        experiment_id,
-        device,
-        culture,
-        event_list,
-        conversion_window,
-        event_filters_map,
-        flow_type,
-        bundle_profile,
-        trip_type,
-        pax_adult_count,
-        travel_group,
-        country=country,
-        hidden_first_step=hidden_first_step,
-        active_variants=active_variants,
-    )
+    # El deadline del análisis (si hay) se propaga a las requests y a los hilos de get_all_variants_raw_data
+    with deadline_scope(_deadline):
+        all_variants_data = get_all_variants_raw_data(
+            start_date,
+            end_date,
+            experiment_id,
+            device,
+            culture,
+            event_list,
+            conversion_window,
+            event_filters_map,
+            flow_type,
+            bundle_profile,
+            trip_type,
+            pax_adult_count,
+            travel_group,
+            country=country,
+            hidden_first_step=hidden_first_step,
+            active_variants=active_variants,
+            grouped_breakdown=grouped_breakdown,
+        )
 
     # Procesar cada variante con datos acumulados
     all_dataframes = []
@@ -1907,3 +1636,61 @@ def final_pipeline_cumulative(start_date, end_date, experiment_id, device, cultu
 
     return df_final
 
+
+def run_planned_funnel_query(planned_query, start_date, end_date, experiment_id, device, culture, conversion_window=1800, flow_type="ALL", bundle_profile="ALL", trip_type="ALL", pax_adult_count="ALL", travel_group="ALL", country=None, active_variants=None, use_cumulative=False, _deadline=None):
+    """
+    Ejecuta una query del plan de query_planner.plan_funnel_queries y reparte los conteos.
+
+    Se consulta una sola vez el funnel del carrier (una request por variante) y cada
+    métrica miembro recibe los primeros n_steps pasos de la respuesta, procesados igual
+    que en final_pipeline / final_pipeline_cumulative.
+
+    Args:
+        planned_query: Elemento de plan['queries'] ({'metric': carrier, 'members': [...]})
+        start_date, ..., active_variants: Igual que final_pipeline
+        use_cumulative: Si True, arma DataFrames acumulados (final_pipeline_cumulative)
+        _deadline: Opcional. Deadline del análisis
+
+    Returns:
+        dict: {nombre de métrica: pd.DataFrame}; si una métrica falla, su DataFrame queda vacío
+
+    Raises:
+        DeadlineExceededError: Si vence el deadline antes de obtener el funnel del carrier
+    """
+    carrier = planned_query['metric']
+    # El deadline del análisis (si hay) se propaga a las requests y a los hilos de get_all_variants_raw_data
+    with deadline_scope(_deadline):
+        all_variants_data = get_all_variants_raw_data(
+            start_date,
+            end_date,
+            experiment_id,
+            device,
+            culture,
+            carrier['events'],
+            conversion_window,
+            carrier.get('filters') or None,
+            flow_type,
+            bundle_profile,
+            trip_type,
+            pax_adult_count,
+            travel_group=travel_group,
+            country=country,
+            hidden_first_step=carrier.get('hidden_first_step', False),
+            active_variants=active_variants,
+        )
+
+    results = {}
+    for member in planned_query['members']:
+        try:
+            all_dataframes = []
+            for variant_data in all_variants_data:
+                member_variant = {**variant_data, 'Data': truncate_funnel_response(variant_data.get('Data', {}), member['n_steps'])}
+                if use_cumulative:
+                    all_dataframes.append(get_variant_funnel_cum(member_variant, actual_start_date=start_date, actual_end_date=end_date))
+                else:
+                    all_dataframes.append(get_variant_funnel(member_variant))
+            results[member['name']] = pd.concat(all_dataframes, axis=0, ignore_index=True) if all_dataframes else pd.DataFrame()
+        except Exception as e:
+            print(f"[Error interno] Error procesando métrica '{member['name']}': {str(e)}")
+            results[member['name']] = pd.DataFrame()
+    return results
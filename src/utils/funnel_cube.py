@@ -0,0 +1,318 @@
+"""
+Cubo de funnels para los resultados del análisis.
+
+Guarda los conteos enteros de todas las métricas en un único array de NumPy con
+dimensiones (métrica, segmento, variante, fecha, paso). Cada dimensión tiene un
+índice categórico (etiqueta -> posición), así que las consultas de la pestaña de
+estadísticas son indexaciones directas en lugar de filtros con máscaras booleanas
+sobre DataFrames en formato largo. Los slices con etiquetas escalares o rangos
+devuelven vistas (sin copia) y la conversión a DataFrame o Arrow se hace a demanda.
+
+En datos acumulados (final_pipeline_cumulative) la dimensión fecha tiene un único
+valor por período (la 'Start Date'); en datos diarios, una posición por día.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_SEGMENT = 'ALL'
+
+
+class FunnelCube:
+    """
+    Conteos de funnel indexados por métrica × segmento × variante × fecha × paso.
+
+    Los pasos son posicionales (0..K-1) y cada métrica tiene sus propios nombres de
+    paso (step_names[métrica]). `present` marca qué celdas venían en los datos, para
+    distinguir "sin datos" de un conteo 0.
+    """
+
+    DIMENSIONS = ('metric', 'segment', 'variant', 'date', 'step')
+
+    def __init__(self, counts, present, metrics, segments, variants, dates, step_names, cumulative=False):
+        """
+        Args:
+            counts: Array int64 de forma (métricas, segmentos, variantes, fechas, pasos)
+            present: Array bool de la misma forma (celdas con datos)
+            metrics, segments, variants: Etiquetas de cada dimensión, en orden
+            dates: Fechas (DatetimeIndex o lista convertible)
+            step_names: Dict métrica -> lista de nombres de paso en orden del funnel
+            cumulative: True si los datos son acumulados por período
+        """
+        self.counts = counts
+        self.present = present
+        self.metrics = list(metrics)
+        self.segments = list(segments)
+        self.variants = list(variants)
+        self.dates = pd.DatetimeIndex(dates)
+        self.step_names = {metric: list(names) for metric, names in step_names.items()}
+        self.cumulative = cumulative
+
+        self._index = {
+            'metric': {label: i for i, label in enumerate(self.metrics)},
+            'segment': {label: i for i, label in enumerate(self.segments)},
+            'variant': {label: i for i, label in enumerate(self.variants)},
+            'date': {label: i for i, label in enumerate(self.dates)},
+        }
+
+    # ------------------------------------------------------------------
+    # Construcción
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_frames(cls, frames):
+        """
+        Construye el cubo desde DataFrames en formato largo del pipeline.
+
+        Args:
+            frames: Dict (métrica, segmento) -> DataFrame de final_pipeline o
+                    final_pipeline_cumulative. Los DataFrames vacíos se ignoran.
+
+        Returns:
+            FunnelCube: Cubo con todas las métricas y segmentos
+        """
+        frames = {
+            key: df for key, df in frames.items()
+            if df is not None and not df.empty and {'Variant', 'Funnel Stage', 'Event Count'} <= set(df.columns)
+        }
+        cumulative = any('Date' not in df.columns for df in frames.values())
+        date_column = 'Start Date' if cumulative else 'Date'
+
+        metrics, segments, variants, step_names = [], [], [], {}
+        all_dates = []
+        for (metric, segment), df in frames.items():
+            if metric not in step_names:
+                metrics.append(metric)
+                step_names[metric] = []
+            if segment not in segments:
+                segments.append(segment)
+            for variant in pd.unique(df['Variant']):
+                if variant not in variants:
+                    variants.append(variant)
+            for stage in pd.unique(df['Funnel Stage']):
+                if stage not in step_names[metric]:
+                    step_names[metric].append(stage)
+            all_dates.append(pd.to_datetime(df[date_column]))
+
+        dates = pd.DatetimeIndex(pd.unique(pd.concat(all_dates))).sort_values() if all_dates else pd.DatetimeIndex([])
+        n_steps = max((len(names) for names in step_names.values()), default=0)
+        shape = (len(metrics), len(segments), len(variants), len(dates), n_steps)
+        counts = np.zeros(shape, dtype=np.int64)
+        present = np.zeros(shape, dtype=bool)
+
+        metric_pos = {label: i for i, label in enumerate(metrics)}
+        segment_pos = {label: i for i, label in enumerate(segments)}
+        for (metric, segment), df in frames.items():
+            variant_codes = pd.Categorical(df['Variant'], categories=variants).codes
+            date_codes = dates.get_indexer(pd.to_datetime(df[date_column]))
+            step_codes = pd.Categorical(df['Funnel Stage'], categories=step_names[metric]).codes
+            values = df['Event Count'].to_numpy(dtype=np.int64)
+            # Si un paso se repite en el mismo día, se conserva la primera fila (igual que iloc[0]):
+            # con índices repetidos NumPy deja la última asignación, por eso se asigna en orden inverso
+            m, s = metric_pos[metric], segment_pos[segment]
+            idx = (variant_codes[::-1], date_codes[::-1], step_codes[::-1])
+            counts[m, s][idx] = values[::-1]
+            present[m, s][idx] = True
+
+        return cls(counts, present, metrics, segments, variants, dates, step_names, cumulative=cumulative)
+
+    @classmethod
+    def from_metrics_results(cls, metrics_results, segment=DEFAULT_SEGMENT):
+        """
+        Construye el cubo desde st.session_state['metrics_results'] (métrica -> DataFrame).
+
+        Args:
+            metrics_results: Dict métrica -> DataFrame del pipeline
+            segment: Etiqueta del segmento de estos resultados (default: 'ALL')
+
+        Returns:
+            FunnelCube: Cubo con un único segmento
+        """
+        return cls.from_frames({(metric, segment): df for metric, df in metrics_results.items()})
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.present.nbytes
+
+    def has_metric(self, metric):
+        return metric in self._index['metric']
+
+    def index_of(self, dimension, label):
+        """
+        Posición de una etiqueta en una dimensión.
+
+        Args:
+            dimension: 'metric', 'segment', 'variant', 'date' o 'step' (requiere métrica, ver step_index)
+            label: Etiqueta buscada
+
+        Returns:
+            int: Posición en el eje
+        """
+        if dimension == 'date':
+            label = pd.Timestamp(label)
+        try:
+            return self._index[dimension][label]
+        except KeyError:
+            raise KeyError(f"'{label}' no existe en la dimensión '{dimension}' del cubo")
+
+    def step_index(self, metric, stage):
+        """Posición del paso `stage` dentro del funnel de la métrica."""
+        try:
+            return self.step_names[metric].index(stage)
+        except (KeyError, ValueError):
+            raise KeyError(f"El paso '{stage}' no existe en la métrica '{metric}'")
+
+    def _axis_key(self, dimension, value, metric=None):
+        if value is None:
+            return slice(None)
+        if isinstance(value, slice):
+            return value
+        if dimension == 'step':
+            return self.step_index(metric, value)
+        return self.index_of(dimension, value)
+
+    def slice(self, metric=None, segment=None, variant=None, date=None, step=None):
+        """
+        Obtiene un sub-array del cubo.
+
+        Cada argumento puede ser una etiqueta (reduce el eje), un slice de posiciones
+        o None (todo el eje). Como solo se usa indexación básica, el resultado es una
+        vista del array (no copia datos). `step` por nombre requiere `metric`.
+
+        Returns:
+            np.ndarray: Vista de los conteos
+        """
+        key = (
+            self._axis_key('metric', metric),
+            self._axis_key('segment', segment),
+            self._axis_key('variant', variant),
+            self._axis_key('date', date),
+            self._axis_key('step', step, metric),
+        )
+        return self.counts[key]
+
+    def variants_for(self, metric, segment=DEFAULT_SEGMENT):
+        """Variantes con datos para una métrica y segmento, en orden de aparición."""
+        m, s = self.index_of('metric', metric), self.index_of('segment', segment)
+        has_data = self.present[m, s].any(axis=(1, 2))
+        return [variant for variant, flag in zip(self.variants, has_data) if flag]
+
+    def stage_total(self, metric, stage, segment=DEFAULT_SEGMENT):
+        """
+        Total de sesiones por variante en un paso, con la misma regla que prepare_variants_from_dataframe:
+        en datos acumulados, el valor del período; en datos diarios, el valor de la fecha más reciente.
+
+        Args:
+            metric: Nombre de la métrica
+            stage: Nombre del paso del funnel
+            segment: Segmento
+
+        Returns:
+            np.ndarray: Total por variante (int64, en el orden de self.variants); 0 si no hay datos
+        """
+        m, s = self.index_of('metric', metric), self.index_of('segment', segment)
+        k = self.step_index(metric, stage)
+        counts = self.counts[m, s, :, :, k]
+        present = self.present[m, s, :, :, k]
+        # Última fecha con datos de cada variante (argmax sobre el eje invertido)
+        n_dates = present.shape[1]
+        last = n_dates - 1 - np.argmax(present[:, ::-1], axis=1)
+        totals = counts[np.arange(len(self.variants)), last]
+        return np.where(present.any(axis=1), totals, 0)
+
+    def variant_counts(self, metric, initial_stage, final_stage, segment=DEFAULT_SEGMENT):
+        """
+        Obtiene n (paso inicial) y x (paso final) por variante para el análisis estadístico.
+
+        Equivale a prepare_variants_from_dataframe(df, initial_stage, final_stage) sobre
+        el DataFrame de la métrica, pero sin recorrer el DataFrame.
+
+        Returns:
+            list: Lista de dicts {'name': str, 'n': int, 'x': int}
+        """
+        n_totals = self.stage_total(metric, initial_stage, segment) if initial_stage in self.step_names.get(metric, []) else None
+        x_totals = self.stage_total(metric, final_stage, segment) if final_stage in self.step_names.get(metric, []) else None
+        variants = []
+        for variant in self.variants_for(metric, segment):
+            v = self._index['variant'][variant]
+            variants.append({
+                'name': str(variant),
+                'n': int(n_totals[v]) if n_totals is not None else 0,
+                'x': int(x_totals[v]) if x_totals is not None else 0,
+            })
+        return variants
+
+    # ------------------------------------------------------------------
+    # Conversión
+    # ------------------------------------------------------------------
+    def _present_codes(self, metric=None):
+        present = self.present
+        metric_offset = 0
+        if metric is not None:
+            metric_offset = self.index_of('metric', metric)
+            present = present[metric_offset:metric_offset + 1]
+        m, s, v, d, k = np.nonzero(present)
+        return m + metric_offset, s, v, d, k
+
+    def _step_labels(self, m_codes, k_codes):
+        labels = np.empty(len(m_codes), dtype=object)
+        for m in np.unique(m_codes):
+            names = np.array(self.step_names[self.metrics[m]], dtype=object)
+            mask = m_codes == m
+            labels[mask] = names[k_codes[mask]]
+        return labels
+
+    def to_frame(self, metric=None):
+        """
+        Convierte el cubo (o una métrica) a DataFrame largo, solo con las celdas con datos.
+
+        Args:
+            metric: Métrica a exportar (None = todas)
+
+        Returns:
+            pd.DataFrame: Columnas Metric, Segment, Variant, Date (o Start Date), Funnel Stage, Event Count
+        """
+        m, s, v, d, k = self._present_codes(metric)
+        date_column = 'Start Date' if self.cumulative else 'Date'
+        return pd.DataFrame({
+            'Metric': pd.Categorical.from_codes(m, categories=pd.Index(self.metrics, dtype=object)),
+            'Segment': pd.Categorical.from_codes(s, categories=pd.Index(self.segments, dtype=object)),
+            'Variant': pd.Categorical.from_codes(v, categories=pd.Index(self.variants, dtype=object)),
+            date_column: self.dates.values[d],
+            'Funnel Stage': self._step_labels(m, k),
+            'Event Count': self.counts[m, s, v, d, k],
+        })
+
+    def to_arrow(self, metric=None):
+        """
+        Convierte el cubo (o una métrica) a una tabla de Arrow con columnas diccionario.
+
+        Args:
+            metric: Métrica a exportar (None = todas)
+
+        Returns:
+            pyarrow.Table: Mismas columnas que to_frame
+        """
+        import pyarrow as pa
+
+        m, s, v, d, k = self._present_codes(metric)
+        date_column = 'Start Date' if self.cumulative else 'Date'
+
+        def dictionary(codes, labels):
+            return pa.DictionaryArray.from_arrays(pa.array(codes, type=pa.int32()), pa.array([str(x) for x in labels]))
+
+        return pa.table({
+            'Metric': dictionary(m, self.metrics),
+            'Segment': dictionary(s, self.segments),
+            'Variant': dictionary(v, self.variants),
+            date_column: pa.array(self.dates.values[d]),
+            'Funnel Stage': pa.array([str(x) for x in self._step_labels(m, k)]),
+            'Event Count': pa.array(self.counts[m, s, v, d, k], type=pa.int64()),
+        })
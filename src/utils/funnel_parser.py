@@ -0,0 +1,159 @@
+"""
+Parser columnar de respuestas de funnel de Amplitude.
+
+Convierte `dayFunnels.series`, `dayFunnels.xValues`, `events` y `cumulativeRaw`
+directamente en arrays de NumPy y arma el DataFrame de cada variante en una sola
+asignación (en lugar de un pd.concat por fila, que es cuadrático). El esquema de
+salida es el mismo que generaban get_variant_funnel y get_variant_funnel_cum.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Columnas (y su orden) de los DataFrames de salida
+DAILY_COLUMNS = ['Date', 'ExperimentID', 'Culture', 'Device', 'Variant', 'Event Count', 'Funnel Stage']
+CUMULATIVE_COLUMNS = ['Start Date', 'End Date', 'ExperimentID', 'Culture', 'Device', 'Variant', 'Funnel Stage', 'Event Count']
+
+
+def get_stage_names(funnel_stages):
+    """
+    Obtiene los nombres de los pasos del funnel.
+
+    Args:
+        funnel_stages: Lista `events` de la respuesta (strings o dicts de Amplitude)
+
+    Returns:
+        list: Nombres de los pasos (si el paso es dict, se usa su event_type)
+    """
+    return [
+        stage.get('event_type', str(stage)) if isinstance(stage, dict) else stage
+        for stage in funnel_stages
+    ]
+
+
+def _constant_column(value, length):
+    """
+    Crea una columna object con el mismo valor repetido.
+
+    Usa fill para que valores lista (ej. Culture multiselect) se guarden tal cual en cada celda.
+    """
+    column = np.empty(length, dtype=object)
+    column.fill(value)
+    return column
+
+
+def _series_matrix(series, n_days, n_stages):
+    """
+    Convierte las filas de `series` en una matriz int64 de n_days x pasos.
+
+    Las filas se recortan a n_stages (mismo criterio que zip con los pasos). Si las filas
+    no tienen todas el mismo largo, se recortan al largo de la fila más corta.
+    """
+    rows = series[:n_days]
+    try:
+        matrix = np.asarray(rows, dtype=np.int64)
+    except (TypeError, ValueError):
+        matrix = None
+    if matrix is None or matrix.ndim != 2:
+        width = min([n_stages] + [len(row) for row in rows])
+        matrix = np.asarray([row[:width] for row in rows], dtype=np.int64).reshape(len(rows), width)
+    return matrix[:, :n_stages]
+
+
+def parse_daily_funnel(websites, experiment_id, culture, device, variant):
+    """
+    Arma el DataFrame diario de una variante a partir de los grupos de la respuesta.
+
+    Args:
+        websites: Lista de grupos de la respuesta (`data` de Amplitude)
+        experiment_id, culture, device, variant: Valores constantes de la variante
+
+    Returns:
+        pd.DataFrame: Una fila por (fecha, paso) con las columnas de DAILY_COLUMNS
+    """
+    dates_parts, stages_parts, counts_parts = [], [], []
+    for website_funnel in websites:
+        series = website_funnel['dayFunnels']['series']
+        dates = website_funnel['dayFunnels']['xValues']
+        stage_names = get_stage_names(website_funnel['events'])
+
+        n_days = min(len(dates), len(series))
+        n_stages = len(stage_names)
+        if n_days == 0 or n_stages == 0:
+            continue
+        counts = _series_matrix(series, n_days, n_stages)
+        n_stages = counts.shape[1]
+
+        # Orden fila a fila: fecha mayor, paso menor
+        dates_parts.append(np.repeat(pd.to_datetime(dates[:n_days]).values, n_stages))
+        stages_parts.append(np.tile(np.array(stage_names[:n_stages], dtype=object), n_days))
+        counts_parts.append(counts.ravel())
+
+    if not counts_parts:
+        return pd.DataFrame({column: [] for column in DAILY_COLUMNS if column != 'Funnel Stage'})
+
+    counts = np.concatenate(counts_parts)
+    n_rows = len(counts)
+    return pd.DataFrame({
+        'Date': np.concatenate(dates_parts),
+        'ExperimentID': _constant_column(experiment_id, n_rows),
+        'Culture': _constant_column(culture, n_rows),
+        'Device': _constant_column(device, n_rows),
+        'Variant': _constant_column(variant, n_rows),
+        'Event Count': counts,
+        'Funnel Stage': np.concatenate(stages_parts),
+    }, columns=DAILY_COLUMNS)
+
+
+def parse_cumulative_funnel(websites, experiment_id, culture, device, variant, actual_start_date=None, actual_end_date=None):
+    """
+    Arma el DataFrame acumulado de una variante a partir de `cumulativeRaw`.
+
+    Args:
+        websites: Lista de grupos de la respuesta (`data` de Amplitude)
+        experiment_id, culture, device, variant: Valores constantes de la variante
+        actual_start_date: Fecha de inicio exacta de la query (si es None, se usa el primer xValue)
+        actual_end_date: Fecha de fin exacta de la query (si es None, se usa el último xValue)
+
+    Returns:
+        pd.DataFrame: Una fila por paso con las columnas de CUMULATIVE_COLUMNS
+    """
+    starts, ends, stages_parts, counts_parts = [], [], [], []
+    for website_funnel in websites:
+        x_values = website_funnel.get('dayFunnels', {}).get('xValues', [])
+        if actual_start_date is not None:
+            start_date_filter = pd.to_datetime(actual_start_date)
+        else:
+            start_date_filter = pd.to_datetime(x_values[0]) if x_values else None
+        if actual_end_date is not None:
+            end_date_filter = pd.to_datetime(actual_end_date)
+        else:
+            end_date_filter = pd.to_datetime(x_values[-1]) if x_values else None
+
+        stage_names = get_stage_names(website_funnel.get('events', []))
+        cumulative_raw = website_funnel.get('cumulativeRaw', [])
+        if not cumulative_raw or not stage_names:
+            continue
+
+        n_stages = min(len(stage_names), len(cumulative_raw))
+        starts.extend([start_date_filter] * n_stages)
+        ends.extend([end_date_filter] * n_stages)
+        stages_parts.append(np.array(stage_names[:n_stages], dtype=object))
+        counts_parts.append(np.asarray(cumulative_raw[:n_stages], dtype=np.int64))
+
+    if not counts_parts:
+        return pd.DataFrame({column: [] for column in CUMULATIVE_COLUMNS})
+
+    counts = np.concatenate(counts_parts)
+    n_rows = len(counts)
+    return pd.DataFrame({
+        'Start Date': pd.to_datetime(pd.Series(starts, dtype=object)),
+        'End Date': pd.to_datetime(pd.Series(ends, dtype=object)),
+        'ExperimentID': _constant_column(experiment_id, n_rows),
+        'Culture': _constant_column(culture, n_rows),
+        'Device': _constant_column(device, n_rows),
+        'Variant': _constant_column(variant, n_rows),
+        'Funnel Stage': np.concatenate(stages_parts),
+        'Event Count': counts,
+    }, columns=CUMULATIVE_COLUMNS)
@@ -4,15 +4,61 @@ Módulo para cargar automáticamente métricas desde las carpetas de metrics/.
 Este módulo escanea las carpetas en metrics/ y detecta automáticamente
 todas las métricas definidas en archivos *_metrics.py, organizándolas
 por carpeta y generando información para mostrar en el dashboard.
+
+OPTIMIZACIÓN: Las métricas se cargan una sola vez en un registro (MetricRegistry) por
+carpeta raíz. En cada lectura solo se revisa el mtime y tamaño de cada archivo; si
+cambiaron se compara el hash del contenido y solo se vuelve a ejecutar el archivo que
+realmente cambió, bajo un nombre de módulo estable (sin acumular módulos huérfanos en
+sys.modules). El registro expone un número de versión que aumenta con cada cambio,
+para que las cachés derivadas (ej. definiciones compiladas) lo usen como clave.
+
+Definiciones compiladas: una vez por versión del registro, cada métrica se compila a
+un mapping de solo lectura con su ancla (Ghost Anchor) ya insertada, los nombres de
+eventos en orden, los eventos inicial/final para los stages y el mapa de filtros. La
+UI las consulta con get_compiled_metrics() sin volver a cargar ni copiar módulos.
+
+Métricas compuestas: una métrica puede declarar la clave 'composite' con sus
+sub-métricas y la regla de combinación (ver src/utils/composite_metrics.py); se compila
+junto con la métrica.
 """
 
+import copy
+import hashlib
+from types import MappingProxyType
 import os
 import sys
 import importlib.util
+import threading
 from pathlib import Path
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Mapping, Tuple
 import inspect
-import time
+
+
+# ==============================================================================
+# MAPEO DE GHOST ANCHORS (Configuración Explícita)
+# Define qué evento de contexto (_loaded) se inyecta según el evento inicial.
+# Key: Evento Inicial de la métrica (Hijo)
+# Value: Evento Ancla a inyectar (Padre/Contexto)
+# ==============================================================================
+EVENT_ANCHOR_MAP = {
+    # Extras (Flexi, Checkin, Embarque, etc.)
+    'extra_selected': 'extras_dom_loaded',  # CORREGIDO: Plural 'extras'
+
+    # Maletas / Ancillaries (Modal o Selección directa)
+    'modal_ancillary_clicked': 'baggage_dom_loaded',
+    'baggage_selected': 'baggage_dom_loaded',
+    'cabin_bag_selected': 'baggage_dom_loaded',
+    'checked_bag_selected': 'baggage_dom_loaded',
+
+    # Vuelos (Selección de itinerario)
+    'dc_modal_dom_loaded': 'flight_dom_loaded_flight',
+    'inbound_flight_selected_flight': 'flight_dom_loaded_flight',
+    'outbound_flight_selected_flight': 'flight_dom_loaded_flight',
+
+    # Asientos (Selección en mapa)
+    'inbound_seat_selected': 'seatmap_dom_loaded',
+    'outbound_seat_selected': 'seatmap_dom_loaded'
+}
 
 
 def is_valid_metric(obj: Any) -> bool:
@@ -92,6 +138,121 @@ def get_event_filters(event_item: Any) -> List[Any]:
     return []
 
 
+def _split_event(event_item: Any, default_filters: List[Any]) -> Tuple[str, List[Any]]:
+    """Nombre y filtros de un evento en cualquiera de los formatos de métrica."""
+    if isinstance(event_item, tuple):
+        if len(event_item) >= 2 and isinstance(event_item[1], list):
+            return event_item[0], event_item[1]
+        return event_item[0], []
+    return event_item, default_filters
+
+
+def _compile_composite(composite: Any) -> Any:
+    """Sub-métricas y regla de la clave 'composite' de una métrica (None si no es compuesta)."""
+    if not isinstance(composite, dict):
+        return None
+    sub_metrics = []
+    for index, sub_metric in enumerate(composite.get('sub_metrics', [])):
+        steps = [_split_event(event_item, []) for event_item in sub_metric.get('events', [])]
+        sub_metrics.append(MappingProxyType({
+            'name': sub_metric.get('name', f'sub_{index}'),
+            'events': tuple((event_name, tuple(filters)) for event_name, filters in steps),
+        }))
+    return MappingProxyType({
+        'combine': composite.get('combine', 'or'),
+        'sub_metrics': tuple(sub_metrics),
+    })
+
+
+def compile_metric(name: str, category: str, config: Dict[str, Any], version: int = 0) -> Mapping[str, Any]:
+    """
+    Compila una métrica a su definición de solo lectura, con el Ghost Anchor ya aplicado.
+    
+    Si el primer evento tiene un ancla en EVENT_ANCHOR_MAP, se inserta el evento ancla
+    (sin filtros) como paso 0 y la métrica queda con hidden_first_step: los stages
+    visibles empiezan en el paso 1.
+    
+    Args:
+        name: Nombre de la métrica (nombre de la variable, ej. 'SEATS_WCR')
+        category: Carpeta de la métrica
+        config: Definición original {'events': [...], 'filters': [...] y 'composite' opcionales}
+        version: Versión del registro que la compiló
+        
+    Returns:
+        Mapping: {
+            'name', 'category', 'version',
+            'events': ((evento, (filtros...)), ...) incluyendo el ancla,
+            'event_names': (evento, ...),
+            'filters': {evento: (filtros...)} solo eventos con filtros,
+            'hidden_first_step': bool, 'anchor_event': str | None,
+            'stage_events': eventos visibles (sin el ancla), en orden,
+            'initial_stage': primer stage visible (denominador),
+            'final_stage': último stage (numerador),
+            'composite': {'combine', 'sub_metrics': ({'name', 'events'}, ...)} | None
+        }
+    """
+    metric_filters = config.get('filters', [])
+    default_filters = list(metric_filters) if isinstance(metric_filters, list) else [metric_filters] if metric_filters else []
+    steps = [_split_event(event_item, default_filters) for event_item in config.get('events', [])]
+    
+    anchor_event = EVENT_ANCHOR_MAP.get(steps[0][0]) if steps else None
+    if anchor_event is not None and anchor_event != steps[0][0]:
+        steps.insert(0, (anchor_event, []))
+    else:
+        anchor_event = None
+    hidden_first_step = anchor_event is not None or bool(config.get('hidden_first_step', False))
+    
+    event_names = tuple(event_name for event_name, _ in steps)
+    stage_events = event_names[1:] if hidden_first_step and len(event_names) >= 2 else event_names
+    return MappingProxyType({
+        'name': name,
+        'category': category,
+        'version': version,
+        'events': tuple((event_name, tuple(filters)) for event_name, filters in steps),
+        'event_names': event_names,
+        'filters': MappingProxyType({event_name: tuple(filters) for event_name, filters in steps if filters}),
+        'hidden_first_step': hidden_first_step,
+        'anchor_event': anchor_event,
+        'stage_events': stage_events,
+        'initial_stage': stage_events[0] if stage_events else None,
+        'final_stage': stage_events[-1] if stage_events else None,
+        'composite': _compile_composite(config.get('composite')),
+    })
+
+
+def metric_to_process(compiled: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    Arma la entrada de metrics_to_process (formato de app.py / query_planner) de una métrica compilada.
+    
+    Args:
+        compiled: Definición compilada (ver compile_metric)
+        
+    Returns:
+        dict: {'name', 'events', 'filters', 'hidden_first_step'} con listas propias (modificables)
+    """
+    return {
+        'name': compiled['name'],
+        'events': list(compiled['event_names']),
+        'filters': {event_name: copy.deepcopy(list(filters)) for event_name, filters in compiled['filters'].items()},
+        'hidden_first_step': compiled['hidden_first_step'],
+    }
+
+
+def _module_name(file_path: Path, category: str) -> str:
+    """Nombre estable del módulo de un archivo de métricas (se reemplaza al recargarlo)."""
+    return f"metrics_{category}_{file_path.stem}"
+
+
+def _forget_module(file_path: Path, category: str) -> None:
+    """Quita de sys.modules el módulo cargado por el registro y el del paquete src.metrics."""
+    for module_name in (
+        _module_name(file_path, category),
+        f"src.metrics.{category}.{file_path.stem}",
+        f"src.metrics.{category}",
+    ):
+        sys.modules.pop(module_name, None)
+
+
 def load_metrics_from_file(file_path: Path, category: str) -> Dict[str, Dict]:
     """
     Carga todas las métricas válidas desde un archivo de métricas.
@@ -106,18 +267,9 @@ def load_metrics_from_file(file_path: Path, category: str) -> Dict[str, Dict]:
     metrics = {}
     
     try:
-        # Limpiar caché de módulos relacionados con este archivo
-        # Buscar y eliminar módulos cacheados que coincidan con el patrón
-        module_pattern = f"metrics_{category}_{file_path.stem}"
-        modules_to_remove = [
-            name for name in sys.modules.keys() 
-            if name.startswith(module_pattern) or name == f"src.metrics.{category}.{file_path.stem}"
-        ]
-        for module_name in modules_to_remove:
-            del sys.modules[module_name]
-        
-        # Generar un nombre único para el módulo para evitar caché
-        module_name = f"metrics_{category}_{file_path.stem}_{int(time.time() * 1000000)}"
+        # Reemplazar la versión anterior del módulo (mismo nombre: no quedan módulos huérfanos)
+        _forget_module(file_path, category)
+        module_name = _module_name(file_path, category)
         
         # Cargar el módulo dinámicamente
         spec = importlib.util.spec_from_file_location(
@@ -129,6 +281,7 @@ def load_metrics_from_file(file_path: Path, category: str) -> Dict[str, Dict]:
         
         module = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(module)
+        sys.modules[module_name] = module
         
         # Buscar todas las variables que sean métricas válidas
         for name, obj in inspect.getmembers(module):
@@ -150,6 +303,185 @@ def load_metrics_from_file(file_path: Path, category: str) -> Dict[str, Dict]:
     return metrics
 
 
+class MetricRegistry:
+    """
+    Registro de métricas de una carpeta metrics/ con recarga por archivo.
+    
+    Cada archivo *_metrics.py se indexa por (mtime, tamaño) y hash SHA-256 del contenido;
+    refresh() solo vuelve a ejecutar los archivos cuyo contenido cambió y descarta los
+    eliminados. `version` aumenta cada vez que cambia el conjunto de métricas.
+    """
+    
+    def __init__(self, metrics_root: Path):
+        """
+        Args:
+            metrics_root: Ruta de la carpeta metrics/
+        """
+        self.metrics_root = Path(metrics_root)
+        self.version = 0
+        self._lock = threading.Lock()
+        # {ruta: {'category', 'mtime_ns', 'size', 'sha256', 'metrics'}}
+        self._entries: Dict[Path, Dict[str, Any]] = {}
+        self.files_loaded = 0
+        self.unchanged_checks = 0
+        self._compiled: Mapping[str, Mapping[str, Any]] = MappingProxyType({})
+        self._compiled_version = None
+    
+    def _scan(self) -> List[Tuple[Path, str]]:
+        """Archivos *_metrics.py de cada subcarpeta, como (ruta, categoría)."""
+        if not self.metrics_root.exists():
+            return []
+        files = []
+        for category_dir in sorted(self.metrics_root.iterdir()):
+            if category_dir.is_dir():
+                files.extend((path, category_dir.name) for path in sorted(category_dir.glob('*_metrics.py')))
+        return files
+    
+    def refresh(self) -> int:
+        """
+        Recarga los archivos nuevos o modificados y descarta los eliminados.
+        
+        Returns:
+            int: Versión del registro después del refresco
+        """
+        with self._lock:
+            changed = False
+            seen = set()
+            for file_path, category in self._scan():
+                seen.add(file_path)
+                try:
+                    stat = file_path.stat()
+                except OSError:
+                    continue
+                entry = self._entries.get(file_path)
+                if entry is not None and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+                    self.unchanged_checks += 1
+                    continue
+                digest = hashlib.sha256(file_path.read_bytes()).hexdigest()
+                if entry is not None and entry['sha256'] == digest:
+                    # Solo cambió el mtime (ej. touch o checkout): no hace falta re-ejecutar
+                    entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+                    continue
+                self._entries[file_path] = {
+                    'category': category,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'sha256': digest,
+                    'metrics': load_metrics_from_file(file_path, category),
+                }
+                self.files_loaded += 1
+                changed = True
+            for file_path in [path for path in self._entries if path not in seen]:
+                _forget_module(file_path, self._entries.pop(file_path)['category'])
+                changed = True
+            if changed:
+                self.version += 1
+            return self.version
+    
+    def get_metrics(self) -> Dict[str, Dict[str, Dict]]:
+        """
+        Obtiene las métricas por categoría (refrescando antes los archivos modificados).
+        
+        Returns:
+            Dict: {categoría: {nombre: config}}; es una copia profunda, así quien la
+                  modifica (ej. al insertar anclas) no altera el registro
+        """
+        self.refresh()
+        with self._lock:
+            all_metrics: Dict[str, Dict[str, Dict]] = {}
+            for entry in self._entries.values():
+                if entry['metrics']:
+                    all_metrics.setdefault(entry['category'], {}).update(entry['metrics'])
+            return copy.deepcopy(all_metrics)
+    
+    def get_compiled(self) -> Mapping[str, Mapping[str, Any]]:
+        """
+        Obtiene las definiciones compiladas (se recompilan solo si cambió la versión).
+        
+        Returns:
+            Mapping: {nombre: definición compilada} de solo lectura (ver compile_metric)
+        """
+        version = self.refresh()
+        with self._lock:
+            if self._compiled_version != version:
+                compiled = {}
+                for entry in self._entries.values():
+                    for name, config in entry['metrics'].items():
+                        compiled[name] = compile_metric(name, entry['category'], config, version)
+                self._compiled = MappingProxyType(compiled)
+                self._compiled_version = version
+            return self._compiled
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene los contadores del registro.
+        
+        Returns:
+            dict: Versión, archivos indexados, cargas de archivos y revisiones sin cambios
+        """
+        with self._lock:
+            return {
+                'version': self.version,
+                'files': len(self._entries),
+                'metrics': sum(len(entry['metrics']) for entry in self._entries.values()),
+                'files_loaded': self.files_loaded,
+                'unchanged_checks': self.unchanged_checks,
+            }
+
+
+_registries: Dict[Path, MetricRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def _default_metrics_root() -> Path:
+    # Ruta del directorio actual (utils/), un nivel arriba y luego metrics/
+    return Path(__file__).resolve().parent.parent / 'metrics'
+
+
+def get_metric_registry(metrics_root: Path = None) -> MetricRegistry:
+    """
+    Obtiene el registro compartido de una carpeta de métricas (se crea en el primer uso).
+    
+    Args:
+        metrics_root: Ruta raíz de la carpeta metrics/ (por defecto: src/metrics)
+        
+    Returns:
+        MetricRegistry: Registro de esa carpeta
+    """
+    root = Path(metrics_root).resolve() if metrics_root is not None else _default_metrics_root()
+    with _registries_lock:
+        registry = _registries.get(root)
+        if registry is None:
+            registry = _registries[root] = MetricRegistry(root)
+    return registry
+
+
+def get_compiled_metrics(metrics_root: Path = None) -> Mapping[str, Mapping[str, Any]]:
+    """
+    Obtiene las definiciones compiladas de todas las métricas (ver compile_metric).
+    
+    Args:
+        metrics_root: Ruta raíz de la carpeta metrics/ (por defecto: src/metrics)
+        
+    Returns:
+        Mapping: {nombre: definición compilada} de solo lectura, compartido entre reruns
+    """
+    return get_metric_registry(metrics_root).get_compiled()
+
+
+def get_metrics_version(metrics_root: Path = None) -> int:
+    """
+    Versión actual del registro de métricas (aumenta cada vez que cambia algún archivo).
+    
+    Args:
+        metrics_root: Ruta raíz de la carpeta metrics/ (por defecto: src/metrics)
+        
+    Returns:
+        int: Versión, útil como clave de cachés derivadas de las métricas
+    """
+    return get_metric_registry(metrics_root).refresh()
+
+
 def generate_display_name(var_name: str, emoji: str = '') -> str:
     """
     Genera un nombre de display legible a partir del nombre de variable.
@@ -353,6 +685,9 @@ def load_all_metrics(metrics_root: Path = None) -> Dict[str, Dict[str, Dict]]:
     """
     Carga todas las métricas desde todas las carpetas de metrics/.
     
+    Usa el registro compartido (get_metric_registry): solo se vuelven a ejecutar los
+    archivos que cambiaron desde la última lectura.
+    
     Args:
         metrics_root: Ruta raíz de la carpeta metrics/ (por defecto: relativa a este archivo)
         
@@ -367,43 +702,7 @@ def load_all_metrics(metrics_root: Path = None) -> Dict[str, Dict[str, Dict]]:
             ...
         }
     """
-    if metrics_root is None:
-        # Obtener la ruta del directorio actual (utils/)
-        current_dir = Path(__file__).resolve().parent
-        # Subir un nivel y entrar a metrics/
-        metrics_root = current_dir.parent / 'metrics'
-    else:
-        metrics_root = Path(metrics_root)
-    
-    if not metrics_root.exists():
-        return {}
-    
-    all_metrics = {}
-    
-    # Escanear cada subcarpeta en metrics/
-    for category_dir in metrics_root.iterdir():
-        if not category_dir.is_dir():
-            continue
-        
-        category = category_dir.name
-        
-        # Buscar archivos *_metrics.py en esta carpeta
-        metrics_files = list(category_dir.glob('*_metrics.py'))
-        
-        if not metrics_files:
-            continue
-        
-        category_metrics = {}
-        
-        # Cargar métricas de cada archivo
-        for metrics_file in metrics_files:
-            file_metrics = load_metrics_from_file(metrics_file, category)
-            category_metrics.update(file_metrics)
-        
-        if category_metrics:
-            all_metrics[category] = category_metrics
-    
-    return all_metrics
+    return get_metric_registry(metrics_root).get_metrics()
 
 
 def get_metrics_info(metrics_dict: Dict[str, Dict]) -> List[Dict[str, str]]:
@@ -0,0 +1,208 @@
+"""
+Planificador de queries de funnel para el análisis multi-métrica.
+
+En un funnel ordenado de Amplitude, el conteo del paso i solo depende de los pasos
+0..i, así que una métrica cuyos eventos (y filtros) son un prefijo de otra métrica
+se puede responder con la query de la métrica más larga, recortando los primeros
+pasos de la respuesta. El planificador agrupa las métricas seleccionadas por prefijo
+compatible, emite el mínimo de queries y reparte los conteos a cada métrica.
+
+Métricas "hermanas" que solo comparten el ancla (ej. A → B y A → C) NO se fusionan:
+un funnel A → B → C cuenta a quienes hicieron B y luego C, no a quienes hicieron C.
+"""
+
+import json
+
+from src.utils.composite_metrics import get_composite
+
+
+# Claves de filtro que desactivan los filtros globales equivalentes en el ancla
+# (mismo criterio que los has_explicit_*_filter de _fetch_funnel_data)
+_CONTEXT_FILTER_KEYS = ('flow_type', 'trip_type', 'bundle', 'pax')
+
+# Listas por paso de cada grupo de la respuesta de /api/2/funnels (un valor por paso, o uno
+# por transición entre pasos: en ambos casos se quitan los valores de los pasos recortados)
+FUNNEL_STEP_KEYS = (
+    'events', 'cumulative', 'cumulativeRaw', 'stepByStep', 'medianTransTimes', 'avgTransTimes',
+    'stepTransTimeDistribution', 'stepPrevStepCountDistribution',
+)
+# Series diarias por paso: cada fila de 'series' es un día con un valor por paso
+FUNNEL_DAY_SERIES_KEYS = ('dayFunnels', 'dayMedianTransTimes', 'dayAvgTransTimes')
+
+
+def _event_name(event):
+    if isinstance(event, tuple) and len(event) > 0:
+        return event[0]
+    if isinstance(event, str):
+        return event
+    return str(event)
+
+
+def _filters_signature(filters):
+    """Representación canónica (comparable) de la lista de filtros de un evento."""
+    if not filters:
+        return ''
+    filters_list = filters if isinstance(filters, list) else [filters]
+    return json.dumps(filters_list, sort_keys=True, default=str)
+
+
+def _context_flags(filters_map):
+    """
+    Filtros contextuales explícitos presentes en el mapa de filtros de una métrica.
+
+    _fetch_funnel_data revisa el mapa completo (no solo los pasos de la query), así que
+    dos métricas solo comparten query si producen los mismos flags.
+    """
+    flags = set()
+    for filters in (filters_map or {}).values():
+        if not filters:
+            continue
+        for filt in (filters if isinstance(filters, list) else [filters]):
+            if not isinstance(filt, dict):
+                continue
+            key = str(filt.get('subprop_key'))
+            for context_key in _CONTEXT_FILTER_KEYS:
+                if key == context_key or (context_key in ('bundle', 'pax') and context_key in key.lower()):
+                    flags.add(context_key)
+    return frozenset(flags)
+
+
+def _step_signatures(metric):
+    """Firma (evento, filtros) de cada paso de la métrica, en orden."""
+    filters_map = metric.get('filters') or {}
+    return tuple(
+        (name, _filters_signature(filters_map.get(name)))
+        for name in (_event_name(event) for event in metric.get('events', []))
+    )
+
+
+def _is_composite(metric):
+    """
+    True si la métrica es compuesta (src/utils/composite_metrics.py): su query no devuelve
+    un funnel simple y nunca se fusiona.
+    """
+    return get_composite(metric.get('events', []), metric.get('filters')) is not None
+
+
+def _can_serve(carrier, member):
+    """
+    True si la query de `carrier` devuelve exactamente los conteos de `member` en sus
+    primeros pasos.
+    """
+    if _is_composite(carrier) or _is_composite(member):
+        return False
+    if bool(carrier.get('hidden_first_step', False)) != bool(member.get('hidden_first_step', False)):
+        return False
+    carrier_steps, member_steps = _step_signatures(carrier), _step_signatures(member)
+    if not member_steps or len(member_steps) > len(carrier_steps):
+        return False
+    if carrier_steps[:len(member_steps)] != member_steps:
+        return False
+    # _fetch_funnel_data decide los filtros globales del ancla mirando el mapa completo
+    return _context_flags(carrier.get('filters')) == _context_flags(member.get('filters'))
+
+
+def plan_funnel_queries(metrics):
+    """
+    Agrupa las métricas por prefijo de funnel compatible.
+
+    Las métricas se recorren de más larga a más corta: cada una se asigna al primer
+    carrier ya elegido que la contiene como prefijo, o pasa a ser un carrier nuevo.
+    Como "ser prefijo" es transitivo, este greedy emite el mínimo de queries.
+
+    Args:
+        metrics: Lista de dicts {'name', 'events', 'filters', 'hidden_first_step'}
+                 (mismo formato que metrics_to_process en app.py)
+
+    Returns:
+        dict: {
+            'queries': [{'metric': dict del carrier, 'members': [{'name': str, 'n_steps': int}]}],
+            'requested_calls': int (queries sin planificar, una por métrica),
+            'planned_calls': int (queries del plan),
+            'saved_calls': int
+        }
+        Los 'members' incluyen al propio carrier. El orden de las queries sigue el de la
+        primera métrica de cada grupo en la lista original.
+    """
+    order = sorted(range(len(metrics)), key=lambda idx: -len(metrics[idx].get('events', [])))
+    groups = []  # [(carrier_idx, [member_idx, ...])]
+    for idx in order:
+        metric = metrics[idx]
+        for carrier_idx, member_indices in groups:
+            if _can_serve(metrics[carrier_idx], metric):
+                member_indices.append(idx)
+                break
+        else:
+            groups.append((idx, [idx]))
+
+    groups.sort(key=lambda group: min(group[1]))
+    queries = [
+        {
+            'metric': metrics[carrier_idx],
+            'members': [
+                {'name': metrics[idx]['name'], 'n_steps': len(metrics[idx].get('events', []))}
+                for idx in sorted(member_indices)
+            ],
+        }
+        for carrier_idx, member_indices in groups
+    ]
+    return {
+        'queries': queries,
+        'requested_calls': len(metrics),
+        'planned_calls': len(queries),
+        'saved_calls': len(metrics) - len(queries),
+    }
+
+
+def _drop_steps(values, removed):
+    """Quita de una lista por paso los valores de los últimos `removed` pasos."""
+    if not isinstance(values, list) or not removed:
+        return values
+    return values[:max(0, len(values) - removed)]
+
+
+def _truncate_step_keys(mapping, removed):
+    return {
+        key: _drop_steps(value, removed) if key in FUNNEL_STEP_KEYS else value
+        for key, value in mapping.items()
+    }
+
+
+def truncate_funnel_response(response, n_steps):
+    """
+    Recorta una respuesta de funnel a sus primeros n_steps pasos.
+
+    Solo se recortan las listas por paso conocidas de cada grupo (FUNNEL_STEP_KEYS) y las
+    filas de las series diarias por paso (FUNNEL_DAY_SERIES_KEYS); el resto de la respuesta
+    se conserva tal cual, aunque sea una lista del mismo largo que los pasos.
+
+    Args:
+        response: JSON de la respuesta de Amplitude (dict con 'data')
+        n_steps: Número de pasos a conservar
+
+    Returns:
+        dict: Nueva respuesta (no modifica la original)
+    """
+    if not isinstance(response, dict) or 'data' not in response:
+        return response
+    data = response['data']
+    websites = data if isinstance(data, list) else [data] if isinstance(data, dict) else []
+
+    truncated = []
+    for website in websites:
+        if not isinstance(website, dict):
+            truncated.append(website)
+            continue
+        removed = max(0, len(website.get('events', [])) - n_steps)
+        new_website = _truncate_step_keys(website, removed)
+        for key in FUNNEL_DAY_SERIES_KEYS:
+            day_series = website.get(key)
+            if not isinstance(day_series, dict):
+                continue
+            new_day_series = _truncate_step_keys(day_series, removed)
+            if isinstance(day_series.get('series'), list):
+                new_day_series['series'] = [_drop_steps(row, removed) for row in day_series['series']]
+            new_website[key] = new_day_series
+        truncated.append(new_website)
+
+    return {**response, 'data': truncated if isinstance(data, list) else truncated[0] if truncated else data}
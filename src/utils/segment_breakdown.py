@@ -0,0 +1,195 @@
+"""
+Desgloses por segmento con group-by en Amplitude (pushdown).
+
+En lugar de repetir la query de una métrica una vez por valor del desglose, se hace una
+sola query por variante agrupada por la propiedad del desglose (parámetro `g` de
+/api/2/funnels, con `limit`); Amplitude devuelve un elemento de `data` por valor, con su
+groupValue. Cada grupo devuelto se asigna a los buckets de la UI con los mismos filtros que
+usaría la query por segmento (ej. desktop = device_type "is not" Android/iPhone) y los
+conteos de los grupos de un bucket se suman.
+
+El endpoint de funnels solo agrupa por propiedades de usuario, así que solo se empujan los
+desgloses sobre propiedades de usuario (Device, Country) cuyos buckets se definen con un
+único filtro "is" / "is not". Culture, Flow Type y Trip Type son propiedades de evento, y
+Flight Profile / Travel Group combinan varias propiedades: siguen usando una query por segmento.
+"""
+
+from src.utils.amplitude_filters import (
+    get_country_filter,
+    get_culture_digital_filter,
+    get_culture_digital_filter_multiple,
+    get_device_type,
+    get_flow_type_filter,
+    get_trip_type_filter,
+)
+
+
+# Culturas que la UI agrupa bajo "INTER"
+INTER_CULTURES = ['BR', 'UY', 'PY', 'EC', 'US', 'DO']
+
+# Propiedades de usuario propias de Amplitude; las demás (custom) se agrupan con prefijo "gp:"
+AMPLITUDE_BUILTIN_USER_PROPERTIES = {
+    'version', 'country', 'city', 'region', 'dma', 'language', 'platform', 'os', 'device',
+    'device_type', 'start_version', 'paying',
+}
+
+# Desglose -> (parámetro de la query que reemplaza, propiedad de usuario del bucket)
+BREAKDOWN_GROUP_BY = {
+    'Device': ('device', 'device_type'),
+    'Country': ('country', 'country'),
+}
+
+
+def get_group_by_param(user_property):
+    """
+    Valor del parámetro `g` de /api/2/funnels para agrupar por una propiedad de usuario.
+
+    Args:
+        user_property: Nombre de la propiedad (ej. 'device_type', 'gp:[Experiment] X' o 'plan')
+
+    Returns:
+        str: La propiedad, con prefijo "gp:" si es una propiedad custom
+    """
+    if user_property in AMPLITUDE_BUILTIN_USER_PROPERTIES or user_property.startswith('gp:'):
+        return user_property
+    return f'gp:{user_property}'
+
+
+def get_bucket_filter(breakdown, segment_value):
+    """
+    Filtro de Amplitude que define un bucket del desglose (el mismo de la query por segmento).
+
+    Args:
+        breakdown: Nombre del desglose ('Device', 'Culture', ...)
+        segment_value: Valor del segmento en la UI
+
+    Returns:
+        dict | None: Filtro, o None si el bucket no se puede expresar con un filtro simple
+    """
+    if breakdown == 'Device':
+        bucket_filter = get_device_type(segment_value)
+    elif breakdown == 'Culture':
+        if segment_value == 'INTER':
+            bucket_filter = get_culture_digital_filter_multiple(INTER_CULTURES)
+        else:
+            bucket_filter = get_culture_digital_filter(segment_value)
+    elif breakdown == 'Country':
+        bucket_filter = get_country_filter([segment_value])
+    elif breakdown == 'Flow Type':
+        bucket_filter = get_flow_type_filter(segment_value)
+    elif breakdown == 'Trip Type':
+        bucket_filter = get_trip_type_filter(segment_value)
+    else:
+        bucket_filter = None
+    if not isinstance(bucket_filter, dict) or bucket_filter.get('subprop_op') not in ('is', 'is not'):
+        return None
+    return bucket_filter
+
+
+def get_breakdown_group_by(breakdown, segment_values, event_filters_map=None):
+    """
+    Indica si un desglose se puede resolver con group-by y con qué propiedad.
+
+    Args:
+        breakdown: Nombre del desglose
+        segment_values: Valores de segmento a resolver
+        event_filters_map: Filtros técnicos de la métrica; si ya filtran la propiedad del
+                           desglose, _fetch_funnel_data ignora el filtro global y la query
+                           por segmento no se puede reproducir con group-by
+
+    Returns:
+        tuple | None: (parámetro a neutralizar, valor del parámetro `g`) o None si no aplica
+    """
+    if breakdown not in BREAKDOWN_GROUP_BY or not segment_values:
+        return None
+    param, user_property = BREAKDOWN_GROUP_BY[breakdown]
+    for filters in (event_filters_map or {}).values():
+        for filt in (filters if isinstance(filters, list) else [filters]):
+            if isinstance(filt, dict) and filt.get('subprop_key') == user_property:
+                return None
+    for value in segment_values:
+        bucket_filter = get_bucket_filter(breakdown, value)
+        if bucket_filter is None or bucket_filter.get('subprop_key') != user_property:
+            return None
+    return param, get_group_by_param(user_property)
+
+
+def _group_value(website):
+    """Valor del grupo de un elemento de `data` (Amplitude lo devuelve como str o lista)."""
+    value = website.get('groupValue')
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+def _matches(bucket_filter, value):
+    values = {str(v) for v in bucket_filter.get('subprop_value', [])}
+    inside = value is not None and str(value) in values
+    return inside if bucket_filter['subprop_op'] == 'is' else not inside
+
+
+def _ratios(numerators, denominators):
+    return [round(num / den, 6) if den else 0 for num, den in zip(numerators, denominators)]
+
+
+def _sum_websites(websites, template):
+    """
+    Suma los conteos (cumulativeRaw y dayFunnels.series alineadas por fecha) de varios grupos.
+
+    El resultado se arma desde un esqueleto neutro: de `template` (cualquier grupo de la
+    respuesta) solo se toman los eventos del funnel, que son los mismos en todos los grupos.
+    cumulative y stepByStep se recalculan desde los conteos sumados; los campos por paso
+    que no se pueden sumar (tiempos de conversión, etc.) y el resto de dayFunnels no se copian.
+    """
+    events = list(template.get('events', []))
+    n_steps = len(events)
+    dates = sorted({day for website in websites for day in website.get('dayFunnels', {}).get('xValues', [])})
+    date_index = {day: idx for idx, day in enumerate(dates)}
+
+    series = [[0] * n_steps for _ in dates]
+    cumulative = [0] * n_steps
+    for website in websites:
+        day_funnels = website.get('dayFunnels', {})
+        for day, row in zip(day_funnels.get('xValues', []), day_funnels.get('series', [])):
+            target = series[date_index[day]]
+            for step, value in enumerate(row[:n_steps]):
+                target[step] += value
+        for step, value in enumerate(website.get('cumulativeRaw', [])[:n_steps]):
+            cumulative[step] += value
+
+    return {
+        'events': events,
+        'dayFunnels': {'xValues': dates, 'series': series},
+        'cumulativeRaw': cumulative,
+        'cumulative': _ratios(cumulative, [cumulative[0]] * n_steps) if n_steps else [],
+        'stepByStep': _ratios(cumulative, [cumulative[0]] + cumulative[:-1]) if n_steps else [],
+    }
+
+
+def split_grouped_response(response, breakdown, segment_values):
+    """
+    Reparte una respuesta de funnel con group-by en una respuesta por segmento de la UI.
+
+    Args:
+        response: JSON de Amplitude con un elemento de `data` por valor de la propiedad
+        breakdown: Nombre del desglose
+        segment_values: Valores de segmento a construir
+
+    Returns:
+        dict: {segmento: respuesta con un único elemento en `data`}
+
+    Raises:
+        ValueError: Si la respuesta no trae grupos (groupValue) reconocibles
+    """
+    data = response.get('data') if isinstance(response, dict) else None
+    websites = data if isinstance(data, list) else [data] if isinstance(data, dict) else []
+    websites = [website for website in websites if isinstance(website, dict)]
+    if not websites or any('groupValue' not in website for website in websites):
+        raise ValueError("La respuesta de Amplitude no contiene grupos (groupValue) para el desglose")
+
+    result = {}
+    for segment_value in segment_values:
+        bucket_filter = get_bucket_filter(breakdown, segment_value)
+        members = [website for website in websites if _matches(bucket_filter, _group_value(website))]
+        result[segment_value] = {**response, 'data': [_sum_websites(members, websites[0])]}
+    return result
@@ -3,8 +3,12 @@ Módulo de análisis estadístico para pruebas A/B/N.
 Proporciona funciones para calcular p-values, lift, P2BB y otras métricas estadísticas.
 """
 
+import threading
+from collections import OrderedDict
+
 import numpy as np
 from scipy import stats
+from scipy.special import betaincinv, betaln, ndtr
 from scipy.stats import chi2_contingency
 import plotly.graph_objects as go
 from itertools import combinations
@@ -12,6 +16,150 @@ import streamlit as st
 import streamlit.components.v1 as components
 
 
+# Máximo de términos de la suma exacta de P(B > A); por encima se usa la aproximación normal
+P2BB_EXACT_MAX_TERMS = 20000
+CREDIBLE_INTERVAL_LEVEL = 0.95
+# Máximo de términos que se materializan a la vez en el cálculo batch de P2BB (acota la memoria)
+P2BB_BATCH_MAX_TERMS = 2_000_000
+SIGNIFICANCE_LEVEL = 0.05
+# Máximo de conjuntos (métrica, segmento, datos) memoizados por el motor de comparaciones pareadas
+PAIRWISE_CACHE_MAX_ENTRIES = 512
+
+
+def beta_posterior_params(n, x):
+    """
+    Parámetros de la posterior Beta de una tasa de conversión con prior uniforme Beta(1, 1).
+
+    Args:
+        n: Sesiones/usuarios
+        x: Conversiones
+
+    Returns:
+        tuple: (alpha, beta)
+    """
+    return max(1, x + 1), max(1, n - x + 1)
+
+
+def _prob_beta_greater_exact(alpha_a, beta_a, alpha_b, beta_b):
+    """
+    P(pB > pA) exacta para pA ~ Beta(alpha_a, beta_a) y pB ~ Beta(alpha_b, beta_b), con alpha_b entero.
+
+    Suma cerrada (Evan Miller) evaluada en escala logarítmica:
+        sum_{i=0}^{alpha_b-1} B(alpha_a+i, beta_a+beta_b) / ((beta_b+i) B(1+i, beta_b) B(alpha_a, beta_a))
+    """
+    i = np.arange(int(alpha_b), dtype=np.float64)
+    log_terms = (
+        betaln(alpha_a + i, beta_a + beta_b)
+        - np.log(beta_b + i)
+        - betaln(1 + i, beta_b)
+        - betaln(alpha_a, beta_a)
+    )
+    # log-sum-exp manual (scipy.special.logsumexp tiene mucho overhead para llamadas escalares)
+    max_term = log_terms.max()
+    return float(np.exp(max_term) * np.exp(log_terms - max_term).sum())
+
+
+def _beta_moments(alpha, beta):
+    mean = alpha / (alpha + beta)
+    var = alpha * beta / ((alpha + beta) ** 2 * (alpha + beta + 1))
+    return mean, var
+
+
+def prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b):
+    """
+    Probabilidad bayesiana de que B supere a A (P2BB), determinística.
+
+    Usa la suma cerrada sobre el menor de los alphas (P(B>A) = 1 - P(A>B)); si incluso
+    ese supera P2BB_EXACT_MAX_TERMS, usa la aproximación normal, que con esos volúmenes
+    es indistinguible de la exacta.
+
+    Args:
+        alpha_a, beta_a: Parámetros de la posterior de A
+        alpha_b, beta_b: Parámetros de la posterior de B
+
+    Returns:
+        float: P(pB > pA) en [0, 1]
+    """
+    if min(alpha_a, alpha_b) <= P2BB_EXACT_MAX_TERMS:
+        if alpha_b <= alpha_a:
+            p = _prob_beta_greater_exact(alpha_a, beta_a, alpha_b, beta_b)
+        else:
+            p = 1.0 - _prob_beta_greater_exact(alpha_b, beta_b, alpha_a, beta_a)
+    else:
+        mean_a, var_a = _beta_moments(alpha_a, beta_a)
+        mean_b, var_b = _beta_moments(alpha_b, beta_b)
+        p = float(ndtr((mean_b - mean_a) / np.sqrt(var_a + var_b)))
+    return min(max(p, 0.0), 1.0)
+
+
+def expected_loss(alpha_a, beta_a, alpha_b, beta_b):
+    """
+    Pérdida esperada de elegir B: E[max(pA - pB, 0)] (identidad de Stucchio).
+
+    E[max(pA - pB, 0)] = E[pA]·P(pA' > pB) - E[pB]·P(pA > pB'),
+    con pA' ~ Beta(alpha_a + 1, beta_a) y pB' ~ Beta(alpha_b + 1, beta_b).
+
+    Args:
+        alpha_a, beta_a: Parámetros de la posterior de A
+        alpha_b, beta_b: Parámetros de la posterior de B
+
+    Returns:
+        float: Pérdida esperada (en puntos de tasa, no en %)
+    """
+    mean_a, var_a = _beta_moments(alpha_a, beta_a)
+    mean_b, var_b = _beta_moments(alpha_b, beta_b)
+    if min(alpha_a, alpha_b) + 1 <= P2BB_EXACT_MAX_TERMS:
+        loss = (
+            mean_a * prob_b_beats_a(alpha_b, beta_b, alpha_a + 1, beta_a)
+            - mean_b * prob_b_beats_a(alpha_b + 1, beta_b, alpha_a, beta_a)
+        )
+    else:
+        # D = pA - pB ~ N(mu, sigma): E[max(D, 0)] = mu·Phi(mu/sigma) + sigma·phi(mu/sigma)
+        mu = mean_a - mean_b
+        sigma = np.sqrt(var_a + var_b)
+        z = mu / sigma
+        loss = mu * ndtr(z) + sigma * np.exp(-0.5 * z * z) / np.sqrt(2 * np.pi)
+    return max(float(loss), 0.0)
+
+
+def credible_interval(alpha, beta, level=CREDIBLE_INTERVAL_LEVEL):
+    """
+    Intervalo de credibilidad de colas iguales de una posterior Beta.
+
+    Args:
+        alpha, beta: Parámetros de la posterior
+        level: Nivel de credibilidad (default: 0.95)
+
+    Returns:
+        tuple: (límite inferior, límite superior) de la tasa de conversión
+    """
+    tail = (1 - level) / 2
+    return float(betaincinv(alpha, beta, tail)), float(betaincinv(alpha, beta, 1 - tail))
+
+
+def calculate_bayesian_comparison(a_n, a_x, b_n, b_x):
+    """
+    Métricas bayesianas de B contra A: P2BB, pérdida esperada e intervalos de credibilidad.
+
+    Args:
+        a_n, a_x: Sesiones y conversiones de A (baseline)
+        b_n, b_x: Sesiones y conversiones de B
+
+    Returns:
+        dict: p2bb, expected_loss_a (de quedarse con A), expected_loss_b (de elegir B),
+              ci_a y ci_b (intervalos de la tasa de conversión)
+    """
+    alpha_a, beta_a = beta_posterior_params(a_n, a_x)
+    alpha_b, beta_b = beta_posterior_params(b_n, b_x)
+    return {
+        'p2bb': prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b),
+        'expected_loss_a': expected_loss(alpha_b, beta_b, alpha_a, beta_a),
+        'expected_loss_b': expected_loss(alpha_a, beta_a, alpha_b, beta_b),
+        'ci_a': credible_interval(alpha_a, beta_a),
+        'ci_b': credible_interval(alpha_b, beta_b),
+    }
+
+
 def calculate_ab_test(control_n, control_x, treatment_n, treatment_x):
     """
     Calcula estadísticas de prueba A/B.
@@ -49,16 +197,8 @@ def calculate_ab_test(control_n, control_x, treatment_n, treatment_x):
     relative_lift = ((treatment_p - control_p) / control_p) * 100 if control_p > 0 else 0
     
     # Calcular probabilidad bayesiana (P2BB)
-    # Validar parámetros para evitar errores en la distribución beta
-    n_simulations = 10000
-    control_alpha = max(1, control_x + 1)
-    control_beta = max(1, control_n - control_x + 1)
-    treatment_alpha = max(1, treatment_x + 1)
-    treatment_beta = max(1, treatment_n - treatment_x + 1)
-    
-    baseline_posterior = np.random.beta(control_alpha, control_beta, n_simulations)
-    treatment_posterior = np.random.beta(treatment_alpha, treatment_beta, n_simulations)
-    p2bb = np.mean(treatment_posterior > baseline_posterior)
+    # OPTIMIZACIÓN: Cálculo analítico Beta-Beta (determinístico) en lugar de Monte Carlo
+    bayes = calculate_bayesian_comparison(control_n, control_x, treatment_n, treatment_x)
     
     return {
         'control_p': control_p,
@@ -67,7 +207,11 @@ def calculate_ab_test(control_n, control_x, treatment_n, treatment_x):
         'z_score': z_score,
         'p_value': p_value,
         'relative_lift': relative_lift,
-        'p2bb': p2bb
+        'p2bb': bayes['p2bb'],
+        'expected_loss_control': bayes['expected_loss_a'],
+        'expected_loss_treatment': bayes['expected_loss_b'],
+        'control_ci': bayes['ci_a'],
+        'treatment_ci': bayes['ci_b']
     }
 
 
@@ -113,16 +257,8 @@ def calculate_single_comparison(variant_a, variant_b, is_control_comparison=Fals
         relative_lift = 0
     
     # Calcular probabilidad bayesiana
-    # Validar parámetros para evitar errores en la distribución beta
-    n_simulations = 10000
-    a_alpha = max(1, variant_a['x'] + 1)
-    a_beta = max(1, variant_a['n'] - variant_a['x'] + 1)
-    b_alpha = max(1, variant_b['x'] + 1)
-    b_beta = max(1, variant_b['n'] - variant_b['x'] + 1)
-    
-    a_posterior = np.random.beta(a_alpha, a_beta, n_simulations)
-    b_posterior = np.random.beta(b_alpha, b_beta, n_simulations)
-    p2bb = np.mean(b_posterior > a_posterior)
+    # OPTIMIZACIÓN: Cálculo analítico Beta-Beta (determinístico) en lugar de Monte Carlo
+    bayes = calculate_bayesian_comparison(variant_a['n'], variant_a['x'], variant_b['n'], variant_b['x'])
     
     return {
         'variant_a_name': variant_a['name'],
@@ -131,7 +267,11 @@ def calculate_single_comparison(variant_a, variant_b, is_control_comparison=Fals
         'variant_b_p': b_p,
         'relative_lift': relative_lift,
         'p_value': p_value,
-        'p2bb': p2bb,
+        'p2bb': bayes['p2bb'],
+        'expected_loss_a': bayes['expected_loss_a'],
+        'expected_loss_b': bayes['expected_loss_b'],
+        'variant_a_ci': bayes['ci_a'],
+        'variant_b_ci': bayes['ci_b'],
         'significant': p_value < 0.05,
         'is_control_comparison': is_control_comparison
     }
@@ -193,28 +333,311 @@ def calculate_chi_square_test(variants):
     }
 
 
-def calculate_all_pairwise_comparisons(variants):
+def mirror_comparison(comparison, is_control_comparison=False):
+    """
+    Deriva la comparación (B vs A) a partir de la comparación (A vs B) sin recalcularla.
+
+    El p-value y la significancia son simétricos, P2BB pasa a 1 - P2BB y el lift se
+    recalcula con la tasa de B como base (igual que calculate_single_comparison).
+
+    Args:
+        comparison: Resultado de calculate_single_comparison(variant_a, variant_b)
+        is_control_comparison: Valor de 'is_control_comparison' del resultado espejado
+
+    Returns:
+        dict: Mismas claves que calculate_single_comparison(variant_b, variant_a)
+    """
+    a_p, b_p = comparison['variant_b_p'], comparison['variant_a_p']
+    return {
+        'variant_a_name': comparison['variant_b_name'],
+        'variant_b_name': comparison['variant_a_name'],
+        'variant_a_p': a_p,
+        'variant_b_p': b_p,
+        'relative_lift': ((b_p - a_p) / a_p) * 100 if a_p > 0 else 0,
+        'p_value': comparison['p_value'],
+        'p2bb': 1.0 - comparison['p2bb'],
+        'expected_loss_a': comparison['expected_loss_b'],
+        'expected_loss_b': comparison['expected_loss_a'],
+        'variant_a_ci': comparison['variant_b_ci'],
+        'variant_b_ci': comparison['variant_a_ci'],
+        'significant': comparison['significant'],
+        'is_control_comparison': is_control_comparison
+    }
+
+
+class PairwiseComparisons:
+    """
+    Comparaciones pareadas de un conjunto de variantes, calculadas una vez por par no ordenado.
+
+    get(i, j) devuelve la comparación de variants[i] (baseline) contra variants[j]; la
+    entrada (j, i) se deriva con mirror_comparison en lugar de recalcularse.
+    """
+
+    def __init__(self, variants):
+        self.variants = list(variants)
+        self._pairs = {}
+        self._lock = threading.Lock()
+
+    def _pair(self, i, j):
+        key = (min(i, j), max(i, j))
+        with self._lock:
+            comparison = self._pairs.get(key)
+            if comparison is None:
+                comparison = calculate_single_comparison(self.variants[key[0]], self.variants[key[1]])
+                self._pairs[key] = comparison
+        return comparison
+
+    def get(self, i, j):
+        """
+        Comparación de variants[i] (baseline) contra variants[j].
+
+        Returns:
+            dict: Mismas claves que calculate_single_comparison
+        """
+        if i == j:
+            raise ValueError("No se puede comparar una variante consigo misma")
+        comparison = self._pair(i, j)
+        if i < j:
+            return {**comparison, 'is_control_comparison': i == 0}
+        return mirror_comparison(comparison, is_control_comparison=(i == 0))
+
+    def against_control(self):
+        """Comparaciones del control (variante 0) contra cada variante, en orden."""
+        return [self.get(0, j) for j in range(1, len(self.variants))]
+
+    def all_pairs(self):
+        """Todas las comparaciones (i, j) con i < j, en el orden de calculate_all_pairwise_comparisons."""
+        return [self.get(i, j) for i in range(len(self.variants)) for j in range(i + 1, len(self.variants))]
+
+
+_pairwise_cache = OrderedDict()
+_pairwise_cache_lock = threading.Lock()
+
+
+def _variants_fingerprint(variants):
+    return tuple((str(v.get('name', '')), int(v.get('n', 0)), int(v.get('x', 0))) for v in variants)
+
+
+def get_pairwise_comparisons(variants, metric=None, segment=None):
+    """
+    Motor de comparaciones pareadas memoizado por (métrica, segmento, huella de los datos).
+
+    La matriz, las tarjetas y la exportación CSV de una misma métrica/segmento comparten
+    el mismo objeto, así que cada par no ordenado se calcula una sola vez por rerun (y
+    entre reruns mientras los datos no cambien).
+
+    Args:
+        variants: Lista de diccionarios con 'name', 'n', 'x' (la primera es el control)
+        metric: Nombre de la métrica (opcional)
+        segment: Segmento o subtítulo de la vista (opcional)
+
+    Returns:
+        PairwiseComparisons: Comparaciones de las variantes, en el orden recibido
+    """
+    key = (metric, segment, _variants_fingerprint(variants))
+    with _pairwise_cache_lock:
+        engine = _pairwise_cache.get(key)
+        if engine is not None:
+            _pairwise_cache.move_to_end(key)
+            return engine
+        engine = PairwiseComparisons(variants)
+        _pairwise_cache[key] = engine
+        while len(_pairwise_cache) > PAIRWISE_CACHE_MAX_ENTRIES:
+            _pairwise_cache.popitem(last=False)
+    return engine
+
+
+def clear_pairwise_cache():
+    """Vacía la memoización de comparaciones pareadas."""
+    with _pairwise_cache_lock:
+        _pairwise_cache.clear()
+
+
+def calculate_all_pairwise_comparisons(variants, metric=None, segment=None):
     """
     Calcula todas las comparaciones pareadas posibles entre variantes.
     
     Args:
         variants: Lista de diccionarios con 'name', 'n', 'x'
+        metric: Nombre de la métrica (opcional, para compartir la memoización)
+        segment: Segmento de la vista (opcional, para compartir la memoización)
         
     Returns:
         list: Lista de diccionarios con resultados de cada comparación
     """
-    all_comparisons = []
-    
-    # Generar todas las combinaciones posibles de variantes
-    for i in range(len(variants)):
-        for j in range(i + 1, len(variants)):
-            variant_a = variants[i]
-            variant_b = variants[j]
-            
-            comparison = calculate_single_comparison(variant_a, variant_b, is_control_comparison=(i == 0))
-            all_comparisons.append(comparison)
-    
-    return all_comparisons
+    # OPTIMIZACIÓN: Reutilizar el motor memoizado (cada par no ordenado se calcula una vez)
+    return get_pairwise_comparisons(variants, metric=metric, segment=segment).all_pairs()
+
+
+def comparison_pairs(n_variants, mode='control'):
+    """
+    Pares (i, j) de variantes a comparar, en el mismo orden que usa el dashboard.
+
+    Args:
+        n_variants: Número de variantes (la 0 es el control)
+        mode: 'control' (control vs cada variante) o 'pairwise' (todos los pares i < j,
+              mismo orden que calculate_all_pairwise_comparisons)
+
+    Returns:
+        np.ndarray: Array int de shape (n_pares, 2)
+    """
+    if mode == 'control':
+        pairs = [(0, j) for j in range(1, n_variants)]
+    elif mode == 'pairwise':
+        pairs = [(i, j) for i in range(n_variants) for j in range(i + 1, n_variants)]
+    else:
+        raise ValueError(f"mode inválido: {mode!r} (usar 'control' o 'pairwise')")
+    return np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def _prob_beta_greater_batch(alpha_a, beta_a, alpha_b, beta_b):
+    """
+    Versión vectorizada de prob_b_beats_a para arrays 1-D de parámetros.
+
+    Las sumas exactas de todos los pares se concatenan en un solo array y se reducen por
+    tramos (np.maximum.reduceat / np.add.reduceat), procesando bloques de a lo más
+    P2BB_BATCH_MAX_TERMS términos. Mismo criterio de simetría y de aproximación normal
+    que la versión escalar.
+    """
+    alpha_a, beta_a, alpha_b, beta_b = (np.asarray(v, dtype=np.float64) for v in (alpha_a, beta_a, alpha_b, beta_b))
+    p = np.empty(alpha_a.shape, dtype=np.float64)
+
+    # Aproximación normal cuando incluso el menor alpha excede el máximo de términos
+    approx = np.minimum(alpha_a, alpha_b) > P2BB_EXACT_MAX_TERMS
+    if approx.any():
+        mean_a, var_a = _beta_moments(alpha_a[approx], beta_a[approx])
+        mean_b, var_b = _beta_moments(alpha_b[approx], beta_b[approx])
+        p[approx] = ndtr((mean_b - mean_a) / np.sqrt(var_a + var_b))
+
+    exact = np.flatnonzero(~approx)
+    if len(exact):
+        # Sumar siempre sobre el menor alpha: P(B > A) = 1 - P(A > B)
+        swap = alpha_b[exact] > alpha_a[exact]
+        big_alpha = np.where(swap, alpha_b[exact], alpha_a[exact])
+        big_beta = np.where(swap, beta_b[exact], beta_a[exact])
+        small_alpha = np.where(swap, alpha_a[exact], alpha_b[exact])
+        small_beta = np.where(swap, beta_a[exact], beta_b[exact])
+
+        lengths = small_alpha.astype(np.int64)
+        sums = np.empty(len(exact), dtype=np.float64)
+        start = 0
+        while start < len(exact):
+            # Bloque de pares cuya suma de términos cabe en P2BB_BATCH_MAX_TERMS (al menos un par)
+            cumulative = np.cumsum(lengths[start:])
+            stop = start + max(1, int(np.searchsorted(cumulative, P2BB_BATCH_MAX_TERMS, side='right')))
+            block = slice(start, stop)
+            block_lengths = lengths[block]
+            offsets = np.concatenate(([0], np.cumsum(block_lengths)[:-1]))
+            owner = np.repeat(np.arange(stop - start), block_lengths)
+            i = np.arange(block_lengths.sum(), dtype=np.float64) - np.repeat(offsets, block_lengths)
+
+            # Los términos de la suma cumplen t_{i+1} / t_i = (a_a+i)(b_b+i) / ((a_a+b_a+b_b+i)(1+i)),
+            # así que basta un betaln por par (t_0) y un log por término (suma acumulada por tramo)
+            a_a, b_a, b_b = big_alpha[block], big_beta[block], small_beta[block]
+            first_terms = betaln(a_a, b_a + b_b) - np.log(b_b) - betaln(1, b_b) - betaln(a_a, b_a)
+            a_t, s_t, b_t = a_a[owner], (a_a + b_a + b_b)[owner], b_b[owner]
+            prev = i - 1
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # En el inicio de cada tramo (prev = -1) el cociente no aplica: se reemplaza por t_0
+                increments = np.log((a_t + prev) * (b_t + prev) / ((s_t + prev) * (1 + prev)))
+            increments[offsets] = first_terms
+            log_terms = np.cumsum(increments)
+            log_terms -= np.repeat(log_terms[offsets] - first_terms, block_lengths)
+            max_terms = np.maximum.reduceat(log_terms, offsets)
+            sums[block] = np.exp(max_terms) * np.add.reduceat(np.exp(log_terms - max_terms[owner]), offsets)
+            start = stop
+        p[exact] = np.where(swap, 1.0 - sums, sums)
+
+    return np.clip(p, 0.0, 1.0)
+
+
+def calculate_batch_comparisons(n, x, pairs='control', valid=None):
+    """
+    Calcula lift, SE, z, p-value, P2BB y significancia de muchas comparaciones en una pasada.
+
+    Cada fila de `n`/`x` es una celda (ej. métrica x segmento) y cada columna una variante
+    (la 0 es el control). Los resultados son idénticos a los de calculate_single_comparison
+    para cada par, pero calculados con operaciones vectorizadas de NumPy.
+
+    Args:
+        n: Sesiones, array-like de shape (celdas, variantes) o (variantes,)
+        x: Conversiones, mismo shape que n
+        pairs: 'control', 'pairwise' o lista de pares (i, j) (i = baseline, j = variante)
+        valid: Máscara booleana opcional (mismo shape que n) de variantes presentes en cada
+               celda; útil cuando las celdas tienen distinto número de variantes
+
+    Returns:
+        dict: 'pairs' (shape (pares, 2)) y arrays de shape (celdas, pares): 'variant_a_p',
+              'variant_b_p', 'relative_lift', 'se', 'z_score', 'p_value', 'p2bb',
+              'significant' y 'valid'. Los pares inválidos quedan con NaN (y significant=False).
+    """
+    n = np.atleast_2d(np.asarray(n, dtype=np.float64))
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    if n.shape != x.shape:
+        raise ValueError(f"n y x deben tener el mismo shape: {n.shape} != {x.shape}")
+    if valid is None:
+        valid = np.ones(n.shape, dtype=bool)
+    else:
+        valid = np.atleast_2d(np.asarray(valid, dtype=bool))
+        if valid.shape != n.shape:
+            raise ValueError(f"valid debe tener el shape de n: {valid.shape} != {n.shape}")
+    # Las variantes ausentes no deben contaminar los cálculos (se enmascaran al final)
+    n = np.where(valid, n, 0.0)
+    x = np.where(valid, x, 0.0)
+
+    if isinstance(pairs, str):
+        pairs = comparison_pairs(n.shape[1], pairs)
+    else:
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+
+    a_n, b_n = n[:, pairs[:, 0]], n[:, pairs[:, 1]]
+    a_x, b_x = x[:, pairs[:, 0]], x[:, pairs[:, 1]]
+    pair_valid = valid[:, pairs[:, 0]] & valid[:, pairs[:, 1]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a_p = np.where(a_n > 0, a_x / a_n, 0.0)
+        b_p = np.where(b_n > 0, b_x / b_n, 0.0)
+
+        # Mismo criterio que calculate_single_comparison: SE pooled, salvo tasas degeneradas
+        both_n = (a_n > 0) & (b_n > 0)
+        total_n = a_n + b_n
+        pooled_p = np.where(total_n > 0, (a_x + b_x) / total_n, 0.0)
+        inv_n = 1 / a_n + 1 / b_n
+        se_pooled = np.sqrt(pooled_p * (1 - pooled_p) * inv_n)
+        se_unpooled = np.sqrt(a_p * (1 - a_p) / a_n + b_p * (1 - b_p) / b_n)
+        use_pooled = both_n & (pooled_p > 0) & (pooled_p < 1)
+        se = np.where(use_pooled, se_pooled, np.where(both_n, se_unpooled, 0.0))
+
+        has_se = se > 0
+        z_score = np.where(has_se, (b_p - a_p) / se, 0.0)
+        finite_z = has_se & np.isfinite(z_score)
+        p_value = np.where(finite_z, 2 * ndtr(-np.abs(z_score)), 1.0)
+
+        relative_lift = np.where(a_p > 0, (b_p - a_p) / a_p * 100, 0.0)
+
+    # P2BB: posteriores Beta(1, 1) como en beta_posterior_params
+    p2bb = np.full(a_n.shape, np.nan)
+    if pair_valid.any():
+        p2bb[pair_valid] = _prob_beta_greater_batch(
+            np.maximum(1, a_x[pair_valid] + 1), np.maximum(1, a_n[pair_valid] - a_x[pair_valid] + 1),
+            np.maximum(1, b_x[pair_valid] + 1), np.maximum(1, b_n[pair_valid] - b_x[pair_valid] + 1),
+        )
+
+    results = {
+        'variant_a_p': a_p,
+        'variant_b_p': b_p,
+        'relative_lift': relative_lift,
+        'se': se,
+        'z_score': z_score,
+        'p_value': p_value,
+        'p2bb': p2bb,
+    }
+    for key, values in results.items():
+        values[~pair_valid] = np.nan
+    results['significant'] = pair_valid & (p_value < SIGNIFICANCE_LEVEL)
+    results['valid'] = pair_valid
+    results['pairs'] = pairs
+    return results
 
 
 def get_smart_label(name):
@@ -410,6 +833,33 @@ def format_duration(seconds):
             return f"{hours}h {remaining_minutes}m"
 
 
+def prepare_variants_by_step(df, initial_step=0, final_step=-1):
+    """
+    Prepara variantes usando la posición de los pasos del funnel en lugar de su nombre.
+    
+    Los DataFrames de get_variant_funnel / get_variant_funnel_cum listan los pasos en el
+    orden de la query, así que el orden de aparición de 'Funnel Stage' es el del funnel.
+    
+    Args:
+        df: DataFrame con columnas 'Variant', 'Event Count' y 'Funnel Stage'
+        initial_step: Índice del paso inicial (1 si la métrica tiene hidden_first_step)
+        final_step: Índice del paso final (por defecto, el último)
+        
+    Returns:
+        list: Lista de diccionarios {'name', 'n', 'x'}; vacía si no hay dos pasos distintos
+    """
+    if df is None or df.empty or 'Funnel Stage' not in df.columns:
+        return []
+    stages = list(df['Funnel Stage'].unique())
+    try:
+        initial_stage, final_stage = stages[initial_step], stages[final_step]
+    except IndexError:
+        return []
+    if initial_stage == final_stage:
+        return []
+    return prepare_variants_from_dataframe(df, initial_stage, final_stage)
+
+
 def prepare_variants_by_funnel_stage(df):
     """
     Prepara variantes agrupadas por etapa del funnel.
@@ -664,9 +1114,10 @@ def create_multivariant_card(metric_name, variants, experiment_name=None, metric
     </tr>
     """
     
-    # Variantes
-    for variant in variants[1:]:
-        comparison = calculate_single_comparison(baseline, variant)
+    # Variantes (comparaciones compartidas con la matriz y la exportación CSV)
+    pairwise = get_pairwise_comparisons(variants, metric=metric_name, segment=metric_subtitle)
+    for variant_idx, variant in enumerate(variants[1:], start=1):
+        comparison = pairwise.get(0, variant_idx)
         
         if is_time_mode:
             variant_time = time_data.get(variant.get('name', ''))
@@ -748,13 +1199,14 @@ def create_multivariant_card(metric_name, variants, experiment_name=None, metric
     components.html(card_html, height=400, scrolling=False)
 
 
-def create_comparison_matrix(metric_name, variants):
+def create_comparison_matrix(metric_name, variants, segment=None):
     """
     Crea una matriz interactiva mostrando todos los resultados de comparación pareada.
     
     Args:
         metric_name: Nombre de la métrica
         variants: Lista de diccionarios con 'name', 'n', 'x'
+        segment: Segmento de la vista (opcional, para compartir la memoización con las tarjetas)
     """
     st.markdown(f"### 📋 Matriz de Comparaciones - {metric_name}")
     
@@ -762,6 +1214,9 @@ def create_comparison_matrix(metric_name, variants):
     n_variants = len(variants)
     variant_names = [v['name'] for v in variants]
     
+    # OPTIMIZACIÓN: Cada par no ordenado se calcula una vez; (j, i) se deriva de (i, j)
+    pairwise = get_pairwise_comparisons(variants, metric=metric_name, segment=segment)
+    
     # Inicializar matrices
     z_values = []
     hover_texts = []
@@ -783,7 +1238,7 @@ def create_comparison_matrix(metric_name, variants):
                 # Comparación entre variantes
                 variant_a = variants[i]
                 variant_b = variants[j]
-                comparison = calculate_single_comparison(variant_a, variant_b)
+                comparison = pairwise.get(i, j)
                 
                 # Texto del tooltip
                 hover_text = f"""{variant_a['name']} vs {variant_b['name']}<br>
@@ -0,0 +1,233 @@
+"""
+Planificador de tareas compartido para todo el trabajo concurrente contra Amplitude.
+
+Todas las tareas de un análisis (queries del plan por métrica, requests por variante,
+sub-métricas, volúmenes, segmentos) corren en un único ThreadPoolExecutor de larga vida
+por proceso, en lugar de crear y destruir un pool en cada llamada. El límite real de
+requests a Amplitude lo sigue aplicando el gobernador de amplitude_client.
+
+Las tareas forman un grafo: una query del plan (métrica) puede abrir tareas por variante
+en el mismo pool. Para que un worker que espera a sus hijas no bloquee el pool, al
+esperar con TaskScheduler.as_completed() desde un worker se ejecutan en ese mismo hilo
+las hijas que ningún otro worker tomó todavía.
+
+Las tareas con `key` se deduplican: si ya hay una tarea en vuelo con la misma key se
+devuelve su future en lugar de encolar otra. Cada tarea se ejecuta con el deadline y el
+modo de trazas activos al momento de encolarla (bind_deadline, bind_debug_tracing), así
+que solo se comparte una tarea cuyo deadline dura al menos lo mismo que el de quien la pide. Un future compartido puede
+tener varios dueños (sesiones): TaskScheduler.cancel() solo lo cancela cuando todos los
+que lo pidieron lo cancelaron; future.cancel() directo no respeta a los demás dueños.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, Optional
+
+from src.utils.amplitude_client import FANOUT_MAX_WORKERS
+from src.utils.deadline import Deadline, bind_deadline, current_deadline
+from src.utils.tracing import bind_debug_tracing
+
+
+_worker_state = threading.local()
+
+
+class _Task:
+    """Tarea encolada: la ejecuta el primer hilo que la reclama (un worker o quien la espera)."""
+
+    def __init__(self, fn: Callable[[], Any], deadline: Optional[Deadline] = None):
+        self.fn = fn
+        self.deadline = deadline
+        self.future: Future = Future()
+        # Quienes recibieron este future (submit original + deduplicados) y no lo cancelaron
+        self.owners = 1
+        self._lock = threading.Lock()
+        self._claimed = False
+
+    def run(self) -> bool:
+        """
+        Ejecuta la tarea si nadie la reclamó antes y no fue cancelada.
+
+        Returns:
+            bool: True si este hilo la ejecutó
+        """
+        with self._lock:
+            if self._claimed:
+                return False
+            self._claimed = True
+        if not self.future.set_running_or_notify_cancel():
+            return False
+        try:
+            result = self.fn()
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+        return True
+
+
+def _mark_worker() -> None:
+    _worker_state.is_worker = True
+
+
+def _outlives(task_deadline: Optional[Deadline], deadline: Optional[Deadline]) -> bool:
+    """True si una tarea con task_deadline puede correr al menos hasta deadline."""
+    if task_deadline is None:
+        return True
+    return deadline is not None and task_deadline.expires_at >= deadline.expires_at
+
+
+class TaskScheduler:
+    """
+    Executor compartido con deduplicación por key y ejecución inline de tareas anidadas.
+    """
+
+    def __init__(self, max_workers: int = None):
+        """
+        Args:
+            max_workers: Hilos del pool (default: AMPLITUDE_FANOUT_WORKERS)
+        """
+        self.max_workers = max_workers or FANOUT_MAX_WORKERS
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='amplitude-task', initializer=_mark_worker
+        )
+        self._lock = threading.Lock()
+        self._tasks: Dict[Future, _Task] = {}
+        self._inflight: Dict[Hashable, Future] = {}
+        self.submitted = 0
+        self.deduplicated = 0
+        self.run_inline = 0
+        self.failed = 0
+
+    @staticmethod
+    def in_worker() -> bool:
+        """True si el hilo actual es un worker del planificador."""
+        return getattr(_worker_state, 'is_worker', False)
+
+    def submit(self, fn: Callable[..., Any], *args, key: Optional[Hashable] = None, **kwargs) -> Future:
+        """
+        Encola una tarea.
+
+        Args:
+            fn: Función a ejecutar
+            *args, **kwargs: Argumentos de fn
+            key: Opcional. Identidad de la tarea; si ya hay una en vuelo con la misma key
+                 (y su deadline no vence antes que el actual) se devuelve su future
+
+        Returns:
+            Future: Future con el resultado de fn (cancelar con TaskScheduler.cancel)
+        """
+        deadline = current_deadline()
+        with self._lock:
+            if key is not None:
+                existing = self._tasks.get(self._inflight.get(key))
+                if existing is not None and not existing.future.done() and _outlives(existing.deadline, deadline):
+                    existing.owners += 1
+                    self.deduplicated += 1
+                    return existing.future
+            bound = bind_deadline(bind_debug_tracing(fn))
+            task = _Task(lambda: bound(*args, **kwargs), deadline)
+            self._tasks[task.future] = task
+            if key is not None:
+                self._inflight[key] = task.future
+            self.submitted += 1
+        task.future.add_done_callback(lambda future: self._forget(future, key))
+        self._executor.submit(task.run)
+        return task.future
+
+    def _forget(self, future: Future, key: Optional[Hashable]) -> None:
+        with self._lock:
+            self._tasks.pop(future, None)
+            if key is not None and self._inflight.get(key) is future:
+                del self._inflight[key]
+            if not future.cancelled() and future.exception() is not None:
+                self.failed += 1
+
+    def cancel(self, future: Future) -> bool:
+        """
+        Retira a quien llama como dueño del future y lo cancela si no queda ningún otro
+        (un future deduplicado puede ser de otra sesión que todavía espera su resultado).
+
+        Args:
+            future: Future devuelto por submit
+
+        Returns:
+            bool: True si el future quedó cancelado
+        """
+        with self._lock:
+            task = self._tasks.get(future)
+            if task is not None:
+                task.owners -= 1
+                if task.owners > 0:
+                    return False
+        return future.cancel()
+
+    def as_completed(self, futures: Iterable[Future], timeout: Optional[float] = None) -> Iterator[Future]:
+        """
+        Igual que concurrent.futures.as_completed; desde un worker, primero ejecuta en este
+        hilo las tareas que aún no tomó nadie (evita que el pool se bloquee esperándose).
+
+        Args:
+            futures: Futures devueltos por submit
+            timeout: Opcional. Segundos máximos de espera (ej. deadline.remaining())
+
+        Returns:
+            Iterator[Future]: Futures a medida que terminan
+
+        Raises:
+            concurrent.futures.TimeoutError: Si se agota timeout antes de que terminen todos
+        """
+        futures = list(futures)
+        if self.in_worker():
+            for future in futures:
+                with self._lock:
+                    task = self._tasks.get(future)
+                if task is not None and task.run():
+                    with self._lock:
+                        self.run_inline += 1
+        return as_completed(futures, timeout=timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene los contadores del planificador.
+
+        Returns:
+            dict: Workers, tareas encoladas, pendientes, deduplicadas, ejecutadas inline y fallidas
+        """
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'submitted': self.submitted,
+                'pending': len(self._tasks),
+                'deduplicated': self.deduplicated,
+                'run_inline': self.run_inline,
+                'failed': self.failed,
+            }
+
+
+_scheduler: Optional[TaskScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_task_scheduler() -> TaskScheduler:
+    """
+    Obtiene el planificador compartido del proceso (se crea en el primer uso).
+
+    Returns:
+        TaskScheduler: Planificador compartido
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = TaskScheduler()
+    return _scheduler
+
+
+def get_task_scheduler_stats() -> Dict[str, Any]:
+    """
+    Obtiene los contadores del planificador compartido.
+
+    Returns:
+        dict: Ver TaskScheduler.get_stats
+    """
+    return get_task_scheduler().get_stats()
@@ -0,0 +1,190 @@
+"""
+Trazas estructuradas de las requests de funnel a Amplitude (opt-in).
+
+Cada query registra un evento con latencia, tamaño del payload, cantidad de pasos y
+resultado de caché (memory, store, network, shared = resultado de otra request en vuelo,
+error) en un ring buffer acotado en memoria. El buffer se consulta desde el panel de
+estadísticas de la app.
+
+Las trazas solo se registran si AMPLITUDE_TRACING está activo o si la sesión tiene el modo
+debug activo (set_debug_tracing). El flag de debug vive en un ContextVar, igual que el
+deadline: cada sesión de Streamlit lo fija en su propio hilo al inicio de cada ejecución y
+el planificador de tareas lo propaga a sus workers (bind_debug_tracing), así que el modo
+debug de una sesión no activa las trazas de las demás. Con las trazas apagadas, el camino
+normal solo revisa un flag: no inspecciona la respuesta ni escribe en stdout.
+
+Configuración (variables de entorno opcionales):
+- AMPLITUDE_TRACING: Activa las trazas para todo el proceso (default: 0)
+- AMPLITUDE_TRACE_BUFFER: Eventos que conserva el ring buffer (default: 500)
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+
+DEFAULT_TRACE_BUFFER = 500
+
+TRACING_ENABLED = os.getenv('AMPLITUDE_TRACING', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+try:
+    TRACE_BUFFER_SIZE = max(1, int(os.getenv('AMPLITUDE_TRACE_BUFFER', DEFAULT_TRACE_BUFFER)))
+except (TypeError, ValueError):
+    TRACE_BUFFER_SIZE = DEFAULT_TRACE_BUFFER
+
+_debug_tracing: contextvars.ContextVar = contextvars.ContextVar('amplitude_debug_tracing', default=False)
+_traces: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+_traces_lock = threading.Lock()
+
+
+def set_debug_tracing(enabled: bool) -> None:
+    """
+    Activa o desactiva las trazas por el modo debug (además de AMPLITUDE_TRACING) en el
+    contexto actual: el hilo de la sesión que llama y las tareas que encola desde ahí.
+
+    Args:
+        enabled: Valor de st.session_state['debug_mode']
+    """
+    _debug_tracing.set(bool(enabled))
+
+
+def bind_debug_tracing(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Envuelve fn para que, al ejecutarse en otro hilo, use el modo debug activo al momento
+    de envolverla.
+
+    Args:
+        fn: Función a ejecutar en el pool
+
+    Returns:
+        Callable: Función envuelta
+    """
+    enabled = _debug_tracing.get()
+    if not enabled:
+        return fn
+
+    def _bound(*args, **kwargs):
+        token = _debug_tracing.set(enabled)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _debug_tracing.reset(token)
+
+    return _bound
+
+
+def tracing_enabled() -> bool:
+    """True si se deben registrar trazas."""
+    return TRACING_ENABLED or _debug_tracing.get()
+
+
+def trace_start() -> Optional[float]:
+    """
+    Marca el inicio de una query.
+
+    Returns:
+        float | None: Instante de inicio, o None si las trazas están apagadas
+    """
+    return time.perf_counter() if tracing_enabled() else None
+
+
+def count_steps(response_json: Any) -> Optional[int]:
+    """Pasos del funnel en la respuesta (largo de `events` del primer grupo)."""
+    data = response_json.get('data') if isinstance(response_json, dict) else None
+    first = data[0] if isinstance(data, list) and data else data
+    events = first.get('events') if isinstance(first, dict) else None
+    return len(events) if isinstance(events, list) else None
+
+
+def record_trace(
+    started: Optional[float],
+    kind: str,
+    cache: str,
+    experiment_id: str = None,
+    variant: str = None,
+    payload_bytes: int = None,
+    steps: int = None,
+    fingerprint: str = None,
+    error: str = None,
+) -> None:
+    """
+    Registra una traza en el ring buffer (no hace nada si started es None).
+
+    Args:
+        started: Valor devuelto por trace_start()
+        kind: Tipo de query ('funnel', 'batch', ...)
+        cache: Resultado de caché ('memory', 'store', 'network', 'shared', 'error')
+        experiment_id, variant: Identificación de la query
+        payload_bytes: Tamaño de la respuesta HTTP (solo si hubo request)
+        steps: Pasos del funnel en la respuesta
+        fingerprint: Fingerprint de la query (se guardan los primeros 12 caracteres)
+        error: Mensaje de error, si la query falló
+    """
+    if started is None:
+        return
+    event = {
+        'ts': time.time(),
+        'kind': kind,
+        'cache': cache,
+        'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+        'payload_bytes': payload_bytes,
+        'steps': steps,
+        'experiment_id': experiment_id,
+        'variant': variant,
+        'fingerprint': fingerprint[:12] if fingerprint else None,
+        'error': error[:300] if error else None,
+    }
+    with _traces_lock:
+        _traces.append(event)
+
+
+def get_recent_traces(limit: int = None) -> List[Dict[str, Any]]:
+    """
+    Obtiene las trazas del buffer, de la más reciente a la más antigua.
+
+    Args:
+        limit: Opcional. Máximo de trazas a devolver
+
+    Returns:
+        list: Copia de las trazas
+    """
+    with _traces_lock:
+        traces = list(_traces)
+    traces.reverse()
+    return traces[:limit] if limit else traces
+
+
+def get_trace_stats() -> Dict[str, Any]:
+    """
+    Resume las trazas del buffer por resultado de caché.
+
+    Returns:
+        dict: Estado de las trazas y, por resultado de caché, cantidad y latencia p50/p95 (ms)
+    """
+    with _traces_lock:
+        traces = list(_traces)
+    by_cache: Dict[str, List[float]] = {}
+    for event in traces:
+        by_cache.setdefault(event['cache'], []).append(event['latency_ms'])
+    summary = {}
+    for cache, latencies in by_cache.items():
+        latencies.sort()
+        summary[cache] = {
+            'count': len(latencies),
+            'p50_ms': latencies[len(latencies) // 2],
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        }
+    return {
+        'enabled': tracing_enabled(),
+        'buffer_size': TRACE_BUFFER_SIZE,
+        'buffered': len(traces),
+        'by_cache': summary,
+    }
+
+
+def clear_traces() -> None:
+    """Vacía el ring buffer."""
+    with _traces_lock:
+        _traces.clear()
@@ -0,0 +1,155 @@
+"""
+Tests del planificador de queries por prefijo de funnel (query_planner).
+
+Una métrica servida por el carrier debe recibir exactamente la respuesta que daría su
+propia query de k pasos; las métricas que no son prefijo compatible nunca se fusionan.
+"""
+
+import copy
+
+from src.utils.query_planner import plan_funnel_queries, truncate_funnel_response
+
+
+DATES = ['2025-01-01', '2025-01-02', '2025-01-03']
+
+
+def _website(events, cumulative_raw, day_series, median_times, transitions):
+    """Elemento de `data` de /api/2/funnels con los campos por paso y por día."""
+    n_steps = len(events)
+    return {
+        'meta': {'segmentIndex': 0},
+        # Lista no relacionada con los pasos que coincide en largo con el funnel de 3 pasos
+        'groupValue': ['desktop', 'Windows', 'Chrome'],
+        'events': list(events),
+        'cumulativeRaw': list(cumulative_raw),
+        'cumulative': [round(count / cumulative_raw[0], 6) for count in cumulative_raw],
+        'stepByStep': [1.0] + [round(cumulative_raw[i] / cumulative_raw[i - 1], 6) for i in range(1, n_steps)],
+        'medianTransTimes': list(median_times),
+        'avgTransTimes': [time * 2 for time in median_times],
+        # Una distribución por transición entre pasos (n_steps - 1 elementos)
+        'stepTransTimeDistribution': [list(transition) for transition in transitions],
+        'dayFunnels': {
+            'xValues': list(DATES),
+            'formattedXValues': ['Jan 1', 'Jan 2', 'Jan 3'],
+            'series': [list(row) for row in day_series],
+        },
+        'dayMedianTransTimes': {
+            'xValues': list(DATES),
+            'series': [[step * 1000 + day for step in range(n_steps)] for day in range(len(DATES))],
+        },
+    }
+
+
+def _response(website):
+    return {'data': [website]}
+
+
+def _three_step_response():
+    return _response(_website(
+        ['view', 'select', 'pay'],
+        [300, 120, 30],
+        [[100, 40, 10], [110, 50, 12], [90, 30, 8]],
+        [0, 45000, 90000],
+        [[1, 2, 3], [4, 5]],
+    ))
+
+
+def _two_step_response():
+    """Respuesta que devolvería la query directa view → select (mismos datos que la de 3 pasos)."""
+    return _response(_website(
+        ['view', 'select'],
+        [300, 120],
+        [[100, 40], [110, 50], [90, 30]],
+        [0, 45000],
+        [[1, 2, 3]],
+    ))
+
+
+def test_truncated_prefix_matches_direct_query():
+    carrier_response = _three_step_response()
+    original = copy.deepcopy(carrier_response)
+
+    assert truncate_funnel_response(carrier_response, 2) == _two_step_response()
+    # La respuesta del carrier se comparte entre métricas: no se modifica
+    assert carrier_response == original
+
+
+def test_truncate_keeps_every_step_of_the_carrier():
+    assert truncate_funnel_response(_three_step_response(), 3) == _three_step_response()
+
+
+def test_truncate_keeps_unrelated_lists_of_matching_length():
+    truncated = truncate_funnel_response(_three_step_response(), 1)['data'][0]
+
+    assert truncated['groupValue'] == ['desktop', 'Windows', 'Chrome']
+    assert truncated['dayFunnels']['xValues'] == DATES
+    assert truncated['dayFunnels']['formattedXValues'] == ['Jan 1', 'Jan 2', 'Jan 3']
+    assert truncated['events'] == ['view']
+    assert truncated['stepTransTimeDistribution'] == []
+    assert truncated['dayFunnels']['series'] == [[100], [110], [90]]
+
+
+def test_truncate_accepts_dict_data_and_error_responses():
+    website = _three_step_response()['data'][0]
+
+    assert truncate_funnel_response({'data': website}, 2)['data'] == _two_step_response()['data'][0]
+    assert truncate_funnel_response({'error': 'rate limited'}, 2) == {'error': 'rate limited'}
+
+
+def _metric(name, events, filters=None, hidden_first_step=False):
+    return {'name': name, 'events': list(events), 'filters': filters or {}, 'hidden_first_step': hidden_first_step}
+
+
+def _groups(plan):
+    return [[member['name'] for member in query['members']] for query in plan['queries']]
+
+
+def test_prefix_metrics_share_one_query():
+    plan = plan_funnel_queries([
+        _metric('view → select', ['view', 'select']),
+        _metric('view → select → pay', ['view', 'select', 'pay']),
+    ])
+
+    assert _groups(plan) == [['view → select', 'view → select → pay']]
+    assert plan['queries'][0]['metric']['name'] == 'view → select → pay'
+    assert [member['n_steps'] for member in plan['queries'][0]['members']] == [2, 3]
+    assert plan['saved_calls'] == 1
+
+
+def test_sibling_metrics_are_not_merged():
+    plan = plan_funnel_queries([
+        _metric('view → select', ['view', 'select']),
+        _metric('view → pay', ['view', 'pay']),
+    ])
+
+    assert _groups(plan) == [['view → select'], ['view → pay']]
+
+
+def test_metrics_with_different_step_filters_are_not_merged():
+    flexi = [{'subprop_type': 'event', 'subprop_key': 'product', 'subprop_op': 'is', 'subprop_value': ['flexi']}]
+    plan = plan_funnel_queries([
+        _metric('select', ['view', 'select']),
+        _metric('select flexi → pay', ['view', 'select', 'pay'], filters={'select': flexi}),
+    ])
+
+    assert _groups(plan) == [['select'], ['select flexi → pay']]
+
+
+def test_metrics_with_different_context_filters_are_not_merged():
+    # Un filtro explícito de flow_type en un paso posterior cambia los filtros globales del ancla
+    flow_type = [{'subprop_type': 'event', 'subprop_key': 'flow_type', 'subprop_op': 'is', 'subprop_value': ['DB']}]
+    plan = plan_funnel_queries([
+        _metric('view → select', ['view', 'select']),
+        _metric('view → select → pay DB', ['view', 'select', 'pay'], filters={'pay': flow_type}),
+    ])
+
+    assert _groups(plan) == [['view → select'], ['view → select → pay DB']]
+
+
+def test_hidden_first_step_is_never_merged():
+    plan = plan_funnel_queries([
+        _metric('view → select', ['view', 'select']),
+        _metric('view → select → pay (oculto)', ['view', 'select', 'pay'], hidden_first_step=True),
+    ])
+
+    assert _groups(plan) == [['view → select'], ['view → select → pay (oculto)']]
@@ -0,0 +1,110 @@
+"""
+Tests del reparto de respuestas agrupadas (group-by) en los buckets del desglose por segmento.
+"""
+
+import pytest
+
+from src.utils.segment_breakdown import split_grouped_response
+
+
+EVENTS = ['extras_dom_loaded', 'extra_selected', 'revenue_amount']
+
+
+def _group(value, cumulative_raw, days):
+    """Elemento de `data` de un grupo: days = {fecha: [conteo por paso]}."""
+    return {
+        'groupValue': [value] if value is not None else [],
+        'events': list(EVENTS),
+        'cumulativeRaw': list(cumulative_raw),
+        'cumulative': [1.0, 0.5, 0.1],
+        'stepByStep': [1.0, 0.5, 0.2],
+        'medianTransTimes': [0, 30000, 60000],
+        'dayFunnels': {'xValues': list(days), 'series': [list(row) for row in days.values()]},
+    }
+
+
+def _website(result, segment):
+    data = result[segment]['data']
+    assert len(data) == 1
+    return data[0]
+
+
+def test_device_desktop_is_not_bucket():
+    response = {'data': [
+        _group('Windows', [100, 40, 10], {'2025-01-01': [100, 40, 10]}),
+        _group('Mac OS X', [50, 20, 5], {'2025-01-01': [50, 20, 5]}),
+        _group('Android', [80, 30, 6], {'2025-01-01': [80, 30, 6]}),
+        _group('Apple iPhone', [70, 10, 2], {'2025-01-01': [70, 10, 2]}),
+    ]}
+
+    result = split_grouped_response(response, 'Device', ['desktop', 'mobile'])
+
+    # desktop = device_type "is not" Android / Apple iPhone
+    assert _website(result, 'desktop')['cumulativeRaw'] == [150, 60, 15]
+    assert _website(result, 'mobile')['cumulativeRaw'] == [150, 40, 8]
+    assert _website(result, 'desktop')['dayFunnels']['series'] == [[150, 60, 15]]
+
+
+def test_culture_inter_sums_every_member_culture():
+    response = {'data': [
+        _group('es-CL', [500, 200, 50], {'2025-01-01': [500, 200, 50]}),
+        _group('pt-BR', [100, 40, 8], {'2025-01-01': [100, 40, 8]}),
+        _group('es_UY', [30, 10, 2], {'2025-01-01': [30, 10, 2]}),
+        _group('en-US', [20, 5, 1], {'2025-01-01': [20, 5, 1]}),
+    ]}
+
+    result = split_grouped_response(response, 'Culture', ['CL', 'INTER'])
+
+    assert _website(result, 'CL')['cumulativeRaw'] == [500, 200, 50]
+    assert _website(result, 'INTER')['cumulativeRaw'] == [150, 55, 11]
+
+
+def test_misaligned_day_series_are_summed_by_date():
+    response = {'data': [
+        _group('pt-BR', [30, 12, 3], {'2025-01-01': [10, 4, 1], '2025-01-02': [20, 8, 2]}),
+        _group('es-EC', [15, 6, 1], {'2025-01-02': [5, 2, 0], '2025-01-03': [10, 4, 1]}),
+    ]}
+
+    website = _website(split_grouped_response(response, 'Culture', ['INTER']), 'INTER')
+
+    assert website['dayFunnels'] == {
+        'xValues': ['2025-01-01', '2025-01-02', '2025-01-03'],
+        'series': [[10, 4, 1], [25, 10, 2], [10, 4, 1]],
+    }
+    assert website['cumulativeRaw'] == [45, 18, 4]
+
+
+def test_summed_bucket_is_built_from_a_neutral_skeleton():
+    response = {'data': [
+        _group('pt-BR', [100, 40, 10], {'2025-01-01': [100, 40, 10]}),
+        _group('es-DO', [100, 60, 20], {'2025-01-01': [100, 60, 20]}),
+    ]}
+
+    website = _website(split_grouped_response(response, 'Culture', ['INTER']), 'INTER')
+
+    assert website['events'] == EVENTS
+    assert website['cumulative'] == [1.0, 0.5, 0.15]
+    assert website['stepByStep'] == [1.0, 0.5, 0.3]
+    # Los campos que no se pueden sumar no se copian del primer grupo
+    assert 'groupValue' not in website
+    assert 'medianTransTimes' not in website
+
+
+def test_bucket_without_groups_is_empty():
+    response = {'data': [_group('es-CL', [10, 5, 1], {'2025-01-01': [10, 5, 1]})]}
+
+    website = _website(split_grouped_response(response, 'Culture', ['AR']), 'AR')
+
+    assert website['cumulativeRaw'] == [0, 0, 0]
+    assert website['dayFunnels'] == {'xValues': [], 'series': []}
+    assert website['cumulative'] == [0, 0, 0]
+
+
+def test_response_without_group_value_raises():
+    website = _group('Windows', [10, 5, 1], {'2025-01-01': [10, 5, 1]})
+    del website['groupValue']
+
+    with pytest.raises(ValueError):
+        split_grouped_response({'data': [website]}, 'Device', ['desktop'])
+    with pytest.raises(ValueError):
+        split_grouped_response({'data': []}, 'Device', ['desktop'])
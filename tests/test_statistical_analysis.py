@@ -0,0 +1,186 @@
+"""
+Tests de las métricas bayesianas y de los motores de comparación de statistical_analysis.
+
+Las fórmulas cerradas (P2BB, pérdida esperada) se contrastan con Monte Carlo sobre las
+mismas posteriores Beta; el cálculo batch y el motor pareado se contrastan con la
+comparación escalar.
+"""
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from src.utils.statistical_analysis import (
+    P2BB_EXACT_MAX_TERMS,
+    beta_posterior_params,
+    calculate_batch_comparisons,
+    calculate_bayesian_comparison,
+    calculate_single_comparison,
+    clear_pairwise_cache,
+    credible_interval,
+    expected_loss,
+    get_pairwise_comparisons,
+    prob_b_beats_a,
+)
+
+
+MC_SAMPLES = 400_000
+
+# (n_a, x_a, n_b, x_b): volúmenes chicos, medianos, sin datos, iguales y con B claramente mejor
+POSTERIOR_CASES = [
+    (0, 0, 0, 0),
+    (0, 0, 50, 10),
+    (100, 10, 100, 10),
+    (1000, 120, 1000, 135),
+    (40, 3, 35, 7),
+    (5000, 400, 5200, 380),
+    (200, 0, 200, 200),
+]
+
+
+def _posterior_samples(n, x, rng):
+    alpha, beta = beta_posterior_params(n, x)
+    return rng.beta(alpha, beta, MC_SAMPLES)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(20240601)
+
+
+@pytest.mark.parametrize('a_n, a_x, b_n, b_x', POSTERIOR_CASES)
+def test_p2bb_matches_monte_carlo(a_n, a_x, b_n, b_x, rng):
+    p_a = _posterior_samples(a_n, a_x, rng)
+    p_b = _posterior_samples(b_n, b_x, rng)
+    expected = np.mean(p_b > p_a)
+    tolerance = 4 * np.sqrt(max(expected * (1 - expected), 1e-4) / MC_SAMPLES) + 1e-4
+
+    alpha_a, beta_a = beta_posterior_params(a_n, a_x)
+    alpha_b, beta_b = beta_posterior_params(b_n, b_x)
+    assert prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b) == pytest.approx(expected, abs=tolerance)
+
+
+@pytest.mark.parametrize('a_n, a_x, b_n, b_x', POSTERIOR_CASES)
+def test_expected_loss_matches_monte_carlo(a_n, a_x, b_n, b_x, rng):
+    p_a = _posterior_samples(a_n, a_x, rng)
+    p_b = _posterior_samples(b_n, b_x, rng)
+    losses = np.maximum(p_a - p_b, 0)
+    tolerance = 4 * losses.std() / np.sqrt(MC_SAMPLES) + 1e-6
+
+    alpha_a, beta_a = beta_posterior_params(a_n, a_x)
+    alpha_b, beta_b = beta_posterior_params(b_n, b_x)
+    assert expected_loss(alpha_a, beta_a, alpha_b, beta_b) == pytest.approx(losses.mean(), abs=tolerance)
+
+
+def test_zero_sessions_is_uniform_posterior():
+    bayes = calculate_bayesian_comparison(0, 0, 0, 0)
+
+    assert bayes['p2bb'] == pytest.approx(0.5)
+    # E[max(U1 - U2, 0)] con U1, U2 ~ U(0, 1) independientes
+    assert bayes['expected_loss_a'] == pytest.approx(1 / 6)
+    assert bayes['expected_loss_b'] == pytest.approx(1 / 6)
+    assert bayes['ci_a'] == pytest.approx((0.025, 0.975))
+
+
+def test_equal_counts_are_a_coin_flip():
+    bayes = calculate_bayesian_comparison(1000, 150, 1000, 150)
+
+    assert bayes['p2bb'] == pytest.approx(0.5, abs=1e-12)
+    assert bayes['expected_loss_a'] == pytest.approx(bayes['expected_loss_b'], rel=1e-9)
+    assert bayes['ci_a'] == bayes['ci_b']
+
+
+def test_normal_approximation_matches_monte_carlo(rng):
+    # Ambos alphas por encima de P2BB_EXACT_MAX_TERMS: se usa la aproximación normal
+    a_n, a_x = 2_000_000, P2BB_EXACT_MAX_TERMS + 5000
+    b_n, b_x = 2_000_000, P2BB_EXACT_MAX_TERMS + 5300
+    p_a = _posterior_samples(a_n, a_x, rng)
+    p_b = _posterior_samples(b_n, b_x, rng)
+
+    alpha_a, beta_a = beta_posterior_params(a_n, a_x)
+    alpha_b, beta_b = beta_posterior_params(b_n, b_x)
+    assert prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b) == pytest.approx(np.mean(p_b > p_a), abs=5e-3)
+    assert expected_loss(alpha_b, beta_b, alpha_a, beta_a) == pytest.approx(
+        np.maximum(p_b - p_a, 0).mean(), rel=2e-2
+    )
+
+
+@pytest.mark.parametrize('n, x', [(0, 0), (10, 1), (1000, 300), (50, 50)])
+def test_credible_interval_is_equal_tailed(n, x):
+    alpha, beta = beta_posterior_params(n, x)
+    lower, upper = credible_interval(alpha, beta)
+
+    assert stats.beta.cdf(lower, alpha, beta) == pytest.approx(0.025)
+    assert stats.beta.cdf(upper, alpha, beta) == pytest.approx(0.975)
+    assert 0 <= lower < upper <= 1
+
+
+def _variants(counts):
+    return [{'name': f'v{idx}', 'n': n, 'x': x} for idx, (n, x) in enumerate(counts)]
+
+
+BATCH_COUNTS = [
+    [(1000, 100), (1000, 120), (980, 90), (1010, 101)],
+    [(0, 0), (10, 1), (10, 10), (300, 0)],
+    [(25000, 21000), (24800, 21300), (25100, 20900), (24900, 21050)],
+]
+
+
+@pytest.mark.parametrize('mode', ['control', 'pairwise'])
+def test_batch_matches_scalar_comparisons(mode):
+    n = np.array([[cell_n for cell_n, _ in row] for row in BATCH_COUNTS])
+    x = np.array([[cell_x for _, cell_x in row] for row in BATCH_COUNTS])
+    batch = calculate_batch_comparisons(n, x, pairs=mode)
+
+    for cell, row in enumerate(BATCH_COUNTS):
+        variants = _variants(row)
+        for pair_idx, (i, j) in enumerate(batch['pairs']):
+            scalar = calculate_single_comparison(variants[i], variants[j])
+            for key in ('variant_a_p', 'variant_b_p', 'relative_lift', 'p_value', 'p2bb'):
+                assert batch[key][cell, pair_idx] == pytest.approx(scalar[key], rel=1e-7, abs=1e-9), (key, cell, i, j)
+            assert bool(batch['significant'][cell, pair_idx]) == scalar['significant']
+
+
+def test_batch_masks_missing_variants():
+    n = np.array([[1000, 1000, 0], [1000, 1100, 900]])
+    x = np.array([[100, 130, 0], [100, 120, 95]])
+    valid = np.array([[True, True, False], [True, True, True]])
+    batch = calculate_batch_comparisons(n, x, pairs='control', valid=valid)
+
+    assert batch['valid'].tolist() == [[True, False], [True, True]]
+    assert np.isnan(batch['p2bb'][0, 1]) and not batch['significant'][0, 1]
+    scalar = calculate_single_comparison({'name': 'a', 'n': 1000, 'x': 100}, {'name': 'c', 'n': 900, 'x': 95})
+    assert batch['p2bb'][1, 1] == pytest.approx(scalar['p2bb'], rel=1e-9)
+
+
+@pytest.mark.parametrize('a_n, a_x, b_n, b_x', POSTERIOR_CASES)
+def test_p2bb_is_symmetric(a_n, a_x, b_n, b_x):
+    alpha_a, beta_a = beta_posterior_params(a_n, a_x)
+    alpha_b, beta_b = beta_posterior_params(b_n, b_x)
+
+    p_b_beats_a = prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b)
+    p_a_beats_b = prob_b_beats_a(alpha_b, beta_b, alpha_a, beta_a)
+    assert p_a_beats_b == pytest.approx(1 - p_b_beats_a, abs=1e-12)
+
+
+def test_pairwise_engine_mirrors_pairs():
+    clear_pairwise_cache()
+    variants = _variants([(1000, 100), (1000, 125), (950, 90)])
+    engine = get_pairwise_comparisons(variants, metric='m', segment='s')
+
+    assert get_pairwise_comparisons(variants, metric='m', segment='s') is engine
+    for i in range(len(variants)):
+        for j in range(len(variants)):
+            if i == j:
+                continue
+            forward, backward = engine.get(i, j), engine.get(j, i)
+            assert backward['p2bb'] == pytest.approx(1 - forward['p2bb'], abs=1e-12)
+            assert backward['p_value'] == forward['p_value']
+            assert backward['expected_loss_a'] == forward['expected_loss_b']
+            direct = calculate_single_comparison(variants[i], variants[j])
+            assert forward['p2bb'] == pytest.approx(direct['p2bb'], abs=1e-12)
+            assert forward['relative_lift'] == pytest.approx(direct['relative_lift'])
+            assert forward['is_control_comparison'] == (i == 0)
+
+    with pytest.raises(ValueError):
+        engine.get(1, 1)